@@ -26,4 +26,13 @@ else:           # pragma: no cover
     iterkeys = lambda d: d.iterkeys()
     itervalues = lambda d: d.itervalues()
     iteritems = lambda d: d.iteritems()
-    max_integer = sys.maxint
\ No newline at end of file
+    max_integer = sys.maxint
+
+
+def with_metaclass(meta, *bases):
+    """base class created by `meta`, for both python 2 and 3"""
+
+    class metaclass(meta):
+        def __new__(cls, name, this_bases, d):
+            return meta(name, bases, d)
+    return type.__new__(metaclass, 'temporary_class', (), {})
@@ -31,7 +31,10 @@ from kepavi.auth.views import auth
 from kepavi.home.views import home
 
 # extensions
-from kepavi.extensions import db, login_manager, cache, migrate, github, csrf, gravatar, babel, oauth, mongo
+from kepavi.extensions import db, login_manager, cache, migrate, github, csrf, gravatar, babel, oauth, mongo, \
+    model_cache, job_queue, solution_cache, results_cache, http_client, \
+    s3_client, topology_cache
+from kepavi.solvers import get_solver
 
 
 def create_app(config=None):
@@ -120,6 +123,24 @@ def configure_extensions(app):
 
     mongo.init_app(app)
 
+    model_cache.init_app(app)
+
+    job_queue.init_app(app)
+
+    solution_cache.init_app(app)
+
+    results_cache.init_app(app)
+
+    topology_cache.init_app(app)
+
+    http_client.init_app(app)
+
+    s3_client.init_app(app)
+
+    # an unknown or unusable FBA backend fails at start-up rather than
+    # in every analysis
+    get_solver(app.config.get('FBA_SOLVER', 'cobra'))
+
 
 def configure_template_filters(app):
     """
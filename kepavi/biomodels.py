@@ -1,6 +1,7 @@
 import logging
 
-from mongoengine import StringField, DynamicDocument, DictField
+import numpy as np
+from mongoengine import StringField, DynamicDocument, DictField, IntField, BinaryField
 import cobra.io
 
 
@@ -14,6 +15,186 @@ class BiomodelMongo(DynamicDocument):
 
     cobra_model = DictField()
 
+    # `kepavi.snapshot` binary version of `cobra_model`, much faster to load
+    snapshot = BinaryField()
+    n_reactions = IntField()
+
+    # see `reaction_summary`, read alone with a projection
+    reaction_summary = DictField()
+
+    # see `kegg_index`, read alone with a projection
+    kegg_index = DictField()
+
+    # bumped each time `cobra_model` is updated, invalidates worker caches
+    version = IntField(default=1)
+
     # username = StringField()
 
 
+def reaction_summary(model):
+    """
+    What the FBA creation form needs about each reaction, as parallel
+    lists. Mass balance is checked here once instead of on each request.
+
+    :param model: cobra model
+    :return: dict of lists
+    """
+
+    summary = {'names': [], 'lower_bounds': [], 'upper_bounds': [],
+               'reversibility': [], 'mass_balanced': []}
+    for r in model.reactions:
+        summary['names'].append(r.name)
+        summary['lower_bounds'].append(r.lower_bound)
+        summary['upper_bounds'].append(r.upper_bound)
+        summary['reversibility'].append(r.reversibility)
+        try:
+            balanced = not bool(r.check_mass_balance())
+        except Exception as e:
+            logging.warn('mass balance of {} failed: {}'.format(r.id, e))
+            balanced = False
+        summary['mass_balanced'].append(balanced)
+    return summary
+
+
+def kegg_ids(element):
+    """
+    KEGG ids of a reaction or metabolite, read from its `KEGG` notes
+    (comma separated) or from its `kegg.compound` annotation
+
+    :return: set of ids, '0' and 'NA' placeholders excluded
+    """
+
+    if 'KEGG' in element.notes:
+        ids = element.notes['KEGG'][0].replace(' ', '').split(',')
+    elif 'kegg.compound' in element.annotation:
+        ids = element.annotation['kegg.compound']
+        if not isinstance(ids, (list, tuple)):
+            ids = [ids]
+    else:
+        return set()
+    return set(ids).difference({'', '0', 'NA'})
+
+
+def kegg_index(model):
+    """
+    KEGG ids of each reaction and metabolite, as lists in the model
+    order (a KEGG id may be shared by several of them). Computed once
+    at ingestion, see `KeggIndex`.
+
+    :param model: cobra model
+    :return: dict of lists of sorted lists
+    """
+
+    return {'reactions': [sorted(kegg_ids(r)) for r in model.reactions],
+            'metabolites': [sorted(kegg_ids(m)) for m in model.metabolites]}
+
+
+class KeggIndex(object):
+    """
+    KEGG id -> indices of the reactions (or metabolites) carrying it, in
+    the model order, built from `kegg_index`
+    """
+
+    def __init__(self, index):
+        self.n_reactions = len(index['reactions'])
+        self.n_metabolites = len(index['metabolites'])
+        self.reactions = self._invert(index['reactions'])
+        self.metabolites = self._invert(index['metabolites'])
+
+    @staticmethod
+    def _invert(ids_by_position):
+        positions = {}
+        for i, ids in enumerate(ids_by_position):
+            for kegg_id in ids:
+                positions.setdefault(kegg_id, []).append(i)
+        return positions
+
+    def reaction(self, kegg_id):
+        """index of the last reaction carrying the id, None if there is none"""
+
+        positions = self.reactions.get(kegg_id)
+        return positions[-1] if positions else None
+
+    def metabolite(self, kegg_id):
+        """index of the last metabolite carrying the id, None if there is none"""
+
+        positions = self.metabolites.get(kegg_id)
+        return positions[-1] if positions else None
+
+    def compounds(self, S):
+        """
+        `CompoundIndex` of the model, built on first use
+
+        :param S: stoichiometric matrix of the same model
+        """
+
+        if getattr(self, '_compounds', None) is None:
+            self._compounds = CompoundIndex(self, S)
+        return self._compounds
+
+
+class CompoundIndex(object):
+    """
+    KEGG compound id -> indices of the reactions consuming it
+    (`reactants`) or producing it (`products`), read from the signs of
+    the stoichiometric matrix. Matching a reaction by its compounds then
+    only visits the reactions sharing one of them.
+    """
+
+    def __init__(self, kegg_index, S):
+        S = S.tocsr()
+        self.n_reactions = S.shape[1]
+        self.reactants = self._side(kegg_index.metabolites, S, S.data < 0)
+        self.products = self._side(kegg_index.metabolites, S, S.data > 0)
+
+    @staticmethod
+    def _side(metabolites, S, mask):
+        reactions = {}
+        for kegg_id, positions in metabolites.items():
+            columns = [S.indices[S.indptr[m]:S.indptr[m + 1]][mask[S.indptr[m]:S.indptr[m + 1]]]
+                       for m in positions]
+            columns = np.unique(np.concatenate(columns)).astype(np.int64)
+            if len(columns):
+                reactions[kegg_id] = columns
+        return reactions
+
+    def _hits(self, side, ids_by_query):
+        """sorted query * n_reactions + reaction keys, and the number of ids matched for each"""
+
+        queries, reactions = [], []
+        for i, ids in enumerate(ids_by_query):
+            for kegg_id in set(ids):
+                found = side.get(kegg_id)
+                if found is not None:
+                    queries.append(np.repeat(i, len(found)))
+                    reactions.append(found)
+        if not reactions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys = np.concatenate(queries).astype(np.int64) * self.n_reactions + np.concatenate(reactions)
+        return np.unique(keys, return_counts=True)
+
+    def match(self, queries):
+        """
+        best matching reactions of each (reactant ids, product ids) query:
+        the reactions sharing at least a reactant and a product with it
+        and the most compounds overall
+
+        :param queries: list of pairs of KEGG compound ids iterables
+        :return: list of frozensets of reaction indices, in the queries
+                 order, empty when nothing matches
+        """
+
+        reactant_keys, reactant_counts = self._hits(self.reactants, [q[0] for q in queries])
+        product_keys, product_counts = self._hits(self.products, [q[1] for q in queries])
+        keys = np.intersect1d(reactant_keys, product_keys, assume_unique=True)
+        scores = (reactant_counts[np.searchsorted(reactant_keys, keys)] +
+                  product_counts[np.searchsorted(product_keys, keys)])
+        query, reaction = keys // self.n_reactions, keys % self.n_reactions
+
+        best = np.zeros(len(queries), dtype=np.int64)
+        np.maximum.at(best, query, scores)
+        kept = scores == best[query]
+        matches = [[] for _ in queries]
+        for q, r in zip(query[kept].tolist(), reaction[kept].tolist()):
+            matches[q].append(r)
+        return [frozenset(m) for m in matches]
@@ -0,0 +1,624 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.caching
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Process local caches. Each uwsgi worker owns its own instances,
+    nothing is shared between processes.
+
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from kepavi import currency, layout
+from kepavi.files import atomic_write, load_array, save_array
+from kepavi.results import open_results
+from kepavi.stoichiometry import ModelArrays, arrays_path
+
+
+class LRUCache(object):
+    """
+    Least recently used cache bounded by a total size. The size of
+    each entry is given by `sizeof` (1 by default, i.e. the cache is
+    bounded by its number of entries).
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None, count=True):
+        """
+        :param count: when False the lookup is not counted in the hits
+                      and misses, e.g. when looking again for a key
+                      just missed
+        """
+
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                if count:
+                    self.misses += 1
+                return default
+            # move it to the most recently used end
+            self._entries[key] = (value, size)
+            if count:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self.pop(key)
+            if size > self.max_size:
+                # would evict everything and still not fit
+                logging.warn('cache entry {} too large: {} > {}'.format(key, size, self.max_size))
+                return value
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (__, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                return None
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / total if total else 0.}
+
+
+def estimate_model_size(model):
+    """
+    rough estimation in bytes of the memory held by a cobra model,
+    measured on BioModels genome scale models
+    """
+
+    n_stoichiometry = sum(len(r._metabolites) for r in model.reactions)
+    return (2048 * len(model.reactions) +
+            1024 * len(model.metabolites) +
+            512 * len(model.genes) +
+            256 * n_stoichiometry)
+
+
+def index_reactions_by_name(model):
+    """name -> list of reactions, names are not unique in every model"""
+
+    index = {}
+    for r in model.reactions:
+        index.setdefault(r.name, []).append(r)
+    return index
+
+
+class ModelView(object):
+    """
+    Copy on write view on a shared cobra model. Every change has to go
+    through `set_bounds`, `set_objective`, `set_stoichiometry`,
+    `add_metabolites` or `add_reaction`, the original values are
+    journaled and put back by `restore` so the cached model is left
+    untouched once the view is released.
+    """
+
+    def __init__(self, model, reactions_by_name=None):
+        self.model = model
+        self._reactions_by_name = reactions_by_name
+        self._journal = OrderedDict()
+        self._stoichiometry_journal = OrderedDict()
+        self._added_metabolites = []
+        self._added = []
+
+    @property
+    def reactions(self):
+        return self.model.reactions
+
+    @property
+    def reactions_by_name(self):
+        if self._reactions_by_name is None:
+            self._reactions_by_name = index_reactions_by_name(self.model)
+        return self._reactions_by_name
+
+    def resolve_reactions(self, names):
+        """
+        :param names: reaction names
+        :return: (reaction by name, missing names, duplicated names),
+                 the first reaction is used for duplicated names
+        """
+
+        found, missing, duplicated = {}, [], []
+        for name in names:
+            if name in found:
+                continue
+            reactions = self.reactions_by_name.get(name, [])
+            # the shared index does not know the reactions added by the view
+            reactions = reactions + [r for r in self._added if r.name == name]
+            if not reactions:
+                missing.append(name)
+                continue
+            if len(reactions) > 1:
+                duplicated.append(name)
+            found[name] = reactions[0]
+        return found, missing, duplicated
+
+    def _remember(self, reaction):
+        if reaction.id not in self._journal:
+            self._journal[reaction.id] = (reaction,
+                                          reaction.lower_bound,
+                                          reaction.upper_bound,
+                                          reaction.objective_coefficient)
+
+    def set_bounds(self, reaction, lower_bound, upper_bound):
+        self._remember(reaction)
+        reaction.lower_bound = lower_bound
+        reaction.upper_bound = upper_bound
+
+    def set_objective(self, reaction, coefficient):
+        self._remember(reaction)
+        reaction.objective_coefficient = coefficient
+
+    def set_stoichiometry(self, reaction, metabolites):
+        """
+        replace the metabolites of a reaction
+
+        :param metabolites: dict of coefficient by metabolite of the model
+        """
+
+        if reaction.id not in self._stoichiometry_journal:
+            self._stoichiometry_journal[reaction.id] = (reaction, dict(reaction._metabolites))
+        for m in reaction._metabolites:
+            m._reaction.discard(reaction)
+        reaction._metabolites = {}
+        reaction.add_metabolites(metabolites)
+
+    def add_metabolites(self, metabolites):
+        """add metabolites unknown to the model"""
+
+        self.model.add_metabolites(metabolites)
+        self._added_metabolites.extend(metabolites)
+
+    def add_reaction(self, reaction):
+        self.add_metabolites([m for m in reaction._metabolites if m.id not in self.model.metabolites])
+        self.model.add_reaction(reaction)
+        self._added.append(reaction)
+
+    def optimize(self, **kwargs):
+        return self.model.optimize(**kwargs)
+
+    def restore(self):
+        # added last, removed first: the model keeps its original order
+        for reaction in reversed(self._added):
+            reaction.remove_from_model()
+        del self._added[:]
+
+        for reaction, metabolites in reversed(self._stoichiometry_journal.values()):
+            for m in reaction._metabolites:
+                m._reaction.discard(reaction)
+            reaction._metabolites = metabolites
+            for m in metabolites:
+                m._reaction.add(reaction)
+        self._stoichiometry_journal.clear()
+
+        for m in reversed(self._added_metabolites):
+            self.model.metabolites.remove(m)
+            m._model = None
+        del self._added_metabolites[:]
+
+        for reaction, lb, ub, coefficient in reversed(self._journal.values()):
+            reaction.lower_bound = lb
+            reaction.upper_bound = ub
+            reaction.objective_coefficient = coefficient
+        self._journal.clear()
+        # `optimize` keeps the last solution on the model
+        self.model.solution = None
+
+
+class CachedModel(object):
+    """Cache entry: the model plus what is derived from it"""
+
+    def __init__(self, model):
+        self.model = model
+        self.size = estimate_model_size(model)
+        self.lock = threading.RLock()
+        self._reactions_by_name = None
+
+    @property
+    def reactions_by_name(self):
+        if self._reactions_by_name is None:
+            self._reactions_by_name = index_reactions_by_name(self.model)
+        return self._reactions_by_name
+
+
+class ModelCache(object):
+    """
+    Per worker cache of deserialized cobra models keyed by biomodel id
+    and content version, evicted in LRU order once the memory budget
+    (`MODEL_CACHE_MAX_BYTES`) is exceeded.
+    """
+
+    def __init__(self, app=None):
+        self._cache = LRUCache(0, sizeof=lambda entry: entry.size)
+        # memory mapped, they mostly cost page cache
+        self._arrays = LRUCache(64)
+        self._layouts = LRUCache(64)
+        self._currency_masks = LRUCache(64)
+        self._kegg_indexes = LRUCache(64)
+        self._lock = threading.Lock()
+        self.arrays_dir = None
+        self.layout_iterations = 50
+        self.layout_seed = 0
+        self.currency_params = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MODEL_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        app.config.setdefault('MODEL_ARRAYS_DIR', os.path.join(app.root_path, os.pardir, 'model_arrays'))
+        self._cache.max_size = app.config['MODEL_CACHE_MAX_BYTES']
+        self.arrays_dir = app.config['MODEL_ARRAYS_DIR']
+        app.config.setdefault('LAYOUT_ITERATIONS', self.layout_iterations)
+        app.config.setdefault('LAYOUT_SEED', self.layout_seed)
+        self.layout_iterations = app.config['LAYOUT_ITERATIONS']
+        self.layout_seed = app.config['LAYOUT_SEED']
+        app.config.setdefault('CURRENCY_MIN_DEGREE', 30)
+        app.config.setdefault('CURRENCY_DEGREE_FACTOR', 10.)
+        app.config.setdefault('CURRENCY_PAIR_FRACTION', 0.8)
+        app.config.setdefault('CURRENCY_METABOLITES', None)
+        app.config.setdefault('CURRENCY_EXCLUDED', ())
+        self.currency_params = currency.config_params(app.config)
+
+    def _get_entry(self, biomodel):
+        key = biomodel.cache_key()
+        if key is None:
+            return None
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry
+
+        # loading is slow, avoid doing it twice for the same model
+        with self._lock:
+            # loaded meanwhile by another thread, the miss was counted
+            entry = self._cache.get(key, count=False)
+            if entry is not None:
+                return entry
+            model = biomodel.load_cobra_model()
+            if model is None:
+                return None
+            entry = CachedModel(model)
+            return self._cache.set(key, entry)
+
+    def get(self, biomodel):
+        """return the shared model, it must not be modified"""
+
+        entry = self._get_entry(biomodel)
+        return entry.model if entry is not None else None
+
+    @contextmanager
+    def checkout(self, biomodel):
+        """
+        yield a `ModelView` of the cached model, restored on exit.
+        Views on the same model are serialized.
+        """
+
+        entry = self._get_entry(biomodel)
+        if entry is None:
+            yield None
+            return
+        with entry.lock:
+            view = ModelView(entry.model, entry.reactions_by_name)
+            try:
+                yield view
+            finally:
+                view.restore()
+
+    def get_arrays(self, biomodel):
+        """
+        `kepavi.stoichiometry.ModelArrays` of the biomodel, written on
+        first use when ingestion did not do it
+        """
+
+        key = biomodel.cache_key()
+        if key is None:
+            return None
+        arrays = self._arrays.get(key)
+        if arrays is not None:
+            return arrays
+
+        path = arrays_path(self.arrays_dir, key[1], key[2])
+        if not ModelArrays.exists(path):
+            built = biomodel.build_model_arrays()
+            if built is None:
+                return None
+            built.save(path)
+        return self._arrays.set(key, ModelArrays.load(path))
+
+    def get_layout(self, biomodel, compute=True):
+        """
+        positions of the whole model graph by metabolite index, see
+        `kepavi.cobra_utils.genome_scale_layout`, computed and written
+        next to the arrays on first use when ingestion did not do it
+
+        :param compute: when False, None unless the layout was written
+        """
+
+        from kepavi.cobra_utils import genome_scale_layout
+
+        key = biomodel.cache_key()
+        if key is None:
+            return None
+        positions = self._layouts.get(key)
+        if positions is not None:
+            return positions
+
+        arrays = self.get_arrays(biomodel)
+        if arrays is None:
+            return None
+        path = layout.layout_path(arrays_path(self.arrays_dir, key[1], key[2]))
+        positions = load_array(path)
+        if positions is None:
+            if not compute:
+                return None
+            positions = genome_scale_layout(arrays, self.layout_iterations, self.layout_seed,
+                                            self.get_currency_mask(biomodel))
+            save_array(path, positions)
+        return self._layouts.set(key, positions)
+
+    def get_currency_mask(self, biomodel):
+        """
+        currency metabolites of the biomodel by metabolite index, see
+        `kepavi.currency.currency_mask`, computed and written next to
+        the arrays on first use when ingestion did not do it
+        """
+
+        key = biomodel.cache_key()
+        if key is None:
+            return None
+        mask = self._currency_masks.get(key)
+        if mask is not None:
+            return mask
+
+        arrays = self.get_arrays(biomodel)
+        if arrays is None:
+            return None
+        path = currency.currency_path(arrays_path(self.arrays_dir, key[1], key[2]))
+        mask = load_array(path)
+        if mask is None:
+            mask = currency.currency_mask(arrays, **self.currency_params)
+            save_array(path, mask)
+        return self._currency_masks.set(key, mask)
+
+    def get_kegg_index(self, biomodel):
+        """`kepavi.biomodels.KeggIndex` of the biomodel"""
+
+        key = biomodel.cache_key()
+        if key is None:
+            return None
+        index = self._kegg_indexes.get(key)
+        if index is None:
+            index = biomodel.load_kegg_index()
+            if index is not None:
+                self._kegg_indexes.set(key, index)
+        return index
+
+    def invalidate(self, biomodel):
+        key = biomodel.cache_key()
+        if key is not None:
+            self._cache.pop(key)
+            self._arrays.pop(key)
+            self._layouts.pop(key)
+            self._currency_masks.pop(key)
+            self._kegg_indexes.pop(key)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class SolutionCache(object):
+    """
+    Content addressed index of stored FBA results: hash of the
+    normalized inputs -> (results url, status). A bounded local index
+    sits in front of the `Analysis.results_hash` lookup. Analyses are
+    solved by the job workers, the index is only filled by lookups.
+    """
+
+    def __init__(self, app=None):
+        self._index = LRUCache(1024)
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SOLUTION_CACHE_MAX_ENTRIES', 1024)
+        self._index.max_size = app.config['SOLUTION_CACHE_MAX_ENTRIES']
+
+    def lookup(self, key):
+        """
+        :return: (results url, status) of an analysis already solved
+                 with the same inputs or None
+        """
+
+        from kepavi.user.models import Analysis
+
+        entry = self._index.get(key)
+        if entry is None:
+            a = Analysis.query.filter(Analysis.results_hash == key,
+                                      Analysis.results_url != None).first()  # noqa
+            if a is not None:
+                entry = self._index.set(key, (a.results_url, a.results_content))
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        logging.debug('solution cache: {}'.format(self.stats()))
+        return entry
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self._index),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.}
+
+
+class ResultsCache(object):
+    """
+    Read-through cache of analysis results, stored results never change.
+    Parsed results are kept by each worker (`RESULTS_CACHE_MAX_ENTRIES`),
+    downloaded files are shared by the workers in `RESULTS_CACHE_DIR`,
+    least recently used files being removed once they exceed
+    `RESULTS_CACHE_MAX_BYTES`.
+    """
+
+    def __init__(self, app=None):
+        self._cache = LRUCache(32)
+        self.directory = None
+        self.max_bytes = 0
+        self.downloads = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESULTS_CACHE_MAX_ENTRIES', 32)
+        app.config.setdefault('RESULTS_CACHE_DIR', os.path.join(app.root_path, os.pardir, 'results_cache'))
+        app.config.setdefault('RESULTS_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+        self._cache.max_size = app.config['RESULTS_CACHE_MAX_ENTRIES']
+        self.directory = app.config['RESULTS_CACHE_DIR']
+        self.max_bytes = app.config['RESULTS_CACHE_MAX_BYTES']
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key, fetch):
+        """
+        :param key: results url
+        :param fetch: function downloading the results bytes, None on failure
+        :return: `kepavi.results.Results` (or dict for json results), None
+                 when they could not be fetched
+        """
+
+        results = self._cache.get(key)
+        if results is not None:
+            return results
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            data = fetch()
+            if data is None:
+                return None
+            self.downloads += 1
+            self._write(path, data)
+        else:
+            # modification time orders the eviction
+            os.utime(path, None)
+        return self._cache.set(key, open_results(path))
+
+    def _write(self, path, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # workers may download the same results
+        with atomic_write(path) as f:
+            f.write(data)
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for name in os.listdir(self.directory):
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, __ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            # memory mapped files stay readable until unmapped
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats['downloads'] = self.downloads
+        return stats
+
+
+class TopologyCache(object):
+    """
+    `kepavi.topology.Topology` of the graphs drawn for each (model
+    content, pathway), kept by each worker up to
+    `TOPOLOGY_CACHE_MAX_ENTRIES`. Topologies do not depend on analyses.
+    Those drawn while their layout is computed (`stats['layout']` is
+    'pending') are not kept.
+    """
+
+    def __init__(self, app=None):
+        self._cache = LRUCache(64)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TOPOLOGY_CACHE_MAX_ENTRIES', 64)
+        self._cache.max_size = app.config['TOPOLOGY_CACHE_MAX_ENTRIES']
+
+    def get(self, biomodel, pathway_id, build):
+        """
+        :param pathway_id: kegg pathway id, 'whole' for the whole model
+        :param build: function building the topology, None on failure
+        :return: topology, None if it could not be built
+        """
+
+        key = biomodel.cache_key()
+        if key is None:
+            return None
+        key += (pathway_id,)
+        topology = self._cache.get(key)
+        if topology is None:
+            topology = build()
+            if topology is not None and topology.stats.get('layout') != 'pending':
+                self._cache.set(key, topology)
+        return topology
+
+    def stats(self):
+        return {'entries': len(self._cache),
+                'hits': self._cache.hits,
+                'misses': self._cache.misses}
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.clients
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Network clients shared by a process: a pooled keep-alive `requests`
+    session retrying idempotent calls with exponential backoff, and a
+    boto S3 connection to the configured bucket. Both are created lazily
+    per process (and per thread for boto) and time every call by
+    endpoint, see `stats`. The stats of every endpoint are logged each
+    `CLIENT_STATS_LOG_INTERVAL` calls.
+
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from io import BytesIO
+
+import boto
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from kepavi.private_keys import S3_KEY, S3_BUCKET, S3_SECRET, S3_UPLOAD_DIRECTORY
+except ImportError:
+    S3_UPLOAD_DIRECTORY, S3_SECRET, S3_BUCKET, S3_KEY = '', '', '', ''
+
+
+class LatencyStats(object):
+    """
+    calls, errors and cumulated seconds by endpoint
+
+    :param name: name of the client in the logs
+    :param log_interval: calls between two logs of the stats, never
+                         logged when 0
+    """
+
+    def __init__(self, name, log_interval=100):
+        self.name = name
+        self.log_interval = log_interval
+        self._calls = 0
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'calls': 0, 'errors': 0, 'seconds': 0., 'max_seconds': 0.})
+
+    @contextmanager
+    def timed(self, endpoint):
+        start = time.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                s = self._stats[endpoint]
+                s['calls'] += 1
+                s['errors'] += failed
+                s['seconds'] += elapsed
+                s['max_seconds'] = max(s['max_seconds'], elapsed)
+                self._calls += 1
+                log = self.log_interval and self._calls % self.log_interval == 0
+            if failed:
+                logging.warn('{} call to {} failed after {:.3f}s'.format(self.name, endpoint, elapsed))
+            if log:
+                self.log()
+
+    def stats(self):
+        with self._lock:
+            return dict((endpoint, dict(s, mean_seconds=s['seconds'] / s['calls'] if s['calls'] else 0.))
+                        for endpoint, s in self._stats.items())
+
+    def log(self):
+        for endpoint, s in sorted(self.stats().items()):
+            logging.info('{} {}: {calls} calls, {errors} errors, {mean_seconds:.3f}s mean, '
+                         '{max_seconds:.3f}s max'.format(self.name, endpoint, **s))
+
+
+def _endpoint(url):
+    """host and first path segment, e.g. rest.kegg.jp/list"""
+
+    path = url.split('://', 1)[-1].split('?', 1)[0]
+    return '/'.join(path.split('/')[:2])
+
+
+# answers worth asking again
+_RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+
+class HttpClient(object):
+    """
+    `HTTP_TIMEOUT` (connect, read) seconds, `HTTP_RETRIES` retries of
+    connection errors, timeouts and 5xx answers spaced by
+    `HTTP_BACKOFF_FACTOR` * 2 ** retry seconds, `HTTP_POOL_SIZE` kept
+    alive connections by host.
+
+    Retries are made here: the adapter of the pinned requests version
+    only takes a number of connection retries.
+    """
+
+    def __init__(self, app=None):
+        self.timeout = (3.05, 30)
+        self.retries = 3
+        self.backoff_factor = 0.3
+        self.pool_size = 10
+        self.latency = LatencyStats('http')
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('HTTP_TIMEOUT', self.timeout)
+        app.config.setdefault('HTTP_RETRIES', self.retries)
+        app.config.setdefault('HTTP_BACKOFF_FACTOR', self.backoff_factor)
+        app.config.setdefault('HTTP_POOL_SIZE', self.pool_size)
+        app.config.setdefault('CLIENT_STATS_LOG_INTERVAL', self.latency.log_interval)
+        self.timeout = tuple(app.config['HTTP_TIMEOUT'])
+        self.retries = app.config['HTTP_RETRIES']
+        self.backoff_factor = app.config['HTTP_BACKOFF_FACTOR']
+        self.pool_size = app.config['HTTP_POOL_SIZE']
+        self.latency.log_interval = app.config['CLIENT_STATS_LOG_INTERVAL']
+
+    @property
+    def session(self):
+        # sockets can not be shared with a forked process
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                      pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session, self._pid = session, os.getpid()
+            return self._session
+
+    def get(self, url, endpoint=None, **kwargs):
+        """
+        `requests.get` through the pooled session, the last answer is
+        returned when every try got a 5xx one
+
+        :param endpoint: name of the latency counter, host and first
+                         path segment of the url by default
+        :raise requests.RequestException: once retries are exhausted
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = endpoint or _endpoint(url)
+        for retry in range(self.retries + 1):
+            if retry:
+                time.sleep(self.backoff_factor * 2 ** (retry - 1))
+            try:
+                with self.latency.timed(endpoint):
+                    resp = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if retry == self.retries:
+                    raise
+                continue
+            if resp.status_code not in _RETRY_STATUSES or retry == self.retries:
+                return resp
+            # give the connection back to the pool
+            resp.close()
+
+    def stats(self):
+        return self.latency.stats()
+
+
+class S3Client(object):
+    """
+    boto connection to `S3_BUCKET`, credentials and bucket being read
+    from the environment first then from `kepavi.private_keys`. Uploads
+    larger than `S3_MULTIPART_THRESHOLD` bytes are sent in parts of
+    `S3_MULTIPART_CHUNK_SIZE` bytes.
+    """
+
+    def __init__(self, app=None):
+        self.multipart_threshold = 16 * 1024 * 1024
+        self.multipart_chunk_size = 8 * 1024 * 1024
+        self.latency = LatencyStats('s3')
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('S3_MULTIPART_THRESHOLD', self.multipart_threshold)
+        app.config.setdefault('S3_MULTIPART_CHUNK_SIZE', self.multipart_chunk_size)
+        app.config.setdefault('CLIENT_STATS_LOG_INTERVAL', self.latency.log_interval)
+        self.latency.log_interval = app.config['CLIENT_STATS_LOG_INTERVAL']
+        self.multipart_threshold = app.config['S3_MULTIPART_THRESHOLD']
+        # s3 refuses parts smaller than 5MB but the last one
+        self.multipart_chunk_size = max(app.config['S3_MULTIPART_CHUNK_SIZE'], 5 * 1024 * 1024)
+
+    @property
+    def upload_directory(self):
+        return os.environ.get('S3_UPLOAD_DIRECTORY') or S3_UPLOAD_DIRECTORY
+
+    @property
+    def bucket(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            with self.latency.timed('s3:connect'):
+                conn = boto.connect_s3(os.environ.get('S3_KEY') or S3_KEY, os.environ.get('S3_SECRET') or S3_SECRET)
+                # no request listing the bucket to validate it
+                local.bucket = conn.get_bucket(os.environ.get('S3_BUCKET') or S3_BUCKET, validate=False)
+            local.pid = os.getpid()
+        return local.bucket
+
+    def new_key(self, destination_filename):
+        """key of a file of the upload directory"""
+
+        return self.bucket.new_key('/'.join([self.upload_directory, destination_filename]))
+
+    def upload_fileobj(self, fp, destination_filename, acl='public-read'):
+        """
+        upload from the current position to the end of a seekable file
+        object, as a multipart upload above `S3_MULTIPART_THRESHOLD` bytes
+        """
+
+        start = fp.tell()
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell() - start
+        fp.seek(start)
+
+        key = self.new_key(destination_filename)
+        if size <= self.multipart_threshold:
+            with self.latency.timed('s3:put'):
+                key.set_contents_from_file(fp, policy=acl, size=size)
+            return key
+
+        with self.latency.timed('s3:multipart'):
+            upload = self.bucket.initiate_multipart_upload(key.name, policy=acl)
+            try:
+                for part, offset in enumerate(range(0, size, self.multipart_chunk_size), 1):
+                    upload.upload_part_from_file(fp, part, size=min(self.multipart_chunk_size, size - offset))
+                upload.complete_upload()
+            except Exception:
+                # uploaded parts are billed until the upload is cancelled
+                upload.cancel_upload()
+                raise
+        return key
+
+    def upload_string(self, data, destination_filename, acl='public-read'):
+        return self.upload_fileobj(BytesIO(data), destination_filename, acl)
+
+    def upload_file(self, source_file, destination_filename, acl='public-read'):
+        with open(source_file, 'rb') as fp:
+            return self.upload_fileobj(fp, destination_filename, acl)
+
+    def delete(self, key):
+        with self.latency.timed('s3:delete'):
+            return self.bucket.delete_key(key)
+
+    def stats(self):
+        return self.latency.stats()
+
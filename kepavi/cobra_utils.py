@@ -1,54 +1,24 @@
+import hashlib
+import json
 import logging
 import cobra
+from kepavi.extensions import http_client
 from kepavi.kegg_utils import Kegg
-import requests
-import os
 from collections import defaultdict
+from requests import RequestException
 import random
+import tempfile
+import numpy as np
+from kepavi.results import Results
+from kepavi.topology import Topology
+from kepavi import layout
+from kepavi.currency import UNDESIRABLES
 from kepavi.user.models import KeggReaction
 
 # Sigma js has my preference since it can handle
 # larger graph
 GRAPH_LIBRARY_BACKEND = {'cytoscape', 'sigma'}
 
-# this metabolites are involved in too much reactions
-# and make the visualization too complicated
-UNDESIRABLES = {'H',
-                'H+',
-                'H(+)',
-                'NH4(+)',
-                'NADH(2-)',
-                'NAD(+)',
-                'NADP(+)',
-                'NADPH',
-                'diphosphate(3-)',
-                'CO(2)',
-                'holo-[acyl-carrier\nprotein]',
-                'HOLO-[ACYL-CARRIER\nPROTEIN]',
-                'Cl(-)',
-                'Fe(2+)',
-                'IDP',  # known has intrinsically disordred protein
-                # 'acetyl-CoA(4-)',
-                'CoA',
-                'GTP',
-                'UTP(3-)',
-                'CTP(3-)',
-                'dioxygen',
-                'AMP',
-                'H2O',
-                'ADP',
-                'ATP',
-                'Diphosphate',
-                'Phosphate',
-                'phosphate',
-                'UDP',
-                'Coenzyme-A',
-                'Nicotinamide-adenine-dinucleotide',
-                'Nicotinamide-adenine-dinucleotide-phosphate',
-                'Nicotinamide-adenine-dinucleotide--reduced',
-                'Ammonium',
-                'CO2'}
-
 
 def get_sbml_from_s3(url):
     """
@@ -58,24 +28,54 @@ def get_sbml_from_s3(url):
     :return: cobra model object could be None
     """
 
-    resp = requests.get(url)
-    if resp.status_code != 200:
-        return None
-    name = 'sbml.xml'
-    # with tempfile.NamedTemporaryFile(delete=False) as f:
-    with open(name, 'w') as f:
-        f.write(resp.text.encode('utf-8'))
+    # libsbml reads from a path, a file of its own per call
+    with tempfile.NamedTemporaryFile(suffix='.xml') as f:
+        try:
+            resp = http_client.get(url, endpoint='s3:get', stream=True)
+            if resp.status_code != 200:
+                return None
+            for chunk in resp.iter_content(64 * 1024):
+                f.write(chunk)
+        except RequestException:
+            return None
+        f.flush()
+
+        try:
+            return cobra.io.read_sbml_model(f.name)
+        except Exception:
+            return None
+
+
+def _warn_unresolved(missing, duplicated):
+    if missing:
+        logging.warn('{} reactions not found: {}'.format(len(missing), ', '.join(missing)))
+    if duplicated:
+        logging.warn('{} ambiguous reaction names, first match used: {}'.format(len(duplicated),
+                                                                               ', '.join(duplicated)))
 
-    sbml_model = None
-    try:
-        sbml_model = cobra.io.read_sbml_model(name)
-    except Exception:
-        pass
 
-    # remove file
-    os.remove(name)
+def _apply_fba_parameters(model, objectives, user_params):
+    """
+    set objectives and user bounds on the model view, see `_launch_fba`
+    """
 
-    return sbml_model
+    objective_names = [str(obj['name']) for obj in objectives]
+    constraint_names = [str(params['name']) for params in user_params]
+
+    # one lookup in the name index of the cached model for each name
+    reactions, missing, duplicated = model.resolve_reactions(objective_names + constraint_names)
+    _warn_unresolved(missing, duplicated)
+
+    # update objective functions
+    for name in objective_names:
+        if name in reactions:
+            model.set_objective(reactions[name], 1.0)
+
+    # update constraints
+    for name, params in zip(constraint_names, user_params):
+        if name in reactions:
+            # Updating bounds
+            model.set_bounds(reactions[name], params['lower_bound'], params['upper_bound'])
 
 
 def _launch_fba(model, objectives, user_params, optimize_sense='maximize'):
@@ -83,7 +83,8 @@ def _launch_fba(model, objectives, user_params, optimize_sense='maximize'):
     Will flux balance analysis calling `model.optimize`
     Got unicode instead of string
 
-    :param model: cobrapy model
+    :param model: `kepavi.caching.ModelView` of a cobrapy model, changes
+                  are reverted when the view is released
     :param objectives: reactions list representing objectives function
     :param user_params: list of dict reactions bounds that has been changed
                         by user
@@ -91,33 +92,203 @@ def _launch_fba(model, objectives, user_params, optimize_sense='maximize'):
 
     """
 
-    def get_reac_by_name(name):
+    _apply_fba_parameters(model, objectives, user_params)
 
-        reacts = model.reactions.query(lambda x: True if x == name else False, 'name')
-        try:
-            return reacts[0]
-        except IndexError:
-            logging.warn('reaction not found: {}'.format(name))
-            return None
-    # end function
+    # start computing a solution
+    solution = model.optimize(objective_sense=optimize_sense)
+    return solution
 
-    # update objective functions
-    for obj in objectives:
-        react = get_reac_by_name(str(obj['name']))
-        if react is not None:
-            react.objective_coefficient = 1.0
 
-    # update constraints
+def fba_inputs_hash(model_key, solver, objectives, user_params, optimize_sense='maximize'):
+    """
+    hash identifying the solution of `_launch_fba`: objective order
+    does not matter and the last bounds given for a reaction win.
+
+    :param model_key: `Biomodel.cache_key`, changes with the model content
+    :param solver: `FBA_SOLVER` backend name, degenerate problems have
+                   several optimal flux vectors and backends may return
+                   different ones
+    """
+
+    bounds = {}
     for params in user_params:
-        react = get_reac_by_name(str(params['name']))
-        if react is not None:
-            # Updating bounds
-            react.lower_bound = params['lower_bound']
-            react.upper_bound = params['upper_bound']
+        bounds[params['name']] = (float(params['lower_bound']), float(params['upper_bound']))
+
+    normalized = {'model': list(model_key),
+                  'solver': solver,
+                  'objectives': sorted(set(obj['name'] for obj in objectives)),
+                  'constraints': sorted([name, lb, ub] for name, (lb, ub) in bounds.items()),
+                  'optimize_sense': optimize_sense}
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
 
-    # start computing a solution
-    solution = model.optimize(objective_sense=optimize_sense)
-    return solution
+
+def reactions_hash(reaction_ids):
+    """
+    hash of the reaction order: chunk jobs address reactions by their
+    index in the model arrays, the solver problem must follow it
+    """
+
+    return hashlib.sha1(json.dumps(list(reaction_ids)).encode('utf-8')).hexdigest()
+
+
+def _launch_fba_batch(model, scenarios):
+    """
+    Flux balance analysis of several scenarios on the same model. A
+    single solver problem is kept alive: only bounds and objective
+    coefficients differing from the previous scenario are changed and
+    the solver restarts from the previous basis.
+
+    :param model: `kepavi.caching.ModelView` of a cobrapy model, left
+                  untouched
+    :param scenarios: list of dict with `objective_functions`,
+                      `constraints` and optionally `optimize_sense`,
+                      same meaning as the `_launch_fba` parameters
+    :return: generator of solution objects, one per scenario
+    """
+
+    from cobra.solvers import solver_dict, get_solver_name
+
+    cobra_model = model.model
+    solver = solver_dict[get_solver_name()]
+    lp = solver.create_problem(cobra_model)
+
+    names = set()
+    for scenario in scenarios:
+        names.update(str(obj['name']) for obj in scenario['objective_functions'])
+        names.update(str(params['name']) for params in scenario['constraints'])
+    reactions, missing, duplicated = model.resolve_reactions(sorted(names))
+    _warn_unresolved(missing, duplicated)
+
+    def model_values(i):
+        r = cobra_model.reactions[i]
+        return r.lower_bound, r.upper_bound, r.objective_coefficient
+
+    # reaction index -> (lower bound, upper bound, objective coefficient) set in lp
+    applied = {}
+    for scenario in scenarios:
+        wanted = {}
+        for obj in scenario['objective_functions']:
+            name = str(obj['name'])
+            if name in reactions:
+                i = cobra_model.reactions.index(reactions[name])
+                lb, ub, _ = wanted.get(i, model_values(i))
+                wanted[i] = (lb, ub, 1.0)
+        for params in scenario['constraints']:
+            name = str(params['name'])
+            if name in reactions:
+                i = cobra_model.reactions.index(reactions[name])
+                _, __, coefficient = wanted.get(i, model_values(i))
+                wanted[i] = (params['lower_bound'], params['upper_bound'], coefficient)
+
+        # reactions changed by the previous scenario only go back to the model values
+        for i in set(applied) | set(wanted):
+            old = applied.get(i) or model_values(i)
+            new = wanted.get(i) or model_values(i)
+            if old[:2] != new[:2]:
+                solver.change_variable_bounds(lp, i, new[0], new[1])
+            if old[2] != new[2]:
+                solver.change_variable_objective(lp, i, new[2])
+        applied = wanted
+
+        solver.solve_problem(lp, objective_sense=scenario.get('optimize_sense', 'maximize'))
+        yield solver.format_solution(lp, cobra_model)
+
+
+class LPProblem(object):
+    """
+    solver problem built from a model view once the FBA parameters are
+    applied, solved once so that following solves start from the
+    optimal basis. Built in the `kepavi.jobs.run_limited` child of each
+    chunk, the cached model is not modified.
+    """
+
+    def __init__(self, model, objectives, user_params, optimize_sense='maximize'):
+        from cobra.solvers import solver_dict, get_solver_name
+
+        # bounds and objectives of the view are copied by the solver
+        # and restored when the view is released
+        _apply_fba_parameters(model, objectives, user_params)
+
+        cobra_model = model.model
+        self.optimize_sense = optimize_sense
+        self.reaction_ids = [r.id for r in cobra_model.reactions]
+        self.bounds = [(r.lower_bound, r.upper_bound) for r in cobra_model.reactions]
+        self.solver = solver_dict[get_solver_name()]
+        self.lp = self.solver.create_problem(cobra_model)
+
+        self.solver.solve_problem(self.lp, objective_sense=optimize_sense)
+        self.fba_solution = self.solver.format_solution(self.lp, cobra_model)
+        if self.fba_solution.status != 'optimal':
+            raise ValueError('FBA problem is {}'.format(self.fba_solution.status))
+
+    def _optimum(self, objective_sense):
+        self.solver.solve_problem(self.lp, objective_sense=objective_sense)
+        if self.solver.get_status(self.lp) != 'optimal':
+            return None
+        return self.solver.get_objective_value(self.lp)
+
+
+class FVAProblem(LPProblem):
+    """
+    flux variability analysis: the objective reactions are constrained
+    to their FBA optimum (times `fraction_of_optimum`) and the objective
+    cleared, ready to be minimized and maximized for each reaction.
+    """
+
+    def __init__(self, model, objectives, user_params, fraction_of_optimum=1.,
+                 optimize_sense='maximize'):
+        super(FVAProblem, self).__init__(model, objectives, user_params, optimize_sense)
+
+        x_dict = self.fba_solution.x_dict
+        for i, r in enumerate(model.model.reactions):
+            if r.objective_coefficient != 0:
+                f = x_dict[r.id]
+                bounds = f * fraction_of_optimum, f
+                self.solver.change_variable_bounds(self.lp, i, min(bounds), max(bounds))
+                self.solver.change_variable_objective(self.lp, i, 0.)
+
+    def variability(self, indices):
+        """
+        :param indices: indices of the reactions to analyse
+        :return: dict of minimum and maximum flux by reaction id
+        """
+
+        minimum, maximum = {}, {}
+        for i in indices:
+            reaction_id = self.reaction_ids[i]
+            self.solver.change_variable_objective(self.lp, i, 1.)
+            maximum[reaction_id] = self._optimum('maximize')
+            minimum[reaction_id] = self._optimum('minimize')
+            self.solver.change_variable_objective(self.lp, i, 0.)
+        return {'minimum': minimum, 'maximum': maximum}
+
+
+class KnockoutProblem(LPProblem):
+    """
+    reaction deletions: bounds of the deleted reactions are set to zero
+    in place then restored, growth is given relative to the wild type.
+    """
+
+    def __init__(self, model, objectives, user_params, optimize_sense='maximize'):
+        super(KnockoutProblem, self).__init__(model, objectives, user_params, optimize_sense)
+        self.wild_type = self.fba_solution.f
+        if not self.wild_type:
+            raise ValueError('wild type objective value is zero')
+
+    def growth_ratio(self, indices):
+        for i in indices:
+            self.solver.change_variable_bounds(self.lp, i, 0., 0.)
+        value = self._optimum(self.optimize_sense)
+        for i in indices:
+            self.solver.change_variable_bounds(self.lp, i, *self.bounds[i])
+        # infeasible: no growth
+        return value / self.wild_type if value is not None else 0.
+
+    def single_deletions(self, indices):
+        return [self.growth_ratio((i,)) for i in indices]
+
+    def double_deletions(self, pairs):
+        return [self.growth_ratio((i, j)) for i, j in pairs]
 
 
 def _add_node(data,
@@ -267,147 +438,341 @@ def _build_genome_scale_network(model, results):
     return data
 
 
-def find_reactions(reactants_kegg_id, products_kegg_id, kegg_ids_by_reac_id):
-    matches = defaultdict(list)
-    for reaction_id, (reac_kegg_ids, prod_kegg_ids) in kegg_ids_by_reac_id.iteritems():
-        reac_intersect = reactants_kegg_id.intersection(reac_kegg_ids)
-        prod_intersect = products_kegg_id.intersection(prod_kegg_ids)
-        if reac_intersect and prod_intersect:
-            matches[len(reac_intersect) + len(prod_intersect)].append(reaction_id)
-    if not matches:
-        return frozenset({})
-    max_match = max(matches.keys())
-    return frozenset(matches[max_match])
+def flux_vector(arrays, results):
+    """fluxes of `results` in the model arrays reactions order"""
+
+    n = arrays.n_reactions
+    if isinstance(results, Results) and 'x_dict' in results.arrays and \
+            results.reaction_ids[:n] == list(arrays.reaction_ids):
+        return np.asarray(results.array('x_dict')[:n], dtype=np.float64)
+    x_dict = results['x_dict']
+    return np.array([x_dict[r] for r in arrays.reaction_ids], dtype=np.float64)
 
 
-def build_kegg_network_mixed(pathway,
-                             kegg_model_name,
-                             sbml_model,
-                             results):
+def _legacy_currency(arrays):
+    """
+    name based masks of `_build_genome_scale_network`: reactants exclude
+    `UNDESIRABLES` and names starting with NAD, products `UNDESIRABLES`
+    only
     """
-    Build network using sbml_model, kegg model and results
-    We use the kegg_model to get the layout
-    Basically, this will be used when the user requests a graph
-    of a specific pathway.
 
+    names = arrays.metabolite_names
+    undesirable = np.array([name in UNDESIRABLES for name in names], dtype=bool)
+    nad = np.array([name.startswith('NAD') for name in names], dtype=bool)
+    return undesirable | nad, undesirable
+
+
+def _genome_scale_edges(arrays, currency=None):
+    """
+    reactant x product pairs of every reaction, read from the columns
+    of the stoichiometric matrix
+
+    Reactants (negative coefficients) and products (positive
+    coefficients) exclude the currency metabolites. Each pair also
+    carries the position of the reactant and of the product among the
+    kept ones of their reaction.
+
+    :param arrays: `kepavi.stoichiometry.ModelArrays`
+    :param currency: bool mask by metabolite index, see
+                     `kepavi.currency.currency_mask`, the names of
+                     `UNDESIRABLES` as `_build_genome_scale_network`
+                     does when None
+    :return: dict of equally long int arrays: `reaction`, `reactant`,
+             `product` (metabolite indices), `i` and `j` (positions)
+             and `entry` (reactant entry) of each pair, plus
+             `reactants`: reaction and metabolite of every reactant
+             entry, with or without products
     """
 
-    def get_kegg_id(element):
-        if "KEGG" in element.notes:
-            kegg_notes = element.notes["KEGG"][0].replace(" ", "").split(',')
-            kegg_ids = set(kegg_notes).difference({'0', 'NA'})
-            return kegg_ids  # if kegg_id not in ('0', 'NA') else ''
-        elif 'kegg.compound' in element.annotation:
-            kegg_id = element.annotation['kegg_compound']
-            return kegg_id if kegg_id not in ('0', 'NA') else ''
-        return ''
+    S = arrays.S_csc
+    n_reactions = arrays.n_reactions
+    if currency is None:
+        hidden_reactants, hidden_products = _legacy_currency(arrays)
+    else:
+        hidden_reactants = hidden_products = np.asarray(currency, dtype=bool)
 
-    def add_node_if_not_drawn(element_set, element, flux):
-        if element.id not in element_set:
-            n = element.name[4:]
-            name = met_name_by_kegg_id[n] if n in met_name_by_kegg_id else None
-            Kegg._add_node(data,
-                           element,
-                           int(flux),
-                           name=name,
-                           show_compound_img=None)
-            element_set.add(element.id)
+    metabolite = np.asarray(S.indices)
+    coefficient = np.asarray(S.data)
+    reaction = np.repeat(np.arange(n_reactions), np.diff(S.indptr))
 
-    def is_real_reaction(react):
-        return pathway.entries[react.id].type != 'ortholog'
+    is_reactant = (coefficient < 0) & ~hidden_reactants[metabolite]
+    is_product = (coefficient > 0) & ~hidden_products[metabolite]
+
+    # entries keep the column order: grouped by reaction
+    r_reaction, r_metabolite = reaction[is_reactant], metabolite[is_reactant]
+    p_reaction, p_metabolite = reaction[is_product], metabolite[is_product]
+
+    n_products = np.bincount(p_reaction, minlength=n_reactions)
+    p_start = np.cumsum(n_products) - n_products
+    r_counts = np.bincount(r_reaction, minlength=n_reactions)
+    r_position = np.arange(len(r_reaction)) - (np.cumsum(r_counts) - r_counts)[r_reaction]
+
+    # one edge per product of the reactant reaction
+    repeats = n_products[r_reaction]
+    edge_reactant = np.repeat(np.arange(len(r_reaction)), repeats)
+    j = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    edge_reaction = r_reaction[edge_reactant]
+
+    return {'reaction': edge_reaction,
+            'reactant': r_metabolite[edge_reactant],
+            'product': p_metabolite[p_start[edge_reaction] + j],
+            'i': r_position[edge_reactant],
+            'j': j,
+            'entry': edge_reactant,
+            'reactants': (r_reaction, r_metabolite)}
+
+
+def _first_occurrences(*columns):
+    """indices of the first occurrence of each distinct row of int columns, in order"""
+
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        # mixed radix: one int64 per row
+        key = key * (int(column.max()) + 1 if len(column) else 1) + column
+    _, first = np.unique(key, return_index=True)
+    return np.sort(first)
+
+
+def genome_scale_layout(arrays, iterations=50, seed=0, currency=None):
+    """
+    positions of the metabolites drawn by `genome_scale_topology`, see
+    `kepavi.layout.force_layout`
+
+    :param currency: bool mask of the metabolites left out, see
+                     `_genome_scale_edges`
 
-    reac_id_by_kegg_id = {}
+    :return: float64 array of shape (n_metabolites, 2), NaN for the
+             metabolites not drawn
+    """
+
+    edges = _genome_scale_edges(arrays, currency)
+    drawn = np.unique(np.concatenate((edges['reactants'][1], edges['product'])))
+    # one spring per distinct reactant, product pair
+    edge_pairs = np.unique(np.searchsorted(drawn, edges['reactant']) * len(drawn) +
+                           np.searchsorted(drawn, edges['product']))
+    sources, targets = edge_pairs // len(drawn), edge_pairs % len(drawn)
+
+    positions = np.full((arrays.n_metabolites, 2), np.nan)
+    positions[drawn] = layout.force_layout(len(drawn), sources, targets, iterations=iterations, seed=seed)
+    return positions
 
-    for reac in sbml_model.reactions:
-        reac_kegg_ids = get_kegg_id(reac)
-        for reac_kegg_id in reac_kegg_ids:
-            reac_id_by_kegg_id[reac_kegg_id] = reac.id
 
-    met_name_by_kegg_id = {}
-    for met in sbml_model.metabolites:
-        met_kegg_ids = get_kegg_id(met)
-        for met_kegg_id in met_kegg_ids:
-            met_name_by_kegg_id[met_kegg_id] = met.name
+def genome_scale_topology(arrays, positions=None, currency=None):
+    """
+    topology of the graph of `_build_genome_scale_network`, built from
+    the model arrays: edges come from masked operations on the
+    stoichiometric matrix, python objects are only created for the
+    nodes and edges.
+
+    A metabolite node takes the flux of the first reaction drawing it,
+    reactions being read in order and each reactant followed by the
+    products of its reaction. Edges go from reactant to product, the
+    other way when the flux is not positive.
+
+    :param arrays: `kepavi.stoichiometry.ModelArrays`
+    :param positions: `genome_scale_layout` output, random positions
+                      when None
+    :param currency: bool mask of the metabolites left out, see
+                     `_genome_scale_edges`
+    :return: `kepavi.topology.Topology`
+    """
+
+    edges = _genome_scale_edges(arrays, currency)
+    r_reaction, r_metabolite = edges['reactants']
+
+    # drawing order: every reactant then the products of its reaction
+    n_products = np.bincount(edges['entry'], minlength=len(r_reaction))
+    start = np.cumsum(n_products + 1) - (n_products + 1)
+    order_metabolite = np.empty(len(r_reaction) + len(edges['reaction']), dtype=np.intp)
+    order_reaction = np.empty_like(order_metabolite)
+    is_reactant = np.zeros(len(order_metabolite), dtype=bool)
+    is_reactant[start] = True
+    order_metabolite[is_reactant], order_reaction[is_reactant] = r_metabolite, r_reaction
+    order_metabolite[~is_reactant], order_reaction[~is_reactant] = edges['product'], edges['reaction']
+
+    first = _first_occurrences(order_metabolite)
+    node_reactions = order_reaction[first]
 
     data = {'nodes': [], 'edges': []}
+    names, ids = arrays.metabolite_names, arrays.metabolite_ids
+    for m in order_metabolite[first].tolist():
+        _add_node(data, ids[m], 'metabolite', names[m], 0., None, '#FFFFFF')
+    for node in data['nodes']:
+        del node['flux'], node['cumflux']
+    if positions is not None:
+        for node, (x, y) in zip(data['nodes'], np.asarray(positions)[order_metabolite[first]].tolist()):
+            node['x'], node['y'] = x, y
+
+    kept = _first_occurrences(edges['reactant'], edges['product'], edges['i'], edges['j'])
+    edge_reactions = edges['reaction'][kept]
+    reversible = ((arrays.lower_bounds < 0) & (arrays.upper_bounds > 0))[edge_reactions]
+    data['edges'] = [{'id': '{}-{}-{}-{}'.format(ids[m1], ids[m2], i, j),
+                      'label': '',
+                      'source': ids[m1],
+                      'target': ids[m2],
+                      'size': 1,
+                      'reversible': rev}
+                     for m1, m2, i, j, rev in zip(edges['reactant'][kept].tolist(), edges['product'][kept].tolist(),
+                                                  edges['i'][kept].tolist(), edges['j'][kept].tolist(),
+                                                  reversible.tolist())]
+
+    # a node cumulates the flux of its first reaction only
+    return Topology(data['nodes'], data['edges'], node_reactions, edge_reactions,
+                    np.arange(len(first)), node_reactions,
+                    reverse_unless_positive=True)
+
+
+def build_genome_scale_network(arrays, results):
+    """
+    same graph as `_build_genome_scale_network`, see `genome_scale_topology`
 
-    metabolites_id = set()
-    fluxes_by_metabolites_ids = defaultdict(int)
+    :param arrays: `kepavi.stoichiometry.ModelArrays`
+    :param results: FBA results, dict or `kepavi.results.Results`
+    """
 
-    for reaction in pathway.reactions:
-        if not is_real_reaction(reaction):
-            continue
+    return genome_scale_topology(arrays).render(flux_vector(arrays, results))
 
-        # skip rn: from the beginning, correspond to the kegg_id of the reaction
-        full_reac_name = reaction.name.split()[0]
-        reac_name = full_reac_name[3:]  # if reaction.name.startswith('rn:') else reaction.name
 
-        reac_label = _get_react_name_by_kegg_react_id(full_reac_name)
+def find_reactions(reactants_kegg_id, products_kegg_id, compound_index):
+    """
+    reactions sharing the most compounds with a reaction given by its
+    KEGG compound ids, at least a reactant and a product
+
+    :param compound_index: `kepavi.biomodels.CompoundIndex` of the model
+    :return: frozenset of reaction indices, see `CompoundIndex.match` to
+             match several reactions in one call
+    """
+
+    return compound_index.match([(reactants_kegg_id, products_kegg_id)])[0]
 
-        # substrate_kegg_ids = {substrate.name[4:] for substrate in reaction.substrates}
-        # product_kegg_ids = {product.name[4:] for product in reaction.products}
 
-        matching_reaction = None
-        if reac_name in reac_id_by_kegg_id:
-            matching_reaction = reac_id_by_kegg_id[reac_name]
-        else:
-            logging.warn("no matching sbml reaction for reaction kegg ID: {}".format(reac_name))
+def kegg_pathway_topology(pathway, arrays, kegg_index, fuzzy=True):
+    """
+    Topology of a KEGG pathway drawn with the model fluxes.
+    We use the kegg pathway to get the layout, reactions and compounds
+    are matched to the model ones through the KEGG ids index of the
+    model. Basically, this will be used when the user requests a graph
+    of a specific pathway.
+
+    :param pathway: KGML pathway
+    :param arrays: `kepavi.stoichiometry.ModelArrays`
+    :param kegg_index: `kepavi.biomodels.KeggIndex` of the same model
+    :param fuzzy: reactions whose KEGG id is not in the model are
+                  matched by their compounds, when a single model
+                  reaction matches best (see `find_reactions`)
+    :return: `kepavi.topology.Topology`
+    """
+
+    # entry id -> node index
+    node_index = {}
 
-        # matching_reactions = find_reactions(substrate_kegg_ids, product_kegg_ids, reac_id_by_kegg_id)
-        # flux = results['x_dict'][list(matching_reactions)[0]] if len(matching_reactions) == 1 else 0
+    def add_node_if_not_drawn(element, reaction):
+        if element.id not in node_index:
+            m = kegg_index.metabolite(element.name[4:])
+            name = arrays.metabolite_names[m] if m is not None else None
+            Kegg._add_node(data,
+                           element,
+                           0,
+                           name=name,
+                           show_compound_img=None)
+            node = data['nodes'][-1]
+            del node['flux'], node['cumflux']
+            node_index[element.id] = len(node_reactions)
+            node_reactions.append(reaction)
+        # count total flux for each nodes
+        cumflux_nodes.append(node_index[element.id])
+        cumflux_reactions.append(reaction)
 
-        flux = results['x_dict'][matching_reaction] if matching_reaction is not None else 0
+    def is_real_reaction(react):
+        return pathway.entries[react.id].type != 'ortholog'
+
+    reversible = (arrays.lower_bounds < 0) & (arrays.upper_bounds > 0)
+
+    data = {'nodes': [], 'edges': []}
+    node_reactions, edge_reactions = [], []
+    cumflux_nodes, cumflux_reactions = [], []
+    # kegg reaction ids of the pathway -> found in the model
+    matched = {}
+
+    reactions = [r for r in pathway.reactions if is_real_reaction(r)]
+    # skip rn: from the beginning, correspond to the kegg_id of the reaction
+    full_reac_names = [r.name.split()[0] for r in reactions]
+    indices = [kegg_index.reaction(name[3:]) for name in full_reac_names]
+
+    # every reaction missing from the model is matched in one call
+    fuzzy_matches = {}
+    if fuzzy:
+        missing = [k for k, index in enumerate(indices) if index is None]
+        queries = [({substrate.name[4:] for substrate in reactions[k].substrates},
+                    {product.name[4:] for product in reactions[k].products}) for k in missing]
+        for k, found in zip(missing, kegg_index.compounds(arrays.S).match(queries)):
+            if len(found) == 1:
+                indices[k], = found
+                fuzzy_matches[full_reac_names[k][3:]] = indices[k]
+
+    for reaction, full_reac_name, index in zip(reactions, full_reac_names, indices):
+        reac_name = full_reac_name[3:]  # if reaction.name.startswith('rn:') else reaction.name
+
+        reac_label = _get_react_name_by_kegg_react_id(full_reac_name)
 
-        sbml_reaction = None
-        if matching_reaction is not None:
-            sbml_reaction = sbml_model.reactions.get_by_id(matching_reaction)
+        matched[reac_name] = index is not None
+        if index is None:
+            index = -1
 
         for _, reactant in enumerate(reaction.substrates):
             if reactant.name in UNDESIRABLES:
                 continue
             # add not if does not exist yet
-            fluxes_by_metabolites_ids[reactant.id] += abs(flux)
-            add_node_if_not_drawn(metabolites_id, reactant, flux)
+            add_node_if_not_drawn(reactant, index)
 
-            # reac_id = id_by_name[reactant.name]  # if reactant.id
             for __, product in enumerate(reaction.products):
                 if product.name in UNDESIRABLES:
                     continue
-                fluxes_by_metabolites_ids[product.id] += abs(flux)
-                add_node_if_not_drawn(metabolites_id, product, flux)
+                add_node_if_not_drawn(product, index)
 
-                # product_id = id_by_name[product.name]  # product.id
-                arrow_src = reaction.type == 'reversible'
                 edge_id = '-'.join([str(reactant.id),
                                     str(product.id), str(_), str(__)])
-
-                _add_edge(data,
-                          sbml_reaction,
-                          edge_id,
-                          reactant.id,
-                          product.id,
-                          flux,
-                          kegg_reac_id=reac_label,
-                          arrow_src=arrow_src)
-
-    # count total flux for each nodes
-    nodes = data['nodes']
-    for n in nodes:
-        n_id = n['id']
-        n['cumflux'] = int(fluxes_by_metabolites_ids[n_id])
-    return data
-
-
-def build_cobra_network(sbml_model, results):
+                data['edges'].append({'id': edge_id,
+                                      'label': reac_label,
+                                      'source': reactant.id,
+                                      'target': product.id,
+                                      'size': 1,
+                                      'reversible': bool(reversible[index]) if index >= 0 else False})
+                edge_reactions.append(index)
+
+    missing = sorted(k for k, found in matched.items() if not found)
+    if missing:
+        logging.debug('{}: no matching sbml reaction for kegg IDs {}'.format(pathway.name, ', '.join(missing)))
+
+    # coverage of the pathway by the model
+    n_matched = len(matched) - len(missing)
+    stats = {'reactions': len(matched),
+             'matched': n_matched,
+             'fuzzy': len(fuzzy_matches),
+             'coverage': float(n_matched) / len(matched) if matched else 0.}
+    return Topology(data['nodes'], data['edges'], node_reactions, edge_reactions,
+                    cumflux_nodes, cumflux_reactions,
+                    integer_node_flux=True, stats=stats)
+
+
+def build_cobra_network(sbml_model, results, currency=None):
     """
     graph based on the sbml model only, i.e. all the
     reactions containing products and reactants
 
     :param sbml_model:
     :param results:
+    :param currency: bool mask by metabolite index of the metabolites
+                     left out, see `kepavi.currency.currency_mask`,
+                     names of `UNDESIRABLES` when None
     :return:
     """
 
+    def is_currency(e):
+        if currency is None:
+            return e.name in UNDESIRABLES
+        return currency[sbml_model.metabolites.index(e)]
+
     data = {'nodes': [], 'edges': []}
 
     added_node = set()
@@ -417,7 +782,7 @@ def build_cobra_network(sbml_model, results):
     def add_node(elements):
         for e in elements:
             e_name = e.name
-            if e_name in UNDESIRABLES:
+            if is_currency(e):
                 continue
             e_id = e.id
             if e_name not in added_node:
@@ -433,11 +798,11 @@ def build_cobra_network(sbml_model, results):
         add_node(reaction.reactants)
         add_node(reaction.products)
         for reactant in reaction.reactants:
-            if reactant.name in UNDESIRABLES:
+            if is_currency(reactant):
                 continue
             reac_id = id_by_name[reactant.name]  # if reactant.id
             for product in reaction.products:
-                if product.name in UNDESIRABLES:
+                if is_currency(product):
                     continue
                 product_id = id_by_name[product.name]  # product.id
                 arrow_src = reaction.reversibility
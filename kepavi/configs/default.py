@@ -58,6 +58,87 @@ class DefaultConfig(object):
     CACHE_TYPE = "simple"
     CACHE_DEFAULT_TIMEOUT = 60
 
+    # memory budget (bytes) of the deserialized cobra models kept by
+    # each worker, least recently used models are evicted first
+    MODEL_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+    # worker processes solving analyses, per web worker, and how many
+    # analyses may be queued or running before new ones are refused
+    JOBS_PROCESSES = 2
+    JOBS_MAX_PENDING = 50
+
+    # limits of each solver process: wall clock (seconds) and memory on
+    # top of what it inherits from its worker (bytes), 0 for no limit
+    JOBS_TIME_LIMIT = 300
+    JOBS_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+
+    # pending jobs queued or started longer ago (seconds) are considered
+    # lost with their worker: not counted as pending, failed at start-up
+    JOBS_STALE_AFTER = 2 * 60 * 60
+
+    # FBA backend, see `kepavi.solvers`: 'cobra' (cobra solver interface)
+    # or 'linprog' (scipy, on the model arrays)
+    FBA_SOLVER = 'cobra'
+
+    # scenarios accepted by a single batch FBA request
+    FBA_BATCH_MAX_SCENARIOS = 100
+
+    # at most reactions per flux variability analysis job, smaller
+    # models are split between the JOBS_PROCESSES
+    FVA_CHUNK_SIZE = 250
+
+    # at most single or double deletions per knockout screening job
+    KNOCKOUT_CHUNK_SIZE = 500
+
+    # hashes of solved FBA inputs indexed by each worker
+    SOLUTION_CACHE_MAX_ENTRIES = 1024
+
+    # zlib compression of the stored result arrays, compressed arrays
+    # can not be memory mapped
+    RESULTS_COMPRESS = False
+
+    # downloaded results: parsed ones kept by each worker, files shared
+    # by the workers up to a total size (bytes)
+    RESULTS_CACHE_MAX_ENTRIES = 32
+    RESULTS_CACHE_DIR = os.path.join(_basedir, 'results_cache')
+    RESULTS_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+    # graph topologies (model, pathway) kept by each worker
+    TOPOLOGY_CACHE_MAX_ENTRIES = 64
+
+    # outgoing http requests: (connect, read) timeout in seconds,
+    # retries of connection errors and 5xx answers, waiting
+    # backoff factor * 2 ** retry seconds, kept alive connections by host
+    HTTP_TIMEOUT = (3.05, 30)
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF_FACTOR = 0.3
+    HTTP_POOL_SIZE = 10
+    # calls of the http and s3 clients between two logs of their latency
+    # by endpoint, 0 to never log them
+    CLIENT_STATS_LOG_INTERVAL = 100
+
+    # s3 uploads larger than the threshold (bytes) are sent in parts
+    S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+    S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+    # stoichiometric matrix and bounds of each model as .npy files
+    MODEL_ARRAYS_DIR = os.path.join(_basedir, 'model_arrays')
+
+    # seeded force layout of the whole model graphs, stored with the arrays
+    LAYOUT_ITERATIONS = 50
+    LAYOUT_SEED = 0
+
+    # currency metabolites left out of the whole model graphs, see
+    # `kepavi.currency`: hubs reach the degree (min degree or factor times
+    # the median degree) or pair with a hub in the given fraction of their
+    # reactions. Names or ids always left out (`kepavi.currency.UNDESIRABLES`
+    # when None) and never left out. Stored with the arrays.
+    CURRENCY_MIN_DEGREE = 30
+    CURRENCY_DEGREE_FACTOR = 10.
+    CURRENCY_PAIR_FRACTION = 0.8
+    CURRENCY_METABOLITES = None
+    CURRENCY_EXCLUDED = ()
+
     # Captcha
     # To get recaptcha, visit the link below:
     # https://www.google.com/recaptcha/admin/create
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.currency
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Currency metabolites (protons, water, cofactors...) take part in so
+    many reactions that drawing them links everything to everything.
+    They are detected once per model content version from the
+    stoichiometric matrix and stored as a boolean mask by metabolite
+    index next to its `kepavi.stoichiometry.ModelArrays`, so graph
+    builders drop them with one indexed lookup.
+
+    A metabolite is a currency one when
+
+    - its degree (reactions it takes part in) reaches the hub threshold,
+      `min_degree` or `degree_factor` times the median degree,
+    - or it stands on the other side of a hub in `pair_fraction` of its
+      reactions with a degree of at least half the threshold, as ADP
+      does with ATP or NADH with NAD,
+    - or its name or id is listed in the overrides, unless it is listed
+      in the exclusions.
+
+"""
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# this metabolites are involved in too much reactions
+# and make the visualization too complicated
+UNDESIRABLES = {'H',
+                'H+',
+                'H(+)',
+                'NH4(+)',
+                'NADH(2-)',
+                'NAD(+)',
+                'NADP(+)',
+                'NADPH',
+                'diphosphate(3-)',
+                'CO(2)',
+                'holo-[acyl-carrier\nprotein]',
+                'HOLO-[ACYL-CARRIER\nPROTEIN]',
+                'Cl(-)',
+                'Fe(2+)',
+                'IDP',  # known has intrinsically disordred protein
+                # 'acetyl-CoA(4-)',
+                'CoA',
+                'GTP',
+                'UTP(3-)',
+                'CTP(3-)',
+                'dioxygen',
+                'AMP',
+                'H2O',
+                'ADP',
+                'ATP',
+                'Diphosphate',
+                'Phosphate',
+                'phosphate',
+                'UDP',
+                'Coenzyme-A',
+                'Nicotinamide-adenine-dinucleotide',
+                'Nicotinamide-adenine-dinucleotide-phosphate',
+                'Nicotinamide-adenine-dinucleotide--reduced',
+                'Ammonium',
+                'CO2'}
+
+
+def currency_path(path):
+    """currency mask file of the arrays stored in `path`"""
+
+    return os.path.join(path, 'currency-v{}.npy'.format(FORMAT_VERSION))
+
+
+def config_params(config):
+    """`currency_mask` keyword arguments read from the `CURRENCY_*` settings"""
+
+    return {'min_degree': config['CURRENCY_MIN_DEGREE'],
+            'degree_factor': config['CURRENCY_DEGREE_FACTOR'],
+            'pair_fraction': config['CURRENCY_PAIR_FRACTION'],
+            'metabolites': config['CURRENCY_METABOLITES'],
+            'excluded': config['CURRENCY_EXCLUDED']}
+
+
+def currency_mask(arrays, min_degree=30, degree_factor=10., pair_fraction=0.8,
+                  metabolites=None, excluded=()):
+    """
+    :param arrays: `kepavi.stoichiometry.ModelArrays`
+    :param metabolites: names or ids always masked, `UNDESIRABLES` when
+                        None
+    :param excluded: names or ids never masked
+    :return: bool array by metabolite index
+    """
+
+    S = arrays.S.tocsr()
+    reactant = (S < 0).astype(np.int32)
+    product = (S > 0).astype(np.int32)
+    degree = np.diff(reactant.indptr) + np.diff(product.indptr)
+
+    drawn = degree[degree > 0]
+    threshold = max(min_degree, degree_factor * np.median(drawn) if len(drawn) else 0)
+    hub = degree >= threshold
+
+    mask = hub.copy()
+    hubs = np.flatnonzero(hub)
+    if len(hubs):
+        # reactions where a metabolite and a hub stand on opposite sides
+        opposite = (reactant.dot(product[hubs].T) + product.dot(reactant[hubs].T)).toarray()
+        paired = opposite.max(axis=1) >= pair_fraction * degree
+        mask |= paired & (degree >= threshold / 2.)
+
+    forced = UNDESIRABLES if metabolites is None else set(metabolites)
+    excluded = set(excluded)
+    for i, (metabolite_id, name) in enumerate(zip(arrays.metabolite_ids, arrays.metabolite_names)):
+        if metabolite_id in excluded or name in excluded:
+            mask[i] = False
+        elif metabolite_id in forced or name in forced:
+            mask[i] = True
+    return mask
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.diffs
+    ~~~~~~~~~~~~~~~~~~~~
+
+    User modifications of a model (`BiomodelModification.diff`) stored
+    as a patch on the base model instead of a full copy. A patch is
+    applied to a `kepavi.caching.ModelView` of the shared cached model
+    and reverted with it, so a variant costs its patch only.
+
+    Patch (json)::
+
+        {"format": 1,
+         "base": {"model": <mongo document id>, "version": <content version>},
+         "bounds": {reaction id: [lower bound, upper bound]},
+         "objective": {reaction id: coefficient},
+         "stoichiometry": {reaction id: {metabolite id: coefficient}},
+         "metabolites": [{"id", "name", "formula", "compartment"}],
+         "added": [{"id", "name", "subsystem", "lower_bound", "upper_bound",
+                    "objective_coefficient", "metabolites"}],
+         "removed": [reaction id]}
+
+    Every key but `format` and `base` is optional. `metabolites` holds
+    the metabolites missing from the base model. Removed reactions stay
+    in the model with their flux forced to zero, the shared model keeps
+    its reactions order.
+
+"""
+import json
+import logging
+
+from kepavi._compat import iteritems
+
+FORMAT_VERSION = 1
+
+_CHANGES = ('bounds', 'objective', 'stoichiometry', 'metabolites', 'added', 'removed')
+
+
+class PatchError(ValueError):
+    pass
+
+
+def dumps(patch):
+    return json.dumps(patch, separators=(',', ':'), sort_keys=True)
+
+
+def loads(data):
+    patch = json.loads(data)
+    if not isinstance(patch, dict) or 'format' not in patch:
+        raise PatchError('not a model patch')
+    if patch['format'] > FORMAT_VERSION:
+        raise PatchError('unsupported patch version {}'.format(patch['format']))
+    return patch
+
+
+def is_empty(patch):
+    return not any(patch.get(k) for k in _CHANGES)
+
+
+def _stoichiometry(reaction):
+    return dict((m.id, coefficient) for m, coefficient in iteritems(reaction._metabolites))
+
+
+def _describe_metabolite(m):
+    return {'id': m.id, 'name': m.name, 'formula': m.formula, 'compartment': m.compartment}
+
+
+def _describe_reaction(r):
+    return {'id': r.id,
+            'name': r.name,
+            'subsystem': r.subsystem,
+            'lower_bound': r.lower_bound,
+            'upper_bound': r.upper_bound,
+            'objective_coefficient': r.objective_coefficient,
+            'metabolites': _stoichiometry(r)}
+
+
+def compute(base, model, base_key=None):
+    """
+    patch turning `base` into `model`, reactions and metabolites being
+    matched by id
+
+    :param base: cobra model the patch applies to
+    :param model: modified cobra model
+    :param base_key: `Biomodel.cache_key` of the base model
+    """
+
+    patch = {'format': FORMAT_VERSION,
+             'base': {'model': base_key[1], 'version': base_key[2]} if base_key else None}
+
+    bounds, objective, stoichiometry, added = {}, {}, {}, []
+    for r in model.reactions:
+        if r.id not in base.reactions:
+            added.append(_describe_reaction(r))
+            continue
+        b = base.reactions.get_by_id(r.id)
+        if (b.lower_bound, b.upper_bound) != (r.lower_bound, r.upper_bound):
+            bounds[r.id] = [r.lower_bound, r.upper_bound]
+        if b.objective_coefficient != r.objective_coefficient:
+            objective[r.id] = r.objective_coefficient
+        metabolites = _stoichiometry(r)
+        if metabolites != _stoichiometry(b):
+            stoichiometry[r.id] = metabolites
+    removed = [r.id for r in base.reactions if r.id not in model.reactions]
+
+    used = set(stoichiometry) | set(r['id'] for r in added)
+    new_metabolites = dict((m.id, m) for r in model.reactions if r.id in used
+                           for m in r._metabolites if m.id not in base.metabolites)
+
+    for key, value in (('bounds', bounds),
+                       ('objective', objective),
+                       ('stoichiometry', stoichiometry),
+                       ('metabolites', [_describe_metabolite(new_metabolites[k]) for k in sorted(new_metabolites)]),
+                       ('added', added),
+                       ('removed', removed)):
+        if value:
+            patch[key] = value
+    return patch
+
+
+def check(patch, model):
+    """
+    :return: list of conflicts between the patch and the model, e.g.
+             reactions missing from the model or added twice
+    """
+
+    conflicts = []
+    for key in ('bounds', 'objective', 'stoichiometry', 'removed'):
+        conflicts.extend('{}: unknown reaction {}'.format(key, reaction_id)
+                         for reaction_id in patch.get(key, ()) if reaction_id not in model.reactions)
+
+    added_ids = [r['id'] for r in patch.get('added', ())]
+    conflicts.extend('added: reaction {} already exists'.format(reaction_id)
+                     for reaction_id in added_ids if reaction_id in model.reactions)
+
+    known = set(m['id'] for m in patch.get('metabolites', ()))
+    stoichiometries = list(patch.get('stoichiometry', {}).values())
+    stoichiometries.extend(r['metabolites'] for r in patch.get('added', ()))
+    for metabolites in stoichiometries:
+        conflicts.extend('unknown metabolite {}'.format(m) for m in metabolites
+                         if m not in known and m not in model.metabolites)
+    return conflicts
+
+
+def apply(view, patch, base_key=None):
+    """
+    apply the patch to a model view, reverted by `view.restore`
+
+    :param view: `kepavi.caching.ModelView`
+    :param base_key: `Biomodel.cache_key` of the viewed model, a patch
+                     made for another version still applies as long as
+                     it does not conflict
+    :raise PatchError: the patch conflicts with the model, nothing is applied
+    """
+
+    from cobra import Metabolite, Reaction
+
+    model = view.model
+    base = patch.get('base')
+    if base_key is not None and base and (base['model'], base['version']) != tuple(base_key[1:]):
+        logging.warn('patch made for {model} v{version}, applied to {0} v{1}'.format(*base_key[1:], **base))
+
+    conflicts = check(patch, model)
+    if conflicts:
+        raise PatchError('patch does not apply: {}'.format('; '.join(conflicts)))
+
+    view.add_metabolites([Metabolite(m['id'], formula=m.get('formula'), name=m.get('name'),
+                                     compartment=m.get('compartment'))
+                          for m in patch.get('metabolites', ()) if m['id'] not in model.metabolites])
+
+    def metabolites(coefficients):
+        return dict((model.metabolites.get_by_id(k), v) for k, v in iteritems(coefficients))
+
+    for reaction_id, (lb, ub) in iteritems(patch.get('bounds', {})):
+        view.set_bounds(model.reactions.get_by_id(reaction_id), lb, ub)
+    for reaction_id, coefficient in iteritems(patch.get('objective', {})):
+        view.set_objective(model.reactions.get_by_id(reaction_id), coefficient)
+    for reaction_id in patch.get('removed', ()):
+        r = model.reactions.get_by_id(reaction_id)
+        view.set_bounds(r, 0., 0.)
+        view.set_objective(r, 0.)
+
+    for r in patch.get('added', ()):
+        reaction = Reaction(r['id'])
+        reaction.name = r.get('name', '')
+        reaction.subsystem = r.get('subsystem', '')
+        reaction.lower_bound = r.get('lower_bound', 0.)
+        reaction.upper_bound = r.get('upper_bound', 1000.)
+        reaction.objective_coefficient = r.get('objective_coefficient', 0.)
+        reaction.add_metabolites(metabolites(r['metabolites']))
+        view.add_reaction(reaction)
+    for reaction_id, coefficients in iteritems(patch.get('stoichiometry', {})):
+        view.set_stoichiometry(model.reactions.get_by_id(reaction_id), metabolites(coefficients))
@@ -12,6 +12,10 @@ from flask_babel import Babel
 from flask_oauthlib.client import OAuth
 from flask_mongoengine import MongoEngine
 
+from kepavi.caching import ModelCache, SolutionCache, ResultsCache, TopologyCache
+from kepavi.clients import HttpClient, S3Client
+from kepavi.jobs import JobQueue
+
 # Database
 db = SQLAlchemy()
 
@@ -40,3 +44,22 @@ htmlminify = HTMLMIN()
 oauth = OAuth()
 
 mongo = MongoEngine()
+
+# deserialized cobra models, one cache per worker
+model_cache = ModelCache()
+
+# process pool running the analyses
+job_queue = JobQueue()
+
+# stored FBA results by hash of their inputs
+solution_cache = SolutionCache()
+
+# downloaded analysis results
+results_cache = ResultsCache()
+
+# graphs drawn for each model and pathway, without fluxes
+topology_cache = TopologyCache()
+
+# pooled http session (kegg, s3 downloads) and s3 connection
+http_client = HttpClient()
+s3_client = S3Client()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.files
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Files shared by the workers: model arrays, layouts, masks, matched
+    pathways and cached results. Several workers may compute and write
+    the same file at once, so each one writes a private temporary copy
+    then renames it into place. Renaming is atomic, readers see either
+    no file or a complete one.
+
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """file object whose content replaces `path` once the block exits without error"""
+
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+@contextmanager
+def atomic_directory(path):
+    """
+    temporary directory renamed to `path` once the block exits without
+    error. When another worker renamed its own copy first, ours is
+    dropped.
+    """
+
+    parent, name = os.path.split(os.path.normpath(path))
+    if parent and not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # created meanwhile by another worker
+            if not os.path.isdir(parent):
+                raise
+    tmp = tempfile.mkdtemp(prefix=name + '.', suffix='.tmp', dir=parent or '.')
+    try:
+        yield tmp
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmp)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def save_array(path, a):
+    with atomic_write(path) as f:
+        np.save(f, a)
+
+
+def load_array(path):
+    """memory mapped array, None if it was not written"""
+
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
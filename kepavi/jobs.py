@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.jobs
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Long running analyses are persisted as `kepavi.user.models.Job`
+    rows and solved by a bounded pool of worker processes, so web
+    workers answer right away.
+
+    Each web worker lazily forks its own pool (`JOBS_PROCESSES`). Worker
+    processes inherit the application and run every job inside an
+    application context.
+
+    Solver calls go through `run_limited`: they run in a process forked
+    from the worker, killed once `JOBS_TIME_LIMIT` is exceeded or the
+    job cancelled, and bounded in memory by `JOBS_MEMORY_LIMIT`.
+
+    Admission (`JOBS_MAX_PENDING`) counts analyses rather than jobs: the
+    chunk jobs of one analysis take a single place.
+
+    Jobs queued in a pool which died with its web worker (reload, crash)
+    are never run. Pending jobs queued or started more than
+    `JOBS_STALE_AFTER` seconds ago are considered lost: they no longer
+    count as pending and are failed when a pool starts.
+
+"""
+import logging
+import multiprocessing
+import os
+import pickle
+import resource
+import select
+import signal
+import time
+import traceback
+from datetime import datetime, timedelta
+
+# kind -> function taking the job
+TASKS = {}
+
+
+def task(kind):
+    """register the function running the jobs of a given kind"""
+
+    def decorator(f):
+        TASKS[kind] = f
+        return f
+    return decorator
+
+
+class JobError(Exception):
+    """expected failure, its message is shown to the user"""
+
+    # status given to the job and its analysis
+    status = 'failed'
+
+
+class JobTimeout(JobError):
+    status = 'timeout'
+
+
+class JobCancelled(JobError):
+    status = 'cancelled'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pool = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_PROCESSES', 2)
+        app.config.setdefault('JOBS_MAX_PENDING', 50)
+        app.config.setdefault('JOBS_TIME_LIMIT', 300)
+        app.config.setdefault('JOBS_MEMORY_LIMIT', 2 * 1024 * 1024 * 1024)
+        app.config.setdefault('JOBS_STALE_AFTER', 2 * 60 * 60)
+        self.app = app
+
+    def _get_pool(self):
+        # a pool can not be used from a forked process, e.g. a new uwsgi worker
+        if self._pool is None or self._pid != os.getpid():
+            self.fail_stale()
+            self._pool = multiprocessing.Pool(self.app.config['JOBS_PROCESSES'],
+                                              initializer=_init_worker)
+            self._pid = os.getpid()
+        return self._pool
+
+    def _alive(self):
+        """filter of the pending jobs queued or started recently enough to be running"""
+
+        from kepavi.extensions import db
+        from kepavi.user.models import Job
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['JOBS_STALE_AFTER'])
+        return db.and_(Job.status.in_(Job.PENDING),
+                       db.func.coalesce(Job.start_date, Job.creation_date) >= cutoff)
+
+    def fail_stale(self):
+        """
+        fail the pending jobs lost by a dead worker, see `JOBS_STALE_AFTER`
+
+        :return: number of failed jobs
+        """
+
+        from kepavi.extensions import db
+        from kepavi.user.models import Job
+
+        stale = Job.query.filter(Job.status.in_(Job.PENDING), db.not_(self._alive())).all()
+        failed = 0
+        for job in stale:
+            # may have ended meanwhile
+            updated = Job.query.filter(Job.id == job.id, Job.status.in_(Job.PENDING))\
+                .update({'status': 'failed', 'error': 'lost by its worker', 'end_date': datetime.utcnow()},
+                        synchronize_session=False)
+            if updated and job.analysis is not None and job.analysis.results_url is None:
+                job.analysis.results_content = 'failed'
+            failed += updated
+        db.session.commit()
+        if failed:
+            logging.warn('{} stale jobs failed'.format(failed))
+        return failed
+
+    def pending_count(self):
+        """analyses, and jobs without one, queued or running"""
+
+        from kepavi.extensions import db
+        from kepavi.user.models import Job
+        alive = Job.query.filter(self._alive())
+        analyses = alive.filter(Job.analysis_id != None).with_entities(  # noqa
+            db.func.count(db.distinct(Job.analysis_id))).scalar()
+        return analyses + alive.filter(Job.analysis_id == None).count()  # noqa
+
+    def submit(self, *jobs):
+        """
+        persist and enqueue the jobs
+
+        :raise QueueFull: when more than `JOBS_MAX_PENDING` analyses would
+                          be queued or running
+        """
+
+        for job in jobs:
+            if job.kind not in TASKS:
+                raise ValueError('unknown job kind: {}'.format(job.kind))
+        analyses = set(job.analysis_id for job in jobs if job.analysis_id is not None)
+        admitted = len(analyses) + sum(1 for job in jobs if job.analysis_id is None)
+        if self.pending_count() + admitted > self.app.config['JOBS_MAX_PENDING']:
+            raise QueueFull()
+
+        from kepavi.extensions import db
+        db.session.add_all(jobs)
+        db.session.commit()
+        pool = self._get_pool()
+        for job in jobs:
+            pool.apply_async(_run_job, (job.id,))
+        return jobs
+
+
+def _init_worker():
+    """connections inherited from the parent process must not be shared"""
+
+    from kepavi.extensions import db, job_queue
+    from mongoengine.connection import connect, disconnect
+
+    app = job_queue.app
+    with app.app_context():
+        db.engine.dispose()
+    settings = app.config['MONGODB_SETTINGS']
+    disconnect()
+    connect(settings['db'], host=settings['host'])
+
+
+# seconds between two checks of the job status while its child runs
+_CANCEL_POLL_INTERVAL = 1.
+
+
+def _address_space():
+    """virtual memory size of this process in bytes, 0 when unknown"""
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _job_status(job):
+    from kepavi.extensions import db
+    from kepavi.user.models import Job
+
+    status = db.session.query(Job.status).filter(Job.id == job.id).scalar()
+    # ends the transaction, the next check sees new commits
+    db.session.commit()
+    return status
+
+
+def run_limited(job, f, *args):
+    """
+    call `f(*args)` in a child process and return its result, which must
+    be picklable. The child inherits the worker memory (cached models,
+    solver problems) but must not use the database connections.
+
+    :raise JobTimeout: `JOBS_TIME_LIMIT` seconds elapsed, the child is killed
+    :raise JobCancelled: the job was cancelled, the child is killed
+    :raise JobError: the child failed or exceeded `JOBS_MEMORY_LIMIT`
+    """
+
+    from kepavi.extensions import job_queue
+
+    config = job_queue.app.config
+    time_limit, memory_limit = config['JOBS_TIME_LIMIT'], config['JOBS_MEMORY_LIMIT']
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            if memory_limit:
+                # the child already maps what it inherited from the worker
+                limit = _address_space() + memory_limit
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            result = (True, f(*args))
+        except MemoryError:
+            result = (False, 'memory limit exceeded')
+        except JobError as e:
+            result = (False, str(e))
+        except Exception:
+            logging.error(traceback.format_exc())
+            result = (False, None)
+        try:
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            while data:
+                data = data[os.write(w, data):]
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    chunks, running = [], True
+    deadline = time.time() + time_limit if time_limit else None
+    try:
+        while True:
+            timeout = _CANCEL_POLL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise JobTimeout('time limit of {}s exceeded'.format(time_limit))
+                timeout = min(timeout, remaining)
+            ready, _, __ = select.select([r], [], [], timeout)
+            if ready:
+                chunk = os.read(r, 1 << 16)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            elif _job_status(job) == 'cancelled':
+                raise JobCancelled('cancelled')
+        os.waitpid(pid, 0)
+        running = False
+    finally:
+        os.close(r)
+        if running:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+    if not chunks:
+        # killed before answering, most likely by the memory limit
+        raise JobError('solver process died')
+    ok, result = pickle.loads(b''.join(chunks))
+    if not ok:
+        if result is None:
+            raise Exception('solver process failed')
+        raise JobError(result)
+    return result
+
+
+def _run_job(job_id):
+    from kepavi.extensions import db, job_queue
+    from kepavi.user.models import Job
+
+    with job_queue.app.app_context():
+        # a job cancelled meanwhile is left as it is
+        started = Job.query.filter(Job.id == job_id, Job.status == 'queued')\
+            .update({'status': 'running', 'start_date': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if not started:
+            return
+        job = Job.query.filter(Job.id == job_id).first()
+
+        try:
+            TASKS[job.kind](job)
+        except Exception as e:
+            db.session.rollback()
+            if isinstance(e, JobError):
+                job.error = str(e)
+                job.status = e.status
+            else:
+                logging.error(traceback.format_exc())
+                job.error = 'internal error'
+                job.status = 'failed'
+            if job.analysis is not None:
+                job.analysis.results_content = job.status
+                job.analysis.save()
+        else:
+            # cancelled while running a step which can not be interrupted
+            job.status = 'cancelled' if _job_status(job) == 'cancelled' else 'done'
+        job.end_date = datetime.utcnow()
+        job.save()
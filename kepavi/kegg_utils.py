@@ -6,8 +6,8 @@ import sqlite3
 from Bio.KEGG.KGML.KGML_parser import read as kgml_read
 from Bio.KEGG.KGML.KGML_pathway import Entry, Component, Reaction, Relation
 
-from kepavi.extensions import db
-import requests
+from kepavi.extensions import db, http_client
+from requests import RequestException
 
 
 class Organism(db.Model):
@@ -44,8 +44,13 @@ class Kegg(object):
         return all organism listed in Kegg database
         """
 
-        resp = requests.get(''.join([Kegg.BASE_URL, 'list/organism']))
-        return resp.text
+        try:
+            resp = http_client.get(''.join([Kegg.BASE_URL, 'list/organism']))
+        except RequestException:
+            return ''
+        if resp.status_code == 200:
+            return resp.text
+        return ''
 
     @staticmethod
     def get_pathways_list(org='hsa'):
@@ -55,7 +60,10 @@ class Kegg(object):
         :param org organism shortcode in Kegg database
         """
 
-        resp = requests.get(''.join([Kegg.BASE_URL, 'list/pathway/', org]))
+        try:
+            resp = http_client.get(''.join([Kegg.BASE_URL, 'list/pathway/', org]))
+        except RequestException:
+            return {}
         if resp.status_code == 200:
             d = csv.DictReader(resp.text.split('\n'),
                                delimiter='\t',
@@ -73,10 +81,13 @@ class Kegg(object):
 
         if pathway_id.startswith('path:'):
             pathway_id = pathway_id.replace('path:', '')
-        resp = requests.get(''.join([Kegg.BASE_URL,
-                                     'get/',
-                                     pathway_id,
-                                     '/kgml']))
+        try:
+            resp = http_client.get(''.join([Kegg.BASE_URL,
+                                            'get/',
+                                            pathway_id,
+                                            '/kgml']))
+        except RequestException:
+            return None
         if resp.status_code == 200:
             return kgml_read(resp.text)
         return None
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.layout
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Server side layout of the graphs drawn without KEGG coordinates.
+    A seeded Fruchterman-Reingold layout in numpy: the same graph always
+    gets the same positions, computed once per model content version
+    and stored next to its `kepavi.stoichiometry.ModelArrays`.
+
+    Repulsion is approximated on a grid, as a single level Barnes-Hut:
+    nodes in the same or adjacent cells repulse each other exactly,
+    farther cells act as one node of their mass at their centroid on
+    the centroid of the cell of the node. With about n^(2/3) cells an
+    iteration costs O(n^(4/3)) instead of O(n^2).
+
+"""
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 3
+
+# half of the adjacent cells, each pair of cells is visited once
+_NEIGHBOUR_CELLS = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def layout_path(path):
+    """layout file of the arrays stored in `path`"""
+
+    return os.path.join(path, 'layout-v{}.npy'.format(FORMAT_VERSION))
+
+
+def _close_pairs(cells, side, chunk_size):
+    """
+    (i, j) index arrays of the pairs of distinct nodes in the same or
+    adjacent cells, each pair once, by blocks of about `chunk_size` pairs
+
+    :param cells: int array of shape (n, 2), cell of each node in a
+                  `side` x `side` grid
+    """
+
+    cell_ids = cells[:, 0] * side + cells[:, 1]
+    order = np.argsort(cell_ids, kind='mergesort')
+    bounds = np.arange(side * side)
+    starts = np.searchsorted(cell_ids[order], bounds, 'left')
+    counts = np.searchsorted(cell_ids[order], bounds, 'right') - starts
+
+    for dx, dy in _NEIGHBOUR_CELLS:
+        x, y = cells[:, 0] + dx, cells[:, 1] + dy
+        nodes = np.flatnonzero((x >= 0) & (x < side) & (y >= 0) & (y < side))
+        if not len(nodes):
+            continue
+        neighbours = x[nodes] * side + y[nodes]
+        # nodes grouped so that each group holds about chunk_size pairs
+        ends = np.cumsum(counts[neighbours])
+        splits = np.unique(np.searchsorted(ends, np.arange(chunk_size, ends[-1], chunk_size)))
+        for group in np.split(np.arange(len(nodes)), splits):
+            group_counts = counts[neighbours[group]]
+            i = np.repeat(nodes[group], group_counts)
+            # rank of each pair in its cell
+            rank = np.arange(len(i)) - np.repeat(np.cumsum(group_counts) - group_counts, group_counts)
+            j = order[np.repeat(starts[neighbours[group]], group_counts) + rank]
+            if dx == dy == 0:
+                distinct = i < j
+                i, j = i[distinct], j[distinct]
+            yield i, j
+
+
+def _repulsion(positions, k, chunk_size):
+    """sum over the other nodes of k^2 / d^2 (p_i - p_j), see the module documentation"""
+
+    n = len(positions)
+    side = max(1, int(2 * n ** (1. / 3)))
+    cells = np.minimum((positions * side).astype(np.intp), side - 1)
+    occupied, cell_index, mass = np.unique(cells[:, 0] * side + cells[:, 1],
+                                           return_inverse=True, return_counts=True)
+    centroids = np.column_stack([np.bincount(cell_index, weights=positions[:, axis])
+                                 for axis in (0, 1)]) / mass[:, np.newaxis]
+    cx, cy = occupied // side, occupied % side
+
+    displacement = np.zeros((n, 2))
+    for i, j in _close_pairs(cells, side, chunk_size):
+        delta = positions[i] - positions[j]
+        weights = k * k / np.maximum((delta ** 2).sum(axis=1), 1e-12)
+        for axis in (0, 1):
+            force = weights * delta[:, axis]
+            displacement[:, axis] += (np.bincount(i, weights=force, minlength=n) -
+                                      np.bincount(j, weights=force, minlength=n))
+
+    # farther cells, evaluated once per cell at its centroid
+    field = np.zeros((len(occupied), 2))
+    rows = max(1, chunk_size // len(occupied))
+    for start in range(0, len(occupied), rows):
+        block = centroids[start:start + rows]
+        dx = block[:, 0, np.newaxis] - centroids[:, 0]
+        dy = block[:, 1, np.newaxis] - centroids[:, 1]
+        weights = mass * k * k / np.maximum(dx * dx + dy * dy, 1e-12)
+        # adjacent cells were summed exactly
+        weights[(np.abs(cx[start:start + rows, np.newaxis] - cx) <= 1) &
+                (np.abs(cy[start:start + rows, np.newaxis] - cy) <= 1)] = 0.
+        field[start:start + rows] = block * weights.sum(axis=1)[:, np.newaxis] - weights.dot(centroids)
+    return displacement + field[cell_index]
+
+
+def force_layout(n, sources, targets, iterations=50, seed=0, chunk_size=1 << 16):
+    """
+    Fruchterman-Reingold layout in the unit square. Repulsion is
+    approximated on a grid and computed by blocks of about `chunk_size`
+    pairs to bound memory, attraction along the edges only.
+
+    :param n: number of nodes
+    :param sources: int array of edge source nodes
+    :param targets: int array of edge target nodes
+    :param seed: seed of the initial positions
+    :return: float64 array of shape (n, 2), in [0, 1]
+    """
+
+    positions = np.random.RandomState(seed).uniform(0., 1., (n, 2))
+    if n < 2:
+        return positions
+    sources = np.asarray(sources, dtype=np.intp)
+    targets = np.asarray(targets, dtype=np.intp)
+    k = 1. / np.sqrt(n)
+
+    for iteration in range(iterations):
+        displacement = _repulsion(positions, k, chunk_size)
+
+        delta = positions[sources] - positions[targets]
+        pull = delta * (np.sqrt((delta ** 2).sum(axis=1)) / k)[:, np.newaxis]
+        for axis in (0, 1):
+            displacement[:, axis] -= np.bincount(sources, weights=pull[:, axis], minlength=n)
+            displacement[:, axis] += np.bincount(targets, weights=pull[:, axis], minlength=n)
+
+        # moves are capped by a temperature cooling down linearly
+        temperature = 0.1 * (1. - float(iteration) / iterations)
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=1)), 1e-12)
+        positions += displacement * (np.minimum(length, temperature) / length)[:, np.newaxis]
+        np.clip(positions, 0., 1., out=positions)
+
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    return (positions - low) / np.where(high > low, high - low, 1.)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.pathways
+    ~~~~~~~~~~~~~~~~~~~~
+
+    KEGG pathways of the model organism matched against the model once,
+    in a background job: the `kepavi.topology.Topology` of each pathway
+    and its coverage by the model are written next to the model arrays.
+    Opening a pathway then only gathers the analysis fluxes.
+
+    Layout::
+
+        pathways-v2/
+            <pathway id>.json   topology of the pathway
+            coverage.json       pathway id -> topology stats, written
+                                last: its presence means the matching
+                                is complete
+
+"""
+import json
+import logging
+import os
+
+from kepavi.files import atomic_write
+from kepavi.topology import Topology
+
+FORMAT_VERSION = 2
+
+
+def pathways_path(path):
+    """pathways directory of the arrays stored in `path`"""
+
+    return os.path.join(path, 'pathways-v{}'.format(FORMAT_VERSION))
+
+
+def _write_json(path, data):
+    with atomic_write(path, 'w') as f:
+        json.dump(data, f)
+
+
+def _topology_path(directory, pathway_id):
+    # pathway ids look like path:hsa00010
+    return os.path.join(directory, pathway_id.replace(':', '_').replace('/', '_') + '.json')
+
+
+def load_topology(directory, pathway_id):
+    """precomputed topology of a pathway, None if it was not matched"""
+
+    path = _topology_path(directory, pathway_id)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return Topology.from_dict(json.load(f))
+
+
+def load_coverage(directory):
+    """pathway id -> coverage stats, None until the matching is complete"""
+
+    path = os.path.join(directory, 'coverage.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def match_pathways(directory, pathways, arrays, kegg_index, get_kgml):
+    """
+    match every pathway against the model and store the results
+
+    :param pathways: list of dict with `id` (and `name`), as returned by
+                     `kepavi.kegg_utils.Kegg.get_pathways_list`
+    :param arrays: `kepavi.stoichiometry.ModelArrays` of the model
+    :param kegg_index: `kepavi.biomodels.KeggIndex` of the model
+    :param get_kgml: function returning the KGML pathway of an id, None
+                     on failure
+    :return: the coverage dict
+    """
+
+    from kepavi.cobra_utils import kegg_pathway_topology
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    coverage = {}
+    for i, pathway in enumerate(pathways):
+        kgml = get_kgml(pathway['id'])
+        if kgml is None:
+            logging.warn('could not fetch pathway {}'.format(pathway['id']))
+            continue
+        topology = kegg_pathway_topology(kgml, arrays, kegg_index)
+        _write_json(_topology_path(directory, pathway['id']), topology.to_dict())
+        coverage[pathway['id']] = topology.stats
+        logging.debug('pathways matched: {}/{}'.format(i + 1, len(pathways)))
+
+    _write_json(os.path.join(directory, 'coverage.json'), coverage)
+    return coverage
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.results
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Binary storage of analysis results. Per reaction and per metabolite
+    values (fluxes, shadow prices, variability...) are float64 arrays
+    aligned to the model reactions and metabolites order, so they can
+    be memory mapped and read by index.
+
+    Layout (little endian)::
+
+        header   magic 'KPVR', format version (uint16), flags (uint16),
+                 length of the table of contents (uint32)
+        toc      json: scalar results, ids and array descriptions,
+                 offset and length of each block
+        blocks   8 bytes aligned, relative to the end of the toc
+
+    Ids are stored once as '\\n' joined utf-8, zlib compressed. Arrays
+    are dense, or zero suppressed (uint32 indices + float64 values) when
+    smaller, and optionally zlib compressed, compressed blocks can not
+    be memory mapped. None is stored as NaN.
+
+    Results written before this format are json, `loads` reads both.
+
+"""
+import json
+import mmap
+import struct
+import zlib
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+import numpy as np
+
+from kepavi._compat import iteritems, text_type
+
+MAGIC = b'KPVR'
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<4sHHI')
+_ALIGNMENT = 8
+
+# result keys holding a value per reaction or metabolite, dicts keyed
+# by id or lists in the ids order
+ALIGNED_DICTS = {'x_dict': 'reactions',
+                 'y_dict': 'metabolites',
+                 'minimum': 'reactions',
+                 'maximum': 'reactions'}
+ALIGNED_LISTS = {'single': 'reactions'}
+# result keys holding the ids themselves
+ID_LISTS = {'reaction_ids': 'reactions'}
+
+
+class ResultsError(ValueError):
+    pass
+
+
+def _aligned_ids(results, axis, ids):
+    """`ids` followed by the ids only known by the results, e.g. added by a patch"""
+
+    ids = list(ids or ())
+    known = set(ids)
+    for key, key_axis in iteritems(ALIGNED_DICTS):
+        values = results.get(key)
+        if key_axis == axis and values:
+            extra = sorted(k for k in values if k not in known)
+            ids.extend(extra)
+            known.update(extra)
+    return ids
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self.blocks = {}
+        self.chunks = []
+        self.position = 0
+
+    def add(self, name, data, dtype, compress):
+        if compress:
+            data = zlib.compress(data, 6)
+        self.blocks[name] = [self.position, len(data), dtype, compress]
+        padding = -len(data) % _ALIGNMENT
+        self.chunks.append(data + b'\0' * padding)
+        self.position += len(data) + padding
+
+
+def dumps(results, reaction_ids=None, metabolite_ids=None, compress=False, sparse=True):
+    """
+    :param results: dict of results as produced by `kepavi.user.tasks`
+    :param reaction_ids: model reactions order, ids missing from it are
+                         appended
+    :param metabolite_ids: model metabolites order
+    :param compress: zlib compression of the arrays
+    :param sparse: zero suppression of the arrays when it saves space
+    :return: bytes
+    """
+
+    ids = {'reactions': _aligned_ids(results, 'reactions', reaction_ids),
+           'metabolites': _aligned_ids(results, 'metabolites', metabolite_ids)}
+    index = dict((axis, dict((k, i) for i, k in enumerate(axis_ids))) for axis, axis_ids in iteritems(ids))
+
+    writer = _Writer()
+    for axis, axis_ids in iteritems(ids):
+        writer.add(axis, u'\n'.join(axis_ids).encode('utf-8'), 'str', True)
+
+    meta, arrays, id_lists = {}, {}, []
+    for key, value in iteritems(results):
+        if key in ALIGNED_DICTS and value is not None:
+            axis = ALIGNED_DICTS[key]
+            a = np.zeros(len(ids[axis]), dtype='<f8')
+            for k, v in iteritems(value):
+                a[index[axis][k]] = np.nan if v is None else v
+        elif key in ALIGNED_LISTS and value is not None:
+            axis = ALIGNED_LISTS[key]
+            a = np.array([np.nan if v is None else v for v in value], dtype='<f8')
+            if len(a) != len(ids[axis]):
+                raise ResultsError('{} has {} values for {} {}'.format(key, len(a), len(ids[axis]), axis))
+        elif key in ID_LISTS and list(value) == ids[ID_LISTS[key]]:
+            id_lists.append(key)
+            continue
+        else:
+            meta[key] = value
+            continue
+
+        nonzero = np.flatnonzero(a)
+        is_sparse = sparse and 12 * len(nonzero) < 8 * len(a)
+        if is_sparse:
+            writer.add(key + '.indices', nonzero.astype('<u4').tobytes(), '<u4', compress)
+            writer.add(key + '.values', a[nonzero].tobytes(), '<f8', compress)
+        else:
+            writer.add(key, a.tobytes(), '<f8', compress)
+        arrays[key] = {'axis': axis, 'sparse': is_sparse, 'list': key in ALIGNED_LISTS}
+
+    toc = json.dumps({'meta': meta,
+                      'counts': dict((axis, len(axis_ids)) for axis, axis_ids in iteritems(ids)),
+                      'arrays': arrays,
+                      'id_lists': id_lists,
+                      'blocks': writer.blocks}).encode('utf-8')
+    toc += b' ' * (-(_HEADER.size + len(toc)) % _ALIGNMENT)
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(toc)) + toc + b''.join(writer.chunks)
+
+
+def is_results(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+class AlignedValues(Mapping):
+    """read only dict like view of an aligned array, keyed by id"""
+
+    def __init__(self, ids, index, values):
+        self.ids = ids
+        self.index = index
+        self.values = values
+
+    def __getitem__(self, key):
+        v = self.values[self.index[key]]
+        return None if v != v else float(v)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Results(object):
+    """
+    results read from the binary format, `results[key]` gives the same
+    values as the dict they were written from
+    """
+
+    def __init__(self, data):
+        if len(data) < _HEADER.size:
+            raise ResultsError('truncated results')
+        magic, version, flags, toc_length = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ResultsError('not analysis results')
+        if version > FORMAT_VERSION:
+            raise ResultsError('unsupported results version {}'.format(version))
+
+        self.data = data
+        toc = json.loads(bytes(data[_HEADER.size:_HEADER.size + toc_length]).decode('utf-8'))
+        self.meta = toc['meta']
+        self.counts = toc['counts']
+        self.arrays = toc['arrays']
+        self.id_lists = toc['id_lists']
+        self._blocks = toc['blocks']
+        self._start = _HEADER.size + toc_length
+        self._ids = {}
+        self._index = {}
+        self._dense = {}
+
+    def _block(self, name):
+        offset, length, dtype, compressed = self._blocks[name]
+        start = self._start + offset
+        if compressed:
+            raw = zlib.decompress(bytes(self.data[start:start + length]))
+            return raw if dtype == 'str' else np.frombuffer(raw, dtype=dtype)
+        if dtype == 'str':
+            return bytes(self.data[start:start + length])
+        # no copy: a view on the (memory mapped) buffer
+        return np.frombuffer(self.data, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=start)
+
+    def ids(self, axis):
+        """reaction or metabolite ids, in the arrays order"""
+
+        if axis not in self._ids:
+            text = self._block(axis).decode('utf-8')
+            self._ids[axis] = text.split(u'\n') if self.counts[axis] else []
+        return self._ids[axis]
+
+    def index(self, axis):
+        """id -> position in the arrays"""
+
+        if axis not in self._index:
+            self._index[axis] = dict((k, i) for i, k in enumerate(self.ids(axis)))
+        return self._index[axis]
+
+    @property
+    def reaction_ids(self):
+        return self.ids('reactions')
+
+    @property
+    def metabolite_ids(self):
+        return self.ids('metabolites')
+
+    def array(self, key):
+        """dense float64 array of an aligned result, NaN standing for None"""
+
+        if key not in self._dense:
+            description = self.arrays[key]
+            if description['sparse']:
+                a = np.zeros(self.counts[description['axis']])
+                a[self._block(key + '.indices')] = self._block(key + '.values')
+            else:
+                a = self._block(key)
+            self._dense[key] = a
+        return self._dense[key]
+
+    def value(self, key, i):
+        """value of an aligned result at index `i`, dense arrays are not built"""
+
+        description = self.arrays[key]
+        if description['sparse'] and key not in self._dense:
+            indices = self._block(key + '.indices')
+            position = np.searchsorted(indices, i)
+            if position == len(indices) or indices[position] != i:
+                return 0.
+            v = self._block(key + '.values')[position]
+        else:
+            v = self.array(key)[i]
+        return None if v != v else float(v)
+
+    def __contains__(self, key):
+        return key in self.meta or key in self.arrays or key in self.id_lists
+
+    def __getitem__(self, key):
+        if key in self.arrays:
+            description = self.arrays[key]
+            axis = description['axis']
+            if description['list']:
+                return [None if v != v else float(v) for v in self.array(key)]
+            return AlignedValues(self.ids(axis), self.index(axis), self.array(key))
+        if key in self.id_lists:
+            return self.ids(ID_LISTS[key])
+        return self.meta[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self.meta) + list(self.arrays) + list(self.id_lists)
+
+    def to_dict(self):
+        """plain dict, as written"""
+
+        d = dict(self.meta)
+        for key in self.arrays:
+            value = self[key]
+            d[key] = value if isinstance(value, list) else dict(value)
+        for key in self.id_lists:
+            d[key] = list(self[key])
+        return d
+
+
+def loads(data):
+    """
+    :param data: bytes (or buffer) of binary or legacy json results
+    :return: `Results`, or a dict for json results
+    """
+
+    if is_results(data):
+        return Results(data)
+    if not isinstance(data, (bytes, text_type)):
+        # memory mapped
+        data = data[:]
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def open_results(path):
+    """memory mapped results of a local file"""
+
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(data)
+
+
+def to_json(results):
+    """json text of results, loaded or not"""
+
+    if not isinstance(results, (Results, dict)):
+        results = loads(results)
+    if isinstance(results, Results):
+        results = results.to_dict()
+    return json.dumps(results)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.snapshot
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Compact binary snapshot of a cobra model, stored next to
+    `BiomodelMongo.cobra_model`.
+
+    Layout (little endian)::
+
+        header   magic 'KPVS', format version (uint16), flags (uint16),
+                 length of the uncompressed body (uint32)
+        body     zlib compressed sequence of sections, each one
+                 prefixed by its length (uint32), see `SECTIONS`
+
+    Strings live in a single table (offsets + utf-8 blob) and are
+    referenced by their index, `NO_STRING` standing for None. Anything
+    that does not fit the flat arrays (notes, annotations, charges...)
+    is kept as json in the `extras` section.
+
+"""
+import json
+import struct
+import sys
+import zlib
+from array import array
+
+from kepavi._compat import iteritems, text_type
+
+MAGIC = b'KPVS'
+FORMAT_VERSION = 1
+
+FLAG_COMPRESSED = 1
+
+NO_STRING = 0xFFFFFFFF
+
+_HEADER = struct.Struct('<4sHHI')
+_LENGTH = struct.Struct('<I')
+
+SECTIONS = ('string_offsets',         # uint32, n_strings + 1
+            'string_blob',            # utf-8
+            'metabolites',            # uint32, (id, name, formula, compartment) per metabolite
+            'reactions',              # uint32, (id, name, gene_reaction_rule, subsystem) per reaction
+            'bounds',                 # float64, (lower_bound, upper_bound, objective_coefficient) per reaction
+            'stoichiometry_indptr',   # uint32, n_reactions + 1
+            'stoichiometry_indices',  # uint32, metabolite index
+            'stoichiometry_values',   # float64, coefficient
+            'genes',                  # uint32, (id, name) per gene
+            'extras')                 # json
+
+METABOLITE_FIELDS = ('id', 'name', 'formula', 'compartment')
+REACTION_FIELDS = ('id', 'name', 'gene_reaction_rule', 'subsystem')
+BOUND_FIELDS = ('lower_bound', 'upper_bound', 'objective_coefficient')
+GENE_FIELDS = ('id', 'name')
+
+# dict keys rebuilt from the arrays or derived by cobra itself
+_REACTION_SKIPPED = set(REACTION_FIELDS + BOUND_FIELDS + ('metabolites', 'reversibility', 'reaction'))
+
+assert array('I').itemsize == 4 and array('d').itemsize == 8
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _array_to_bytes(a):
+    if sys.byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _array_from_bytes(typecode, data):
+    a = array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+class _StringTable(object):
+
+    def __init__(self):
+        self.index_by_string = {}
+        self.strings = []
+
+    def add(self, s):
+        if s is None:
+            return NO_STRING
+        if not isinstance(s, text_type):
+            s = s.decode('utf-8') if isinstance(s, bytes) else text_type(s)
+        try:
+            return self.index_by_string[s]
+        except KeyError:
+            index = self.index_by_string[s] = len(self.strings)
+            self.strings.append(s)
+            return index
+
+    def dump(self):
+        offsets, chunks, position = array('I', [0]), [], 0
+        for s in self.strings:
+            encoded = s.encode('utf-8')
+            chunks.append(encoded)
+            position += len(encoded)
+            offsets.append(position)
+        return _array_to_bytes(offsets), b''.join(chunks)
+
+
+def _extras(obj, skipped):
+    return dict((k, v) for k, v in iteritems(obj) if k not in skipped)
+
+
+def dumps(model_dict, compress=True):
+    """
+    serialize a model dict as produced by `cobra.io._to_dict`
+
+    :param model_dict: cobra model as a dict
+    :param compress: zlib compression of the body
+    :return: bytes
+    """
+
+    strings = _StringTable()
+
+    metabolites = model_dict.get('metabolites', [])
+    reactions = model_dict.get('reactions', [])
+    genes = model_dict.get('genes', [])
+
+    extras = {'model': _extras(model_dict, {'metabolites', 'reactions', 'genes'}),
+              'metabolites': {}, 'reactions': {}, 'genes': {}}
+
+    met_index = {}
+    met_strings = array('I')
+    for i, m in enumerate(metabolites):
+        met_index[m['id']] = i
+        met_strings.extend(strings.add(m.get(f)) for f in METABOLITE_FIELDS)
+        e = _extras(m, METABOLITE_FIELDS)
+        if e:
+            extras['metabolites'][i] = e
+
+    reac_strings, bounds = array('I'), array('d')
+    indptr, indices, values = array('I', [0]), array('I'), array('d')
+    for i, r in enumerate(reactions):
+        reac_strings.extend(strings.add(r.get(f)) for f in REACTION_FIELDS)
+        bounds.extend(float(r.get(f) or 0.) for f in BOUND_FIELDS)
+        for met_id, coefficient in iteritems(r.get('metabolites', {})):
+            try:
+                indices.append(met_index[met_id])
+            except KeyError:
+                raise SnapshotError('unknown metabolite {} in reaction {}'.format(met_id, r['id']))
+            values.append(float(coefficient))
+        indptr.append(len(indices))
+        e = _extras(r, _REACTION_SKIPPED)
+        if e:
+            extras['reactions'][i] = e
+
+    gene_strings = array('I')
+    for i, g in enumerate(genes):
+        gene_strings.extend(strings.add(g.get(f)) for f in GENE_FIELDS)
+        e = _extras(g, GENE_FIELDS)
+        if e:
+            extras['genes'][i] = e
+
+    string_offsets, string_blob = strings.dump()
+    sections = (string_offsets,
+                string_blob,
+                _array_to_bytes(met_strings),
+                _array_to_bytes(reac_strings),
+                _array_to_bytes(bounds),
+                _array_to_bytes(indptr),
+                _array_to_bytes(indices),
+                _array_to_bytes(values),
+                _array_to_bytes(gene_strings),
+                json.dumps(extras).encode('utf-8'))
+
+    body = b''.join(_LENGTH.pack(len(s)) + s for s in sections)
+    flags = 0
+    if compress:
+        flags |= FLAG_COMPRESSED
+        payload = zlib.compress(body, 6)
+    else:
+        payload = body
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(body)) + payload
+
+
+def read_tables(data):
+    """
+    decode a snapshot into its flat tables without building any cobra
+    object.
+
+    :return: dict with `strings` (list), `metabolites`, `reactions`, `genes`
+             (lists of tuples of strings), `bounds` (list of tuples),
+             `indptr`, `indices`, `values` (arrays) and `extras` (dict)
+    """
+
+    if len(data) < _HEADER.size:
+        raise SnapshotError('truncated snapshot')
+    magic, version, flags, body_length = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError('not a model snapshot')
+    if version > FORMAT_VERSION:
+        raise SnapshotError('unsupported snapshot version {}'.format(version))
+
+    body = data[_HEADER.size:]
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+    if len(body) != body_length:
+        raise SnapshotError('corrupted snapshot')
+
+    raw, position = {}, 0
+    for name in SECTIONS:
+        length, = _LENGTH.unpack_from(body, position)
+        position += _LENGTH.size
+        raw[name] = body[position:position + length]
+        position += length
+
+    offsets = _array_from_bytes('I', raw['string_offsets'])
+    blob = raw['string_blob']
+    strings = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+    def rows(section, width, typecode='I', resolve=True):
+        a = _array_from_bytes(typecode, raw[section])
+        if resolve:
+            a = [strings[i] if i != NO_STRING else None for i in a]
+        return [tuple(a[i:i + width]) for i in range(0, len(a), width)]
+
+    extras = json.loads(raw['extras'].decode('utf-8'))
+    return {'strings': strings,
+            'metabolites': rows('metabolites', len(METABOLITE_FIELDS)),
+            'reactions': rows('reactions', len(REACTION_FIELDS)),
+            'bounds': rows('bounds', len(BOUND_FIELDS), 'd', resolve=False),
+            'genes': rows('genes', len(GENE_FIELDS)),
+            'indptr': _array_from_bytes('I', raw['stoichiometry_indptr']),
+            'indices': _array_from_bytes('I', raw['stoichiometry_indices']),
+            'values': _array_from_bytes('d', raw['stoichiometry_values']),
+            # json turns integer keys into strings
+            'extras': {'model': extras['model'],
+                       'metabolites': dict((int(k), v) for k, v in iteritems(extras['metabolites'])),
+                       'reactions': dict((int(k), v) for k, v in iteritems(extras['reactions'])),
+                       'genes': dict((int(k), v) for k, v in iteritems(extras['genes']))}}
+
+
+def loads(data):
+    """
+    rebuild a cobra model from a snapshot, same result as
+    `cobra.io._from_dict` on the dict it was made from.
+    """
+
+    from cobra import Model, Metabolite, Reaction, Gene
+
+    tables = read_tables(data)
+    extras = tables['extras']
+
+    def set_extras(obj, values):
+        for k, v in iteritems(values):
+            setattr(obj, k, v)
+
+    model = Model()
+
+    metabolites = []
+    for i, (met_id, name, formula, compartment) in enumerate(tables['metabolites']):
+        m = Metabolite(met_id, formula=formula, name=name, compartment=compartment)
+        set_extras(m, extras['metabolites'].get(i, {}))
+        metabolites.append(m)
+    model.add_metabolites(metabolites)
+
+    genes = []
+    for i, (gene_id, name) in enumerate(tables['genes']):
+        g = Gene(gene_id)
+        g.name = name
+        set_extras(g, extras['genes'].get(i, {}))
+        genes.append(g)
+    model.genes.extend(genes)
+
+    indptr, indices, values = tables['indptr'], tables['indices'], tables['values']
+    reactions = []
+    for i, ((reac_id, name, rule, subsystem), (lb, ub, coefficient)) in \
+            enumerate(zip(tables['reactions'], tables['bounds'])):
+        r = Reaction(reac_id)
+        r.name = name
+        r.subsystem = subsystem
+        r.lower_bound = lb
+        r.upper_bound = ub
+        r.objective_coefficient = coefficient
+        if rule is not None:
+            r.gene_reaction_rule = rule
+        set_extras(r, extras['reactions'].get(i, {}))
+        r.add_metabolites(dict((metabolites[indices[j]], values[j])
+                               for j in range(indptr[i], indptr[i + 1])))
+        reactions.append(r)
+    model.add_reactions(reactions)
+
+    set_extras(model, extras['model'])
+    return model
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.solvers
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Flux balance analysis backends, selected by `FBA_SOLVER`:
+
+    ``cobra``
+        `model.optimize` on a view of the cached cobra model, solved
+        by whatever cobra solver interface is installed.
+
+    ``linprog``
+        ``max c.v  s.t.  S.v = 0, lb <= v <= ub`` handed to
+        `scipy.optimize.linprog` straight from the memory mapped
+        `kepavi.stoichiometry.ModelArrays`, no cobra model is built.
+        Needs scipy 1.0 or later, for its sparse interior point method,
+        HiGHS being used from scipy 1.6. Older versions only have a
+        dense simplex, slower than cobra on genome scale models, and the
+        backend is refused.
+
+    `checkout` loads the model in the calling process and yields the
+    function solving it, so that solving alone can happen in a child
+    process (see `kepavi.jobs.run_limited`). Solutions are `Solution`
+    like objects: `status`, `f`, `x_dict` and `y_dict`, `f` and the
+    dicts being None unless the problem is optimal.
+
+"""
+import logging
+import re
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
+import scipy
+
+from kepavi._compat import with_metaclass
+
+# name -> backend class
+SOLVERS = {}
+
+
+def solver(name):
+    """register a backend class under `name`"""
+
+    def decorator(cls):
+        cls.name = name
+        SOLVERS[name] = cls
+        return cls
+    return decorator
+
+
+def get_solver(name=None):
+    """
+    :param name: backend name, `FBA_SOLVER` of the current app by default
+    :raise ValueError: unknown backend
+    """
+
+    if name is None:
+        from flask import current_app
+        name = current_app.config.get('FBA_SOLVER', 'cobra')
+    try:
+        return SOLVERS[name]()
+    except KeyError:
+        raise ValueError('unknown FBA solver: {}'.format(name))
+
+
+class Solution(object):
+    """
+    :ivar status: 'optimal' or the reason no solution was found
+    :ivar f: objective value
+    :ivar x_dict: flux by reaction id
+    :ivar y_dict: shadow price by metabolite id, None as well when the
+                  backend does not report them: the ``linprog`` backend
+                  only gets them from HiGHS
+    """
+
+    def __init__(self, status, f=None, x_dict=None, y_dict=None):
+        self.status = status
+        self.f = f
+        self.x_dict = x_dict
+        self.y_dict = y_dict
+
+
+class Backend(with_metaclass(ABCMeta, object)):
+
+    @abstractmethod
+    def checkout(self, biomodel, modification=None):
+        """
+        context manager loading the model
+
+        :param biomodel: `kepavi.user.models.Biomodel`
+        :param modification: `kepavi.user.models.BiomodelModification`
+                             applied to the model
+        :return: function taking `objectives`, `user_params` and
+                 `optimize_sense`, None if the model could not be loaded
+        """
+
+    def solve(self, biomodel, objectives, user_params, optimize_sense='maximize', modification=None):
+        """:return: solution, None if the model could not be loaded"""
+
+        with self.checkout(biomodel, modification) as fba:
+            return fba(objectives, user_params, optimize_sense) if fba is not None else None
+
+
+@solver('cobra')
+class CobraSolver(Backend):
+
+    @contextmanager
+    def checkout(self, biomodel, modification=None):
+        from kepavi.cobra_utils import _launch_fba
+
+        with biomodel.checkout_cobra_model(modification) as sbml_model:
+            yield partial(_launch_fba, sbml_model) if sbml_model is not None else None
+
+
+# linprog statuses, see `scipy.optimize.OptimizeResult`
+_LINPROG_STATUS = {0: 'optimal',
+                   1: 'iteration_limit',
+                   2: 'infeasible',
+                   3: 'unbounded',
+                   4: 'failed'}
+
+
+def _linprog_method():
+    """
+    best method of the installed scipy
+
+    :raise ValueError: scipy older than 1.0, which only has a dense simplex
+    """
+
+    # major and minor, pre-release suffixes ignored
+    version = tuple(int(part) for part in re.findall(r'\d+', scipy.__version__)[:2])
+    if version >= (1, 6):
+        return 'highs', {}
+    if version >= (1, 0):
+        return 'interior-point', {'sparse': True}
+    raise ValueError('the linprog FBA solver needs scipy 1.0 or later, {} is installed'.format(scipy.__version__))
+
+
+@solver('linprog')
+class LinprogSolver(Backend):
+
+    def __init__(self):
+        self.method, self.options = _linprog_method()
+        if self.method != 'highs':
+            logging.warn('HiGHS not available in scipy {}, using linprog {}'.format(scipy.__version__,
+                                                                                     self.method))
+
+    @contextmanager
+    def checkout(self, biomodel, modification=None):
+        if modification is not None:
+            # patches are applied to cobra models only
+            with CobraSolver().checkout(biomodel, modification) as fba:
+                yield fba
+            return
+
+        arrays = biomodel.get_model_arrays()
+        yield partial(self.solve_arrays, arrays) if arrays is not None else None
+
+    def solve_arrays(self, arrays, objectives, user_params, optimize_sense='maximize'):
+        """
+        same parameters as `kepavi.cobra_utils._launch_fba`, applied to
+        copies of the bound and objective vectors
+
+        :param arrays: `kepavi.stoichiometry.ModelArrays`
+        """
+
+        from scipy.optimize import linprog
+        from kepavi.cobra_utils import _warn_unresolved
+
+        objective_names = [str(obj['name']) for obj in objectives]
+        constraint_names = [str(params['name']) for params in user_params]
+        indices, missing, duplicated = arrays.resolve_reactions(objective_names + constraint_names)
+        _warn_unresolved(missing, duplicated)
+
+        c = np.array(arrays.objective, dtype=np.float64)
+        lower_bounds = np.array(arrays.lower_bounds, dtype=np.float64)
+        upper_bounds = np.array(arrays.upper_bounds, dtype=np.float64)
+        for name in objective_names:
+            if name in indices:
+                c[indices[name]] = 1.
+        for name, params in zip(constraint_names, user_params):
+            if name in indices:
+                lower_bounds[indices[name]] = params['lower_bound']
+                upper_bounds[indices[name]] = params['upper_bound']
+
+        if (lower_bounds > upper_bounds).any():
+            return Solution('infeasible')
+
+        # linprog minimizes
+        sign = -1. if optimize_sense == 'maximize' else 1.
+        res = linprog(sign * c,
+                      A_eq=arrays.S,
+                      b_eq=np.zeros(arrays.n_metabolites),
+                      bounds=np.column_stack((lower_bounds, upper_bounds)),
+                      method=self.method,
+                      options=self.options)
+
+        status = _LINPROG_STATUS.get(res.status, 'failed')
+        if status != 'optimal':
+            return Solution(status)
+
+        x_dict = dict(zip(arrays.reaction_ids, res.x.tolist()))
+        y_dict = None
+        eqlin = getattr(res, 'eqlin', None)
+        if eqlin is not None:
+            # sensitivity of the minimized objective, back to the asked sense
+            y_dict = dict(zip(arrays.metabolite_ids, (sign * eqlin.marginals).tolist()))
+        return Solution(status, sign * res.fun, x_dict, y_dict)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.stoichiometry
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Array view of a model: sparse stoichiometric matrix, bound vectors
+    and reaction/metabolite indexes. Written once per `Biomodel` content
+    version as plain `.npy` files so every worker can memory map them.
+
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import scipy.sparse
+
+from kepavi.files import atomic_directory
+
+FORMAT_VERSION = 1
+
+_ARRAYS = ('S_data', 'S_indices', 'S_indptr', 'lower_bounds', 'upper_bounds', 'objective')
+
+
+def arrays_path(directory, doc_id, version):
+    """directory holding the arrays of a mongo document version"""
+
+    return os.path.join(directory, '{}-v{}'.format(doc_id, version))
+
+
+class ModelArrays(object):
+    """
+    `S` is a CSR matrix of shape (n_metabolites, n_reactions), rows and
+    columns follow `metabolite_ids` and `reaction_ids`.
+    """
+
+    def __init__(self, S, lower_bounds, upper_bounds, objective,
+                 reaction_ids, reaction_names, metabolite_ids, metabolite_names):
+        self.S = S
+        self.lower_bounds = lower_bounds
+        self.upper_bounds = upper_bounds
+        self.objective = objective
+        self.reaction_ids = reaction_ids
+        self.reaction_names = reaction_names
+        self.metabolite_ids = metabolite_ids
+        self.metabolite_names = metabolite_names
+        self._reaction_index = None
+        self._reactions_by_name = None
+        self._metabolite_index = None
+        self._S_csc = None
+
+    @property
+    def n_reactions(self):
+        return len(self.reaction_ids)
+
+    @property
+    def n_metabolites(self):
+        return len(self.metabolite_ids)
+
+    @property
+    def S_csc(self):
+        """reaction major copy of `S`, participants of a reaction are contiguous"""
+
+        if self._S_csc is None:
+            self._S_csc = self.S.tocsc()
+        return self._S_csc
+
+    @property
+    def reaction_index(self):
+        if self._reaction_index is None:
+            self._reaction_index = dict((r, i) for i, r in enumerate(self.reaction_ids))
+        return self._reaction_index
+
+    @property
+    def reactions_by_name(self):
+        """name -> list of reaction indices, names are not unique in every model"""
+
+        if self._reactions_by_name is None:
+            index = {}
+            for i, name in enumerate(self.reaction_names):
+                index.setdefault(name, []).append(i)
+            self._reactions_by_name = index
+        return self._reactions_by_name
+
+    def resolve_reactions(self, names):
+        """
+        same as `kepavi.caching.ModelView.resolve_reactions` with
+        reaction indices instead of reactions
+        """
+
+        found, missing, duplicated = {}, [], []
+        for name in names:
+            if name in found:
+                continue
+            indices = self.reactions_by_name.get(name)
+            if not indices:
+                missing.append(name)
+                continue
+            if len(indices) > 1:
+                duplicated.append(name)
+            found[name] = indices[0]
+        return found, missing, duplicated
+
+    @property
+    def metabolite_index(self):
+        if self._metabolite_index is None:
+            self._metabolite_index = dict((m, i) for i, m in enumerate(self.metabolite_ids))
+        return self._metabolite_index
+
+    def nbytes(self):
+        return (self.S.data.nbytes + self.S.indices.nbytes + self.S.indptr.nbytes +
+                3 * 8 * self.n_reactions)
+
+    @classmethod
+    def from_tables(cls, tables):
+        """build from `kepavi.snapshot.read_tables` output"""
+
+        n_metabolites, n_reactions = len(tables['metabolites']), len(tables['reactions'])
+        S = scipy.sparse.csc_matrix((np.asarray(tables['values'], dtype=np.float64),
+                                     np.asarray(tables['indices'], dtype=np.int32),
+                                     np.asarray(tables['indptr'], dtype=np.int32)),
+                                    shape=(n_metabolites, n_reactions)).tocsr()
+        bounds = np.asarray(tables['bounds'], dtype=np.float64).reshape((n_reactions, 3))
+        return cls(S,
+                   np.ascontiguousarray(bounds[:, 0]),
+                   np.ascontiguousarray(bounds[:, 1]),
+                   np.ascontiguousarray(bounds[:, 2]),
+                   [r[0] for r in tables['reactions']],
+                   [r[1] for r in tables['reactions']],
+                   [m[0] for m in tables['metabolites']],
+                   [m[1] for m in tables['metabolites']])
+
+    @classmethod
+    def from_cobra_model(cls, model):
+        metabolite_index = dict((m.id, i) for i, m in enumerate(model.metabolites))
+        indptr, indices, values = [0], [], []
+        for r in model.reactions:
+            for m, coefficient in r._metabolites.items():
+                indices.append(metabolite_index[m.id])
+                values.append(coefficient)
+            indptr.append(len(indices))
+        S = scipy.sparse.csc_matrix((np.asarray(values, dtype=np.float64),
+                                     np.asarray(indices, dtype=np.int32),
+                                     np.asarray(indptr, dtype=np.int32)),
+                                    shape=(len(model.metabolites), len(model.reactions))).tocsr()
+        return cls(S,
+                   np.array([r.lower_bound for r in model.reactions], dtype=np.float64),
+                   np.array([r.upper_bound for r in model.reactions], dtype=np.float64),
+                   np.array([r.objective_coefficient for r in model.reactions], dtype=np.float64),
+                   [r.id for r in model.reactions],
+                   [r.name for r in model.reactions],
+                   [m.id for m in model.metabolites],
+                   [m.name for m in model.metabolites])
+
+    def save(self, path):
+        """
+        write one `.npy` per array plus a json file holding ids and
+        names, in a temporary directory renamed to `path`: workers
+        saving the same model do not overwrite each other's files
+        """
+
+        if os.path.isdir(path) and not self.exists(path):
+            # left incomplete by an interrupted save
+            shutil.rmtree(path, ignore_errors=True)
+
+        arrays = {'S_data': self.S.data, 'S_indices': self.S.indices, 'S_indptr': self.S.indptr,
+                  'lower_bounds': self.lower_bounds, 'upper_bounds': self.upper_bounds,
+                  'objective': self.objective}
+        with atomic_directory(path) as tmp:
+            for name in _ARRAYS:
+                np.save(os.path.join(tmp, name + '.npy'), arrays[name])
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'version': FORMAT_VERSION,
+                           'shape': list(self.S.shape),
+                           'reaction_ids': self.reaction_ids,
+                           'reaction_names': self.reaction_names,
+                           'metabolite_ids': self.metabolite_ids,
+                           'metabolite_names': self.metabolite_names}, f)
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """arrays are memory mapped (read only) by default"""
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] > FORMAT_VERSION:
+            raise ValueError('unsupported arrays version {}'.format(meta['version']))
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+                      for name in _ARRAYS)
+        S = scipy.sparse.csr_matrix((arrays['S_data'], arrays['S_indices'], arrays['S_indptr']),
+                                    shape=tuple(meta['shape']), copy=False)
+        return cls(S,
+                   arrays['lower_bounds'],
+                   arrays['upper_bounds'],
+                   arrays['objective'],
+                   meta['reaction_ids'],
+                   meta['reaction_names'],
+                   meta['metabolite_ids'],
+                   meta['metabolite_names'])
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.topology
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Graphs drawn for a model, or for a KEGG pathway mapped on a model,
+    split in two: the topology (nodes, labels, positions, edge
+    endpoints) depends on the model only and is built once, the fluxes
+    of an analysis are gathered on it by reaction index.
+
+"""
+import numpy as np
+
+
+class Topology(object):
+    """
+    `nodes` and `edges` are the graph dicts without their flux fields.
+    `node_reactions` and `edge_reactions` hold the index, in the model
+    reactions order, of the reaction giving their flux, -1 when there is
+    none (flux 0). The `cumflux` of a node sums the absolute flux of the
+    reactions of the (`cumflux_nodes`, `cumflux_reactions`) pairs, a pair
+    being repeated as many times as it is counted.
+
+    :param reverse_unless_positive: edges go from target to source when
+                                    their flux is not positive
+    :param integer_node_flux: node fluxes are truncated to int
+    :param stats: dict describing how the graph matched the model,
+                  e.g. the pathway reactions found in the model
+    """
+
+    def __init__(self, nodes, edges, node_reactions, edge_reactions, cumflux_nodes, cumflux_reactions,
+                 reverse_unless_positive=False, integer_node_flux=False, stats=None):
+        self.nodes = nodes
+        self.edges = edges
+        self.node_reactions = np.asarray(node_reactions, dtype=np.intp)
+        self.edge_reactions = np.asarray(edge_reactions, dtype=np.intp)
+        self.cumflux_nodes = np.asarray(cumflux_nodes, dtype=np.intp)
+        self.cumflux_reactions = np.asarray(cumflux_reactions, dtype=np.intp)
+        self.reverse_unless_positive = reverse_unless_positive
+        self.integer_node_flux = integer_node_flux
+        self.stats = stats or {}
+
+    def overlay(self, flux):
+        """
+        :param flux: flux vector in the model reactions order
+        :return: dict of `node_flux`, `cumflux` and `edge_flux` arrays in
+                 the nodes and edges order
+        """
+
+        # index -1 reads the appended 0
+        flux = np.append(np.asarray(flux, dtype=np.float64), 0.)
+        node_flux = flux[self.node_reactions]
+        if self.integer_node_flux:
+            node_flux = np.trunc(node_flux).astype(np.int64)
+        cumflux = np.bincount(self.cumflux_nodes,
+                              weights=np.abs(flux[self.cumflux_reactions]),
+                              minlength=len(self.nodes))
+        return {'node_flux': node_flux,
+                'cumflux': np.trunc(cumflux).astype(np.int64),
+                'edge_flux': flux[self.edge_reactions]}
+
+    def render(self, flux):
+        """graph dict of `nodes` and `edges` holding the fluxes"""
+
+        overlay = self.overlay(flux)
+        edge_flux = overlay['edge_flux']
+        reverse = edge_flux <= 0 if self.reverse_unless_positive else np.zeros(len(edge_flux), dtype=bool)
+        sign = np.where(edge_flux < 0, 'neg', np.where(edge_flux > 0, 'pos', 'zero'))
+
+        nodes = [dict(node, flux=f, cumflux=c)
+                 for node, f, c in zip(self.nodes, overlay['node_flux'].tolist(), overlay['cumflux'].tolist())]
+        edges = []
+        for edge, f, abs_f, s, r in zip(self.edges, edge_flux.tolist(), np.abs(edge_flux).tolist(),
+                                        sign.tolist(), reverse.tolist()):
+            edge = dict(edge, flux=f, absflux=abs_f, sign=s)
+            if r:
+                edge['source'], edge['target'] = edge['target'], edge['source']
+            edges.append(edge)
+        return {'nodes': nodes, 'edges': edges}
+
+    def to_json(self):
+        """topology sent to the client, fluxes being fetched apart"""
+
+        return {'nodes': self.nodes,
+                'edges': self.edges,
+                'reverse_unless_positive': self.reverse_unless_positive}
+
+    def to_dict(self):
+        """json serializable dict, see `from_dict`"""
+
+        return {'nodes': self.nodes,
+                'edges': self.edges,
+                'node_reactions': self.node_reactions.tolist(),
+                'edge_reactions': self.edge_reactions.tolist(),
+                'cumflux_nodes': self.cumflux_nodes.tolist(),
+                'cumflux_reactions': self.cumflux_reactions.tolist(),
+                'reverse_unless_positive': self.reverse_unless_positive,
+                'integer_node_flux': self.integer_node_flux,
+                'stats': self.stats}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
@@ -7,22 +7,26 @@
 
     :copyright: (c) 2014 by the kepavi Team.
 """
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous import SignatureExpired
-from kepavi.biomodels import BiomodelMongo
+from kepavi.biomodels import BiomodelMongo, reaction_summary, kegg_index, KeggIndex
+from kepavi import diffs, snapshot
+from kepavi.stoichiometry import ModelArrays, arrays_path
+from kepavi.pathways import pathways_path, load_coverage, load_topology, match_pathways
 from kepavi.helpers import slugify
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import current_app
+from flask import current_app, g, has_request_context
 from flask_login import UserMixin
 import uuid
 
 import cobra.io
 
 # from kepavi._compat import max_integer
-from kepavi.extensions import db
+from kepavi.extensions import db, model_cache
 from kepavi.utils import random_email
 
 
@@ -76,6 +80,22 @@ class BiomodelModification(db.Model, InsertableMixin):
                                foreign_keys=[biomodel_id],
                                backref='biomodels_diffs')
 
+    def get_patch(self):
+        """`kepavi.diffs` patch on `biomodel`"""
+
+        return diffs.loads(self.diff)
+
+    def set_patch(self, patch):
+        self.diff = diffs.dumps(patch)
+
+    @classmethod
+    def from_model(cls, biomodel, model, **kwargs):
+        """modification turning `biomodel` into the cobra model `model`"""
+
+        m = cls(biomodel_id=biomodel.id, **kwargs)
+        m.set_patch(diffs.compute(biomodel.get_cobra_model(), model, biomodel.cache_key()))
+        return m
+
 
 class Biomodel(db.Model, InsertableMixin):
     __tablename__ = 'biomodels'
@@ -99,12 +119,45 @@ class Biomodel(db.Model, InsertableMixin):
 
     fbc_availabale = db.Column(db.Boolean, default=True)
 
-    def get_cobra_model(self):
-
+    def _mongo_query(self):
         if self.kegg_org is not None:
-            model = BiomodelMongo.objects(organism=self.kegg_org).first()
-        else:
-            model = BiomodelMongo.objects(name=self.name).first()
+            return BiomodelMongo.objects(organism=self.kegg_org)
+        return BiomodelMongo.objects(name=self.name)
+
+    def cache_key(self):
+        """
+        key identifying the content of this model, changes each time
+        the mongo document is replaced or its version bumped. Read once
+        per request: every cache consulted by a view asks for it.
+        """
+
+        if not has_request_context():
+            return self._load_cache_key()
+        keys = getattr(g, 'biomodel_keys', None)
+        if keys is None:
+            keys = g.biomodel_keys = {}
+        if self.id not in keys:
+            keys[self.id] = self._load_cache_key()
+        return keys[self.id]
+
+    def _load_cache_key(self):
+        # projection only, does not fetch the cobra model
+        doc = self._mongo_query().only('id', 'version').first()
+        if doc is None:
+            return None
+        return self.id, str(doc.id), doc.version or 1
+
+    def load_cobra_model(self):
+        """load the cobra model from mongodb, bypassing the cache"""
+
+        doc = self._mongo_query().only('snapshot').first()
+        if doc is not None and doc.snapshot:
+            try:
+                return snapshot.loads(doc.snapshot)
+            except Exception as e:
+                logging.error('unable to load snapshot of {}: {}'.format(self.name, e))
+
+        model = self._mongo_query().only('cobra_model').first()
 
         # try to load the cobra model
         cobra_model = None
@@ -114,10 +167,154 @@ class Biomodel(db.Model, InsertableMixin):
             logging.error(e)
         return cobra_model
 
+    def build_model_arrays(self):
+        """stoichiometric arrays computed from the snapshot (or the cobra model)"""
+
+        doc = self._mongo_query().only('snapshot').first()
+        if doc is not None and doc.snapshot:
+            return ModelArrays.from_tables(snapshot.read_tables(doc.snapshot))
+        model = self.get_cobra_model()
+        if model is None:
+            return None
+        return ModelArrays.from_cobra_model(model)
+
+    def get_model_arrays(self):
+        """memory mapped `kepavi.stoichiometry.ModelArrays`, shared by the worker"""
+
+        return model_cache.get_arrays(self)
+
+    def get_layout(self, compute=True):
+        """
+        seeded positions of the whole model graph, by metabolite index
+
+        :param compute: when False, None until the layout is written, slow
+                        to compute: the `layout` job does it
+        """
+
+        return model_cache.get_layout(self, compute)
+
+    def get_currency_mask(self):
+        """currency metabolites of the model, by metabolite index"""
+
+        return model_cache.get_currency_mask(self)
+
+    def get_reaction_summary(self):
+        """
+        name, bounds, reversibility and mass balance of each reaction,
+        read with a projection, computed and stored if missing
+        """
+
+        doc = self._mongo_query().only('id', 'reaction_summary').as_pymongo().first()
+        if doc is None:
+            return None
+        summary = doc.get('reaction_summary')
+        if not summary:
+            model = self.get_cobra_model()
+            if model is None:
+                return None
+            summary = reaction_summary(model)
+            BiomodelMongo.objects(id=doc['_id']).update_one(set__reaction_summary=summary)
+
+        return [{'name': name,
+                 'lower_bound': lb,
+                 'upper_bound': ub,
+                 'reversibility': reversibility,
+                 'check_mass_balance': balanced}
+                for name, lb, ub, reversibility, balanced in zip(summary['names'],
+                                                                 summary['lower_bounds'],
+                                                                 summary['upper_bounds'],
+                                                                 summary['reversibility'],
+                                                                 summary['mass_balanced'])]
+
+    def load_kegg_index(self):
+        """
+        `kepavi.biomodels.KeggIndex` of the model, read with a
+        projection, computed and stored if missing
+        """
+
+        doc = self._mongo_query().only('id', 'kegg_index').as_pymongo().first()
+        if doc is None:
+            return None
+        index = doc.get('kegg_index')
+        if not index:
+            model = self.get_cobra_model()
+            if model is None:
+                return None
+            index = kegg_index(model)
+            BiomodelMongo.objects(id=doc['_id']).update_one(set__kegg_index=index)
+        return KeggIndex(index)
+
+    def get_kegg_index(self):
+        """KEGG id -> reaction and metabolite indices, shared by the worker"""
+
+        return model_cache.get_kegg_index(self)
+
+    def pathways_dir(self):
+        """directory of the pathways matched against this model version, see `kepavi.pathways`"""
+
+        key = self.cache_key()
+        if key is None:
+            return None
+        return pathways_path(arrays_path(model_cache.arrays_dir, key[1], key[2]))
+
+    def get_pathway_coverage(self):
+        """pathway id -> stats of its match against the model, None until matched"""
+
+        directory = self.pathways_dir()
+        return load_coverage(directory) if directory is not None else None
+
+    def get_pathway_topology(self, pathway_id):
+        """precomputed `kepavi.topology.Topology` of a pathway, None if not matched"""
+
+        directory = self.pathways_dir()
+        return load_topology(directory, pathway_id) if directory is not None else None
+
+    def match_pathways(self):
+        """
+        match every KEGG pathway of the organism against the model,
+        slow: run by the `match_pathways` job
+
+        :return: the coverage dict, None on failure
+        """
+
+        from kepavi.kegg_utils import Kegg
+
+        arrays, index = self.get_model_arrays(), self.get_kegg_index()
+        if arrays is None or index is None or index.n_reactions != arrays.n_reactions:
+            return None
+        pathways = Kegg.get_pathways_list(self.kegg_org)
+        if not pathways:
+            return None
+        return match_pathways(self.pathways_dir(), pathways, arrays, index, Kegg.get_kgml_obj)
+
+    def get_cobra_model(self):
+        """
+        return the cobra model shared by this worker, use
+        `checkout_cobra_model` when bounds or objectives need to change
+        """
+
+        return model_cache.get(self)
+
+    @contextmanager
+    def checkout_cobra_model(self, modification=None):
+        """
+        view of the shared model, see `kepavi.caching.ModelCache.checkout`
+
+        :param modification: `BiomodelModification` of this model applied
+                             to the view
+        :raise kepavi.diffs.PatchError: the modification does not apply
+        """
+
+        with model_cache.checkout(self) as view:
+            if view is not None and modification is not None:
+                diffs.apply(view, modification.get_patch(), self.cache_key())
+            yield view
+
 
 class Analysis(db.Model, InsertableMixin):
     __tablename__ = 'analysis'
-    KIND = ('Flux balance analysis', 'Annotation & Database search')
+    KIND = ('Flux balance analysis', 'Annotation & Database search', 'Flux variability analysis',
+            'Knockout screening')
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -127,6 +324,10 @@ class Analysis(db.Model, InsertableMixin):
     results_url = db.Column(db.String(200))
     results_content = db.Column(db.Text)
 
+    # `kepavi.cobra_utils.fba_inputs_hash`, analyses with the same hash
+    # share their results
+    results_hash = db.Column(db.String(40), index=True)
+
     model_id = db.Column(db.Integer, db.ForeignKey('biomodels.id'))
     model = db.relationship('Biomodel', foreign_keys=[model_id], backref='analysis')
 
@@ -139,10 +340,81 @@ class Analysis(db.Model, InsertableMixin):
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
     project = db.relationship('Project', foreign_keys=[project_id], backref='analysis')
 
+    # batch analyses have one child per scenario
+    parent_id = db.Column(db.Integer, db.ForeignKey('analysis.id'), nullable=True)
+    parent = db.relationship('Analysis', foreign_keys=[parent_id], remote_side=[id], backref='children')
+
     @property
     def slug(self):
         return slugify(self.title)
 
+    def progress(self):
+        """fraction of the jobs of this analysis which are finished"""
+
+        jobs = self.jobs
+        if not jobs:
+            return 1.
+        return float(sum(1 for j in jobs if not j.is_pending)) / len(jobs)
+
+    def cancel(self):
+        """
+        cancel the pending jobs of the analysis, running ones are killed
+        by their worker (see `kepavi.jobs.run_limited`)
+
+        :return: False if nothing was pending
+        """
+
+        pending = [j for j in self.jobs if j.is_pending]
+        if not pending:
+            return False
+        now = datetime.utcnow()
+        for job in pending:
+            job.status = 'cancelled'
+            job.end_date = now
+        for analysis in [self] + self.children:
+            if analysis.results_url is None:
+                analysis.results_content = 'cancelled'
+        db.session.commit()
+        return True
+
+
+class Job(db.Model, InsertableMixin):
+    """asynchronous computation, see `kepavi.jobs`"""
+
+    __tablename__ = 'jobs'
+    STATUS = ('queued', 'running', 'done', 'failed', 'timeout', 'cancelled')
+    PENDING = ('queued', 'running')
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), default=STATUS[0], nullable=False)
+    creation_date = db.Column(db.DateTime, default=datetime.utcnow)
+    start_date = db.Column(db.DateTime)
+    end_date = db.Column(db.DateTime)
+
+    # json encoded task parameters and partial results
+    payload = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user = db.relationship('User', foreign_keys=[user_id], backref='jobs')
+
+    analysis_id = db.Column(db.Integer, db.ForeignKey('analysis.id'), nullable=True)
+    analysis = db.relationship('Analysis', foreign_keys=[analysis_id], backref='jobs')
+
+    @property
+    def is_pending(self):
+        return self.status in Job.PENDING
+
+    def to_dict(self):
+        return {'id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'error': self.error,
+                'analysis_id': self.analysis_id,
+                'progress': self.analysis.progress() if self.analysis is not None else 1.}
+
 
 class Project(db.Model, InsertableMixin):
     __tablename__ = 'projects'
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.user.tasks
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Analyses run by `kepavi.jobs` worker processes.
+
+"""
+import json
+import logging
+
+from flask import current_app
+
+from kepavi.cobra_utils import _launch_fba_batch, FVAProblem, KnockoutProblem, reactions_hash
+from kepavi.diffs import PatchError
+from kepavi.extensions import db
+from kepavi.jobs import task, run_limited, JobError
+from kepavi.results import dumps as dumps_results
+from kepavi.solvers import get_solver
+from kepavi.user.models import Analysis, Biomodel, Job
+from kepavi.utils import s3_upload_from_memory
+
+
+def results_path(analysis):
+    """s3 key of the analysis results"""
+
+    return '{}/{}/{}'.format(analysis.project.user.username, analysis.project_id, analysis.id)
+
+
+def store_results(analysis, results):
+    """
+    upload the results in the `kepavi.results` binary format, aligned
+    to the model arrays, and record their url on the analysis
+    """
+
+    results_url = results_path(analysis)
+
+    arrays = analysis.model.get_model_arrays()
+    data = dumps_results(results,
+                         arrays.reaction_ids if arrays is not None else None,
+                         arrays.metabolite_ids if arrays is not None else None,
+                         compress=current_app.config['RESULTS_COMPRESS'])
+
+    # upload to s3
+    logging.info('uploading to s3')
+    s3_upload_from_memory(data, destination_filename=results_url)
+    analysis.results_url = results_url
+
+
+def _solution_to_dict(solution):
+    return {'status': solution.status, 'objective_value': solution.f,
+            'x_dict': solution.x_dict, 'y_dict': solution.y_dict}
+
+
+def _solve(fba, *args):
+    return _solution_to_dict(fba(*args))
+
+
+def _solve_batch(sbml_model, scenarios):
+    return [_solution_to_dict(solution) for solution in _launch_fba_batch(sbml_model, scenarios)]
+
+
+@task('fba')
+def run_fba(job):
+    data = json.loads(job.payload)
+    analysis = job.analysis
+    model = analysis.model
+
+    # have often exception here du to encoding issues
+    try:
+        with get_solver().checkout(model, analysis.model_diff) as fba:
+            if fba is None:
+                raise JobError('unable to load model {}'.format(model.name))
+            results = run_limited(job, _solve, fba,
+                                  data['objective_functions'],
+                                  data['constraints'])
+    except PatchError as e:
+        raise JobError(str(e))
+
+    # dump solution
+    store_results(analysis, results)
+
+    # finally save analysis object
+    logging.info('saving analysis')
+    analysis.results_content = results['status']
+    analysis.save()
+
+
+@task('fba_batch')
+def run_fba_batch(job):
+    """one child analysis per scenario of the parent analysis"""
+
+    data = json.loads(job.payload)
+    parent = job.analysis
+    model = parent.model
+    children = sorted(parent.children, key=lambda a: a.id)
+
+    n_optimal = 0
+    try:
+        with model.checkout_cobra_model(parent.model_diff) as sbml_model:
+            if sbml_model is None:
+                raise JobError('unable to load model {}'.format(model.name))
+
+            solutions = run_limited(job, _solve_batch, sbml_model, data['scenarios'])
+    except PatchError as e:
+        raise JobError(str(e))
+
+    for child, results in zip(children, solutions):
+        store_results(child, results)
+        child.results_content = results['status']
+        child.save()
+        if results['status'] == 'optimal':
+            n_optimal += 1
+
+    parent.results_content = '{}/{} optimal'.format(n_optimal, len(children))
+    parent.save()
+
+
+@task('match_pathways')
+def match_pathways(job):
+    """KEGG pathways of a model organism matched against the model, see `kepavi.pathways`"""
+
+    data = json.loads(job.payload)
+    biomodel = Biomodel.query.filter(Biomodel.id == data['biomodel_id']).first()
+    if biomodel is None:
+        raise JobError('unknown model {}'.format(data['biomodel_id']))
+    coverage = biomodel.match_pathways()
+    if coverage is None:
+        raise JobError('unable to match the pathways of model {}'.format(biomodel.name))
+    job.result = json.dumps({'pathways': len(coverage)})
+
+
+@task('layout')
+def compute_layout(job):
+    """layout of the whole model graph, see `kepavi.caching.ModelCache.get_layout`"""
+
+    data = json.loads(job.payload)
+    biomodel = Biomodel.query.filter(Biomodel.id == data['biomodel_id']).first()
+    if biomodel is None:
+        raise JobError('unknown model {}'.format(data['biomodel_id']))
+    if biomodel.get_layout() is None:
+        raise JobError('unable to lay out model {}'.format(biomodel.name))
+
+
+def _build_and_solve(sbml_model, factory, expected_reactions, method, args):
+    try:
+        problem = factory(sbml_model)
+    except ValueError as e:
+        raise JobError(str(e))
+    # indices were read from the model arrays when the analysis was queued
+    if reactions_hash(problem.reaction_ids) != expected_reactions:
+        raise JobError('the model reactions changed since the analysis was queued')
+    return _solution_to_dict(problem.fba_solution), problem.reaction_ids, getattr(problem, method)(*args)
+
+
+def _run_chunk(job, factory, method, *args):
+    """
+    build the problem of the chunk analysis and solve the chunk, both in
+    a `run_limited` child: the reference FBA solve is bounded like the
+    chunk solves. The problem reactions are checked against the
+    `reactions_hash` of the payload, the order chunk indices refer to.
+
+    :param factory: function building the problem from a model view
+    :param method: name of the problem method solving the chunk, called
+                   with `args`
+    :return: (reference FBA solution dict, reaction ids of the problem,
+             chunk results)
+    """
+
+    model = job.analysis.model
+    with model.checkout_cobra_model() as sbml_model:
+        if sbml_model is None:
+            raise JobError('unable to load model {}'.format(model.name))
+        return run_limited(job, _build_and_solve, sbml_model, factory,
+                           json.loads(job.payload).get('reactions_hash'), method, args)
+
+
+def _claim_chunks(analysis, kind):
+    """
+    results of every chunk job of the analysis once they are all done,
+    None if some are missing or another worker already claimed them.
+    """
+
+    chunks = Job.query.filter(Job.analysis_id == analysis.id, Job.kind == kind)
+    if chunks.filter(Job.result == None).count():  # noqa
+        return None
+
+    # the last chunks may finish together, only one of them assembles
+    claimed = Analysis.query.filter(Analysis.id == analysis.id,
+                                    Analysis.results_content != 'assembling')\
+                            .update({'results_content': 'assembling'}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return None
+    return [json.loads(chunk.result) for chunk in chunks.order_by(Job.id)]
+
+
+@task('fva_chunk')
+def run_fva_chunk(job):
+    """
+    minimum and maximum fluxes of the reactions in [start, stop), kept
+    in `job.result` until every chunk of the analysis is done
+    """
+
+    data = json.loads(job.payload)
+    analysis = job.analysis
+    fraction_of_optimum = data.get('fraction_of_optimum', 1.)
+
+    def factory(sbml_model):
+        return FVAProblem(sbml_model,
+                          data['objective_functions'],
+                          data['constraints'],
+                          fraction_of_optimum=fraction_of_optimum,
+                          optimize_sense=data.get('optimize_sense', 'maximize'))
+
+    fba, _, result = _run_chunk(job, factory, 'variability', range(data['start'], data['stop']))
+    job.result = json.dumps(result)
+    job.save()
+
+    chunks = _claim_chunks(analysis, 'fva_chunk')
+    if chunks is None:
+        return
+
+    minimum, maximum = {}, {}
+    for result in chunks:
+        minimum.update(result['minimum'])
+        maximum.update(result['maximum'])
+
+    d = dict(fba)
+    d.update({'fraction_of_optimum': fraction_of_optimum,
+              'minimum': minimum,
+              'maximum': maximum})
+    store_results(analysis, d)
+
+    analysis.results_content = fba['status']
+    analysis.save()
+
+
+@task('knockout_chunk')
+def run_knockout_chunk(job):
+    """
+    growth ratio of the single deletions of reactions in [start, stop)
+    or of the double deletions listed in `pairs` (reaction indices)
+    """
+
+    data = json.loads(job.payload)
+    analysis = job.analysis
+
+    def factory(sbml_model):
+        return KnockoutProblem(sbml_model,
+                               data['objective_functions'],
+                               data['constraints'],
+                               optimize_sense=data.get('optimize_sense', 'maximize'))
+
+    if 'pairs' in data:
+        result = {'pairs': data['pairs']}
+        fba, reaction_ids, result['ratios'] = _run_chunk(job, factory, 'double_deletions', data['pairs'])
+    else:
+        result = {'start': data['start']}
+        fba, reaction_ids, result['ratios'] = _run_chunk(job, factory, 'single_deletions',
+                                                         range(data['start'], data['stop']))
+    job.result = json.dumps(result)
+    job.save()
+
+    chunks = _claim_chunks(analysis, 'knockout_chunk')
+    if chunks is None:
+        return
+
+    # growth ratio matrix: diagonal holds the single deletions, stored
+    # as a dense vector, double deletions as sparse coordinates
+    single = [None] * len(reaction_ids)
+    rows, cols, ratios = [], [], []
+    for result in chunks:
+        if 'pairs' in result:
+            for (i, j), ratio in zip(result['pairs'], result['ratios']):
+                rows.append(i)
+                cols.append(j)
+                ratios.append(ratio)
+        else:
+            single[result['start']:result['start'] + len(result['ratios'])] = result['ratios']
+
+    d = {'status': fba['status'],
+         'objective_value': fba['objective_value'],
+         'reaction_ids': reaction_ids,
+         'single': single,
+         'double': {'rows': rows, 'cols': cols, 'ratios': ratios},
+         # overlaid on the networks in place of the fluxes
+         'x_dict': dict((r, ratio or 0.) for r, ratio in zip(reaction_ids, single))}
+    store_results(analysis, d)
+
+    analysis.results_content = fba['status']
+    analysis.save()
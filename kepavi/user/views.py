@@ -12,24 +12,26 @@ import json
 import logging
 # import cobra
 # from kepavi.biomodels import BiomodelMongo
-from kepavi.cobra_utils import _launch_fba, build_kegg_network_mixed,\
-                               _build_genome_scale_network
+from kepavi.cobra_utils import genome_scale_topology, kegg_pathway_topology, flux_vector, fba_inputs_hash, \
+    reactions_hash
+from kepavi.extensions import db, job_queue, solution_cache, results_cache, topology_cache
+from kepavi.jobs import QueueFull
 from kepavi.kegg_utils import Kegg, Organism
-from kepavi.utils import s3_upload_from_server, download_from_s3
+from kepavi.results import to_json as results_to_json
+from kepavi.utils import download_from_s3
+from kepavi import wire
 from kepavi.private_keys import S3_URL
-import os
 # from datetime import datetime
 
 from kepavi.user.forms import CreateProjectForm, CreateFBAAnalysisForm
-from kepavi.user.models import Project, Analysis, User, Biomodel
+from kepavi.user.models import Project, Analysis, User, Biomodel, Job
+# registers the analyses run by the job queue
+from kepavi.user import tasks
 from kepavi.auth.forms import LoginForm
 
-import requests
-from flask import Blueprint, flash, request, redirect, url_for, render_template, Response
+from flask import Blueprint, flash, request, redirect, url_for, render_template, Response, current_app
 from flask_login import login_required, current_user
 
-from requests.packages.urllib3.exceptions import ConnectionError
-
 
 user = Blueprint("user", __name__, template_folder="../templates")
 
@@ -88,26 +90,40 @@ def get_sbml_reactions(username):
     # if model is None:
     #     return render_template('errors/page_not_found.html')
 
-    logging.info('loading model from mongodb...')
-    # TODO get the sbml model from mongodb
-    sbml_model = model.get_cobra_model()
-    if sbml_model is None:
+    logging.info('loading reactions summary from mongodb...')
+    summary = model.get_reaction_summary()
+    if summary is None:
         return render_template('errors/server_error.html', form=LoginForm())
-    d = []
-    for r in sbml_model.reactions:
-        d.append({
-            'name': r.name,
-            'lower_bound': r.lower_bound,
-            'upper_bound': r.upper_bound,
-            'reversibility': r.reversibility,
-            'check_mass_balance': not bool(r.check_mass_balance())
-        })
-    return json.dumps(d)
+    return json.dumps(summary)
+
+
+def _get_model(model_name):
+    """
+    :return: (biomodel, modification) the name stands for, a model
+             modified by the current user or a base model
+    """
+
+    for modification in current_user.biomodels_diffs:
+        if modification.title == model_name:
+            return modification.biomodel, modification
+    return Biomodel.query.filter(Biomodel.name == model_name).first_or_404(), None
+
+
+def _chunks(n, max_size):
+    """
+    (start, stop) ranges splitting `n` items between the `JOBS_PROCESSES`
+    worker processes, at most `max_size` items each
+    """
+
+    size = max(1, min(max_size, -(-n // current_app.config['JOBS_PROCESSES'])))
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
 
 
 @user.route('/<username>/launch_fba', methods=['POST'])
 @login_required
 def launch_fba(username):
+    """enqueue the analysis, solved by `kepavi.user.tasks.run_fba`"""
+
     data = request.get_json(force=True)
 
     logging.debug(data)
@@ -116,59 +132,253 @@ def launch_fba(username):
     project_id = data['project_id']
     title = data['title']
 
-    model = Biomodel.query.filter(Biomodel.name == model_name).first_or_404()
-
-    # have often exception here du to encoding issues
-    sbml_model = model.get_cobra_model()
-    if sbml_model is None:
-        return render_template('errors/server_error.html', form=LoginForm())
-
-    solution = _launch_fba(sbml_model,
-                           data['objective_functions'],
-                           data['constraints'])
+    model, modification = _get_model(model_name)
 
     # create analysis object
     a = Analysis(title=data['title'],
                  kind=Analysis.KIND[0],
                  model_id=model.id,
+                 model_diff_id=modification.id if modification is not None else None,
+                 project_id=project_id)
+    a.results_content = 'queued'
+    a.serialized_properties = json.dumps(data)
+
+    model_key = model.cache_key()
+    if model_key is not None:
+        if modification is not None:
+            model_key += (modification.diff,)
+        a.results_hash = fba_inputs_hash(model_key,
+                                         current_app.config['FBA_SOLVER'],
+                                         data['objective_functions'],
+                                         data['constraints'])
+        solved = solution_cache.lookup(a.results_hash)
+        if solved is not None:
+            # same inputs already solved, share the stored results
+            a.results_url, a.results_content = solved
+            a.save()
+            flash('FBA analysis {} saved...'.format(title), 'success')
+            return json.dumps({'redirect': url_for('user.project', username=username,
+                                                   project_id=project_id, slug=a.project.slug)})
+
+    job = Job(kind='fba', user_id=current_user.id, payload=a.serialized_properties)
+    try:
+        a.save()
+        job.analysis_id = a.id
+        job_queue.submit(job)
+    except QueueFull:
+        a.delete()
+        return json.dumps({'error': 'Too many analyses are running, please retry later.'}), 503
+
+    flash('FBA analysis {} queued...'.format(title), 'success')
+
+    return json.dumps({'redirect': url_for('user.project', username=username,
+                                           project_id=project_id, slug=a.project.slug),
+                       'job_id': job.id,
+                       'status_url': url_for('user.job_status', username=username, job_id=job.id)})
+
+
+@user.route('/<username>/launch_fba_batch', methods=['POST'])
+@login_required
+def launch_fba_batch(username):
+    """
+    same model solved for several scenarios, each one holding
+    `objective_functions`, `constraints` and optionally `optimize_sense`
+    and `title`. Solved by `kepavi.user.tasks.run_fba_batch`.
+    """
+
+    data = request.get_json(force=True)
+
+    project_id = data['project_id']
+    scenarios = data.get('scenarios') or []
+    if not 0 < len(scenarios) <= current_app.config['FBA_BATCH_MAX_SCENARIOS']:
+        return json.dumps({'error': 'Between 1 and {} scenarios are expected.'.format(
+            current_app.config['FBA_BATCH_MAX_SCENARIOS'])}), 400
+
+    model, modification = _get_model(data['model'])
+
+    parent = Analysis(title=data['title'],
+                      kind=Analysis.KIND[0],
+                      model_id=model.id,
+                      model_diff_id=modification.id if modification is not None else None,
+                      project_id=project_id)
+    parent.results_content = 'queued'
+    parent.serialized_properties = json.dumps(data)
+    parent.save()
+
+    for i, scenario in enumerate(scenarios):
+        child = Analysis(title=scenario.get('title') or '{} #{}'.format(data['title'], i + 1),
+                         kind=Analysis.KIND[0],
+                         model_id=model.id,
+                         model_diff_id=parent.model_diff_id,
+                         project_id=project_id,
+                         parent_id=parent.id)
+        child.results_content = 'queued'
+        child.serialized_properties = json.dumps(scenario)
+        db.session.add(child)
+    db.session.commit()
+
+    job = Job(kind='fba_batch', user_id=current_user.id, analysis_id=parent.id,
+              payload=parent.serialized_properties)
+    try:
+        job_queue.submit(job)
+    except QueueFull:
+        for child in parent.children:
+            db.session.delete(child)
+        parent.delete()
+        return json.dumps({'error': 'Too many analyses are running, please retry later.'}), 503
+
+    return json.dumps({'redirect': url_for('user.project', username=username,
+                                           project_id=project_id, slug=parent.project.slug),
+                       'analysis_id': parent.id,
+                       'job_id': job.id,
+                       'status_url': url_for('user.job_status', username=username, job_id=job.id)})
+
+
+@user.route('/<username>/launch_fva', methods=['POST'])
+@login_required
+def launch_fva(username):
+    """
+    flux variability analysis, same parameters as `launch_fba` plus
+    `fraction_of_optimum`. Reactions are split between the worker
+    processes, in chunks of at most `FVA_CHUNK_SIZE`, solved in parallel
+    by `kepavi.user.tasks.run_fva_chunk`. Modified models are refused,
+    chunks are ranges of the base model reactions.
+    """
+
+    data = request.get_json(force=True)
+
+    project_id = data['project_id']
+    model, modification = _get_model(data['model'])
+    if modification is not None:
+        return json.dumps({'error': 'FVA of modified models is not supported.'}), 400
+
+    arrays = model.get_model_arrays()
+    if arrays is None:
+        return json.dumps({'error': 'Unable to load model {}.'.format(model.name)}), 500
+
+    a = Analysis(title=data['title'],
+                 kind=Analysis.KIND[2],
+                 model_id=model.id,
                  project_id=project_id)
-    a.results_content = solution.status
+    a.results_content = 'queued'
     a.serialized_properties = json.dumps(data)
-    # in order to populate its id field
     a.save()
 
-    # building several path local and s3 path
-    filename = "{}-{}-{}".format(username, project_id, a.id)
-    results_url = filename.replace('-', '/')
+    # chunks are ranges of this reaction order
+    parameters = dict(data, reactions_hash=reactions_hash(arrays.reaction_ids))
+    jobs = []
+    for start, stop in _chunks(arrays.n_reactions, current_app.config['FVA_CHUNK_SIZE']):
+        payload = dict(parameters, start=start, stop=stop)
+        jobs.append(Job(kind='fva_chunk', user_id=current_user.id, analysis_id=a.id,
+                        payload=json.dumps(payload)))
+    try:
+        job_queue.submit(*jobs)
+    except QueueFull:
+        a.delete()
+        return json.dumps({'error': 'Too many analyses are running, please retry later.'}), 503
+
+    flash('FVA analysis {} queued...'.format(data['title']), 'success')
 
-    # dump solution to file
-    d = {'status': solution.status, 'objective_value': solution.f,
-         'x_dict': solution.x_dict, 'y_dict': solution.y_dict}
+    return json.dumps({'redirect': url_for('user.project', username=username,
+                                           project_id=project_id, slug=a.project.slug),
+                       'analysis_id': a.id,
+                       'job_id': jobs[0].id,
+                       'status_url': url_for('user.job_status', username=username, job_id=jobs[0].id)})
+
+
+@user.route('/<username>/launch_knockouts', methods=['POST'])
+@login_required
+def launch_knockouts(username):
+    """
+    knockout screening: every single reaction deletion plus the double
+    deletions listed in `double_deletions` (pairs of reaction names),
+    other parameters as in `launch_fba`. Deletions are split between the
+    worker processes, in chunks of at most `KNOCKOUT_CHUNK_SIZE`, solved
+    by `kepavi.user.tasks.run_knockout_chunk`. Modified models are
+    refused, deletions are indices of the base model reactions.
+    """
 
-    with open(filename, 'w') as f:
-        f.write(json.dumps(d).encode('utf-8'))
+    data = request.get_json(force=True)
 
-    # upload to s3
-    logging.info('uploading to s3')
-    s3_upload_from_server(filename, destination_filename=results_url)
+    project_id = data['project_id']
+    model, modification = _get_model(data['model'])
+    if modification is not None:
+        return json.dumps({'error': 'Knockout screening of modified models is not supported.'}), 400
+
+    arrays = model.get_model_arrays()
+    if arrays is None:
+        return json.dumps({'error': 'Unable to load model {}.'.format(model.name)}), 500
+
+    index_by_name = {}
+    for i, name in enumerate(arrays.reaction_names):
+        index_by_name.setdefault(name, i)
+    pairs, unknown = [], set()
+    for name_a, name_b in data.get('double_deletions', []):
+        if name_a in index_by_name and name_b in index_by_name:
+            pairs.append([index_by_name[name_a], index_by_name[name_b]])
+        else:
+            unknown.update(n for n in (name_a, name_b) if n not in index_by_name)
+    if unknown:
+        return json.dumps({'error': 'Unknown reactions: {}'.format(', '.join(sorted(unknown)))}), 400
 
-    # finally save analysis object
-    logging.info('saving analysis')
-    a.results_url = results_url
+    a = Analysis(title=data['title'],
+                 kind=Analysis.KIND[3],
+                 model_id=model.id,
+                 project_id=project_id)
+    a.results_content = 'queued'
+    a.serialized_properties = json.dumps(data)
     a.save()
 
-    # remove created file
-    logging.info('removing created file...')
+    # each chunk only carries its own deletions
+    parameters = dict((k, v) for k, v in data.items() if k != 'double_deletions')
+    parameters['reactions_hash'] = reactions_hash(arrays.reaction_ids)
+    chunk_size = current_app.config['KNOCKOUT_CHUNK_SIZE']
+    payloads = [dict(parameters, start=start, stop=stop)
+                for start, stop in _chunks(arrays.n_reactions, chunk_size)]
+    payloads += [dict(parameters, pairs=pairs[start:stop])
+                 for start, stop in _chunks(len(pairs), chunk_size)]
+    jobs = [Job(kind='knockout_chunk', user_id=current_user.id, analysis_id=a.id, payload=json.dumps(p))
+            for p in payloads]
     try:
-        os.remove(filename)
-        logging.warn('Done')
-    except OSError:
-        logging.warn('Enable to remove "{}"'.format(filename))
-        logging.warn('Failed !')
+        job_queue.submit(*jobs)
+    except QueueFull:
+        a.delete()
+        return json.dumps({'error': 'Too many analyses are running, please retry later.'}), 503
+
+    flash('Knockout screening {} queued...'.format(data['title']), 'success')
+
+    return json.dumps({'redirect': url_for('user.project', username=username,
+                                           project_id=project_id, slug=a.project.slug),
+                       'analysis_id': a.id,
+                       'job_id': jobs[0].id,
+                       'status_url': url_for('user.job_status', username=username, job_id=jobs[0].id)})
+
+
+@user.route('/<username>/jobs/<int:job_id>')
+@login_required
+def job_status(username, job_id):
+    job = Job.query.filter(Job.id == job_id, Job.user_id == current_user.id).first_or_404()
+    return json.dumps(job.to_dict())
 
-    flash('FBA analysis {} saved...'.format(title), 'success')
 
-    return json.dumps({'redirect': url_for('user.profile', username=username)})
+@user.route('/<username>/analysis/<int:analysis_id>/cancel', methods=['POST'])
+@login_required
+def cancel_analysis(username, analysis_id):
+    """cancel a queued or running analysis"""
+
+    analysis = Analysis.query.filter(Analysis.id == analysis_id).first_or_404()
+    if analysis.project.user_id != current_user.id:
+        return json.dumps({'error': 'Not allowed.'}), 403
+    if not analysis.cancel():
+        return json.dumps({'error': 'Analysis {} is not running.'.format(analysis.title)}), 409
+    return json.dumps({'status': 'cancelled'})
+
+
+def _get_results(analysis):
+    """stored results of the analysis through the results cache, None on failure"""
+
+    return results_cache.get(analysis.results_url,
+                             lambda: download_from_s3(S3_URL, analysis.results_url, binary=True))
 
 
 @user.route("/<username>/visualize/<int:analysis_id>")
@@ -180,12 +390,13 @@ def visualize_fba_analysis(username, analysis_id):
     """
     analysis = Analysis.query.filter(Analysis.id == analysis_id).first_or_404()
 
-    # retrieve file data from s3
-    filename = '{}/{}/{}'.format(username, analysis.project_id, analysis_id)
-    resp = requests.get(S3_URL + filename)
+    if analysis.results_url is None:
+        flash('Analysis {} is not finished yet'.format(analysis.title), 'info')
+        return redirect(url_for('user.project', username=username,
+                                project_id=analysis.project_id, slug=analysis.project.slug))
 
-    # return error code if request failed
-    if resp.status_code != 200:
+    # retrieve file data from s3, kept for the following get_kgml calls
+    if _get_results(analysis) is None:
         return render_template('errors/server_error.html'), 500
 
     orgs = Organism.query.order_by(Organism.tax).all()
@@ -193,12 +404,35 @@ def visualize_fba_analysis(username, analysis_id):
     model = analysis.model
     model_name = model.name
     pathways = Kegg.get_pathways_list(org=model.kegg_org)
+    coverage = model.get_pathway_coverage()
+    if coverage is None:
+        # pathways are matched on the fly meanwhile
+        _queue_model_job('match_pathways', model)
     return render_template('user/fba_analysis.html',
                            analysis=analysis, organisms=orgs,
                            model_name=model_name, pathways=pathways,
+                           coverage=coverage or {},
                            display_sidebar=False)
 
 
+def _queue_model_job(kind, biomodel):
+    """
+    queue a job computing data of the whole model, `match_pathways` or
+    `layout`, unless it is already queued
+    """
+
+    payload = json.dumps({'biomodel_id': biomodel.id})
+    pending = Job.query.filter(Job.kind == kind,
+                               Job.status.in_(Job.PENDING),
+                               Job.payload == payload).first()
+    if pending is not None:
+        return
+    try:
+        job_queue.submit(Job(kind=kind, user_id=current_user.id, payload=payload))
+    except QueueFull:
+        logging.info('{} of {} not queued: queue full'.format(kind, biomodel.name))
+
+
 @user.route('/<username>/get_kegg_pathways', methods=['GET'])
 def get_kegg_pathways(username):
     org = request.args.get('org', 'hsa')  # the default will be the human.
@@ -207,64 +441,151 @@ def get_kegg_pathways(username):
     return data
 
 
-@user.route('/<username>/get_kgml', methods=['GET'])
-@login_required
-def get_kgml(username):
+def _get_topology(biomodel, pathway_id):
     """
-    main function to visualize network
-    return json encoded graph
+    topology of the whole model graph or of a kegg pathway drawn with
+    the model, through the topology cache, None on failure
+    """
+
+    def build():
+        arrays = biomodel.get_model_arrays()
+        if arrays is None:
+            return None
+        if pathway_id == 'whole':
+            # from the stoichiometric matrix only
+            positions = biomodel.get_layout(compute=False)
+            topology = genome_scale_topology(arrays, positions, biomodel.get_currency_mask())
+            if positions is None:
+                # random positions until the layout job is done
+                _queue_model_job('layout', biomodel)
+                topology.stats['layout'] = 'pending'
+            return topology
+
+        # matched by the background job
+        topology = biomodel.get_pathway_topology(pathway_id)
+        if topology is not None:
+            return topology
+
+        kegg_index = biomodel.get_kegg_index()
+        kegg_model = Kegg.get_kgml_obj(pathway_id)
+        if kegg_index is None or kegg_model is None:
+            return None
+        if kegg_index.n_reactions != arrays.n_reactions:
+            logging.error('kegg index of {} does not match its arrays'.format(biomodel.name))
+            return None
+        return kegg_pathway_topology(kegg_model, arrays, kegg_index)
+
+    return topology_cache.get(biomodel, pathway_id, build)
+
+
+def _get_graph_inputs(with_flux=True):
+    """
+    analysis, topology and fluxes of the `analysis_id` and `pathway_id`
+    request arguments, or the error response
+
+    :param with_flux: when False only the analysis model is resolved,
+                      the results are not downloaded and the fluxes are
+                      None
     """
 
     pathway_id = request.args.get('pathway_id')
     if pathway_id is None:
-        return json.dumps([])
+        return None, json.dumps([])
 
     analysis_id = request.args.get('analysis_id')
     analysis = Analysis.query.filter(Analysis.id == analysis_id).first_or_404()
 
-    # retrieve file data from s3
-    filename = '{}/{}/{}'.format(username, analysis.project_id, analysis_id)
-    try:
-        resp = requests.get(S3_URL + filename)
-    except ConnectionError:
-        return render_template('errors/server_error.html', form=LoginForm())
-    # return error code if request failed
-    if resp.status_code != 200:
-        return render_template('errors/server_error.html', form=LoginForm())
+    results = None
+    if with_flux:
+        if analysis.results_url is None:
+            return None, render_template('errors/page_not_found.html', form=LoginForm())
 
-    # load fba analysis results
-    results = json.loads(resp.text)
+        # load fba analysis results
+        results = _get_results(analysis)
+        if results is None:
+            return None, render_template('errors/server_error.html', form=LoginForm())
 
-    # get the sbml model
-    model = analysis.model.get_cobra_model()
-    if model is None:
-        return render_template('errors/server_error.html')
+    topology = _get_topology(analysis.model, pathway_id)
+    if topology is None:
+        if pathway_id == 'whole':
+            return None, render_template('errors/server_error.html')
+        return None, render_template('errors/page_not_found.html', form=LoginForm())
 
-    if pathway_id == 'whole':
-        # whole drawing requested
-        cytoscape_formatted = _build_genome_scale_network(model, results)
+    flux = flux_vector(analysis.model.get_model_arrays(), results) if with_flux else None
+    return (analysis, topology, flux), None
 
-    else:
-        kegg_model = Kegg.get_kgml_obj(pathway_id)
 
-        if model is None or kegg_model is None:
-            return render_template('errors/page_not_found.html', form=LoginForm())
+def _graph_response(graph):
+    """
+    graph encoded in the `format` request argument, see `kepavi.wire`:
+    json (default), columnar or binary
+    """
+
+    fmt = request.args.get('format', 'json')
+    if fmt == 'columnar':
+        return json.dumps(wire.encode(graph))
+    if fmt == 'binary':
+        return Response(wire.dumps(graph), mimetype='application/octet-stream')
+    return json.dumps(graph)
 
-        kegg_model_name = request.args.get('pathway_name')
-        cytoscape_formatted = build_kegg_network_mixed(kegg_model,
-                                                       kegg_model_name,
-                                                       model,
-                                                       results)
-    return json.dumps(cytoscape_formatted)
+
+@user.route('/<username>/get_kgml', methods=['GET'])
+@login_required
+def get_kgml(username):
+    """
+    main function to visualize network
+    return the graph encoded as asked by the `format` argument
+    """
+
+    inputs, error = _get_graph_inputs()
+    if inputs is None:
+        return error
+    _, topology, flux = inputs
+    return _graph_response(topology.render(flux))
+
+
+@user.route('/<username>/get_topology', methods=['GET'])
+@login_required
+def get_topology(username):
+    """
+    graph without fluxes, the same for every analysis of the model,
+    see `get_fluxes`, encoded as asked by the `format` argument
+    """
+
+    inputs, error = _get_graph_inputs(with_flux=False)
+    if inputs is None:
+        return error
+    return _graph_response(inputs[1].to_json())
+
+
+@user.route('/<username>/get_fluxes', methods=['GET'])
+@login_required
+def get_fluxes(username):
+    """
+    node fluxes, node cumulated fluxes and edge fluxes of an analysis,
+    in the `get_topology` nodes and edges order
+    """
+
+    inputs, error = _get_graph_inputs()
+    if inputs is None:
+        return error
+    _, topology, flux = inputs
+    overlay = topology.overlay(flux)
+    return json.dumps(dict((k, v.tolist()) for k, v in overlay.items()))
 
 
 @user.route('/<username>/download/<project_id>/<analysis_id>')
 @login_required
 def download(username, project_id, analysis_id):
+    analysis = Analysis.query.filter(Analysis.id == analysis_id).first_or_404()
+    if analysis.results_url is None:
+        return render_template('errors/page_not_found.html', form=LoginForm())
     filename = '{}/{}/{}'.format(username, project_id, analysis_id)
-    text = download_from_s3(S3_URL, filename)
-    if text is None:
+    results = _get_results(analysis)
+    if results is None:
         return render_template('errors/server_error.html', form=LoginForm())
+    # results are stored in binary
+    text = results_to_json(results)
     f = filename.replace('/', '-') + '.json'
     return Response(text,
                     mimetype='application/json',
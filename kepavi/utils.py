@@ -1,16 +1,11 @@
 from collections import OrderedDict
 import random
 import itertools
-import boto
-from kepavi.extensions import db
+from kepavi.extensions import db, http_client, s3_client
 import os
+from requests import RequestException
 from sqlalchemy import func
 
-try:
-    from kepavi.private_keys import S3_KEY, S3_BUCKET, S3_SECRET, S3_UPLOAD_DIRECTORY
-except ImportError:
-    S3_UPLOAD_DIRECTORY, S3_SECRET, S3_BUCKET, S3_KEY = '', '', '', ''
-
 from werkzeug.utils import secure_filename
 
 
@@ -32,13 +27,7 @@ def s3_upload(source_file, destination_filename, acl='public-read'):
     source_filename = secure_filename(source_file.data.filename)
     source_extension = os.path.splitext(source_filename)[1]
 
-    # Connect to S3 and upload file.
-    conn = boto.connect_s3(os.environ.get('S3_KEY') or S3_KEY, os.environ.get("S3_SECRET") or S3_SECRET)
-    b = conn.get_bucket(os.environ.get("S3_BUCKET") or S3_BUCKET)
-
-    sml = b.new_key("/".join([os.environ.get("S3_UPLOAD_DIRECTORY") or S3_UPLOAD_DIRECTORY, destination_filename]))
-    sml.set_contents_from_string(source_file.data.read())
-    sml.set_acl(acl)
+    s3_client.upload_string(source_file.data.read(), destination_filename, acl)
 
     return destination_filename
 
@@ -51,12 +40,18 @@ def s3_upload_from_server(source_file, destination_filename, acl='public-read'):
     :param acl:
     :return:
     """
-    conn = boto.connect_s3(os.environ.get('S3_KEY') or S3_KEY, os.environ.get("S3_SECRET") or S3_SECRET)
-    b = conn.get_bucket(os.environ.get("S3_BUCKET") or S3_BUCKET)
+    s3_client.upload_file(source_file, destination_filename, acl)
 
-    sml = b.new_key("/".join([os.environ.get("S3_UPLOAD_DIRECTORY") or S3_UPLOAD_DIRECTORY, destination_filename]))
-    sml.set_contents_from_filename(source_file)
-    sml.set_acl(acl)
+
+def s3_upload_from_memory(data, destination_filename, acl='public-read'):
+    """
+    upload bytes without writing them to disk
+    :param data:
+    :param destination_filename:
+    :param acl:
+    :return:
+    """
+    s3_client.upload_string(data, destination_filename, acl)
 
 
 def s3_delete(key):
@@ -65,9 +60,7 @@ def s3_delete(key):
     :param key: here it will be a software name for example
     :return:
     """
-    conn = boto.connect_s3(os.environ.get('S3_KEY') or S3_KEY, os.environ.get("S3_SECRET") or S3_SECRET)
-    b = conn.get_bucket(os.environ.get("S3_BUCKET") or S3_BUCKET)
-    return b.delete_key(key)
+    return s3_client.delete(key)
 
 
 def mean(l):
@@ -95,13 +88,12 @@ def random_email(prefix=(2, 8), domain=(5, 20), sufix=(2, 4)):
     return '{}@{}.{}'.format("".join(sample_wr(l, p)), "".join(sample_wr(l, d)), "".join(sample_wr(l, s)))
 
 
-def download_from_s3(prefix, filename):
-    import requests
+def download_from_s3(prefix, filename, binary=False):
     try:
-        resp = requests.get(prefix + filename)
-    except ConnectionError:
+        resp = http_client.get(prefix + filename, endpoint='s3:get')
+    except RequestException:
         return None
     # return error code if request failed
     if resp.status_code != 200:
         return None
-    return resp.text
+    return resp.content if binary else resp.text
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+    kepavi.wire
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Compact encodings of the graph dicts sent to the browser, selected
+    by the `format` argument of the graph routes:
+
+    ``json``
+        lists of node and edge dicts, as built.
+
+    ``columnar``
+        json holding one column per key instead of one dict per
+        element. Strings are indices in a shared table, edge endpoints
+        indices of nodes, columns holding a single value are stored
+        once, and columns the client can rebuild (`absflux` and `sign`
+        from `flux`, labels abbreviating `full_name`...) are described
+        instead of stored.
+
+    ``binary``
+        the columnar description in a header, the columns as little
+        endian typed arrays the browser reads without parsing::
+
+            header   magic 'KPVG', format version (uint16), flags
+                     (uint16), length of the table of contents (uint32)
+            toc      json: the columnar dict, stored columns pointing
+                     to a block (offset, count, dtype)
+            blocks   8 bytes aligned, relative to the end of the toc
+
+    `decode` and `loads` give back the graph dict.
+
+"""
+import json
+import struct
+
+import numpy as np
+
+from kepavi._compat import integer_types, string_types
+
+FORMATS = ('json', 'columnar', 'binary')
+
+MAGIC = b'KPVG'
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<4sHHI')
+_ALIGNMENT = 8
+
+_INT32 = np.iinfo(np.int32)
+
+
+def _sign(value):
+    return 'neg' if value < 0 else 'pos' if value > 0 else 'zero'
+
+
+# how a column can be rebuilt from another one
+_DERIVATIONS = {'abs': abs,
+                'sign': _sign,
+                'same': lambda value: value,
+                'abbreviation': lambda value: value[:10] + '...'}
+
+# column -> (derivation, source column) tried in order
+_DERIVED = {'absflux': (('abs', 'flux'),),
+            'sign': (('sign', 'flux'),),
+            'label': (('same', 'full_name'), ('abbreviation', 'full_name')),
+            'name': (('same', 'full_name'), ('abbreviation', 'full_name')),
+            'content': (('same', 'full_name'), ('abbreviation', 'full_name'))}
+
+
+class WireError(ValueError):
+    pass
+
+
+class _Strings(object):
+    """table of the distinct strings of a graph"""
+
+    def __init__(self):
+        self.table = []
+        self.index = {}
+
+    def add(self, value):
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.table)
+            self.table.append(value)
+        return i
+
+
+def _keys(elements):
+    keys, seen = [], set()
+    for element in elements:
+        for key in element:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+    return keys
+
+
+def _derivation(name, values, columns):
+    for derivation, source in _DERIVED.get(name, ()):
+        if source not in columns:
+            continue
+        f = _DERIVATIONS[derivation]
+        try:
+            if all(f(s) == v for s, v in zip(columns[source], values)):
+                return {'type': derivation, 'of': source}
+        except TypeError:
+            continue
+    return None
+
+
+def _stored(values, strings, node_index):
+    """column description holding its values"""
+
+    first = values[0]
+    if all(type(v) is type(first) and v == first for v in values):
+        return {'type': 'constant', 'value': first}
+    if node_index is not None and all(v in node_index for v in values):
+        return {'type': 'node', 'values': [node_index[v] for v in values]}
+    if all(isinstance(v, bool) for v in values):
+        return {'type': 'bool', 'values': [int(v) for v in values]}
+    if all(isinstance(v, integer_types) and not isinstance(v, bool) for v in values):
+        return {'type': 'int', 'values': values}
+    if all(isinstance(v, (float,) + integer_types) and not isinstance(v, bool) for v in values):
+        return {'type': 'float', 'values': [float(v) for v in values]}
+    if all(isinstance(v, string_types) for v in values):
+        return {'type': 'string', 'values': [strings.add(v) for v in values]}
+    return {'type': 'any', 'values': values}
+
+
+def _encode_elements(elements, strings, node_index=None):
+    names = _keys(elements)
+    columns, missing = {}, {}
+    for name in names:
+        missing[name] = [i for i, element in enumerate(elements) if name not in element]
+        # absent keys hold the first present value, dropped when decoding
+        default = next(element[name] for element in elements if name in element)
+        columns[name] = [element.get(name, default) for element in elements]
+
+    stored, derived = [], []
+    for name in names:
+        description = _derivation(name, columns[name], columns) if not missing[name] else None
+        if description is None:
+            endpoints = node_index if name in ('source', 'target') else None
+            description = _stored(columns[name], strings, endpoints)
+        description['name'] = name
+        if missing[name]:
+            description['missing'] = missing[name]
+        # rebuilt columns come after their sources
+        (derived if description['type'] in _DERIVATIONS else stored).append(description)
+    return {'count': len(elements), 'columns': stored + derived}
+
+
+def encode(graph):
+    """
+    :param graph: dict of `nodes` and `edges` lists of dicts, other
+                  keys are kept as they are
+    :return: json serializable columnar dict
+    """
+
+    strings = _Strings()
+    nodes, edges = graph.get('nodes', []), graph.get('edges', [])
+    node_index = dict((node['id'], i) for i, node in enumerate(nodes) if 'id' in node)
+    return {'format': 'columnar',
+            'version': FORMAT_VERSION,
+            'nodes': _encode_elements(nodes, strings),
+            'edges': _encode_elements(edges, strings, node_index),
+            'strings': strings.table,
+            'meta': dict((k, v) for k, v in graph.items() if k not in ('nodes', 'edges'))}
+
+
+def _decode_elements(encoded, strings, nodes=None):
+    count = encoded['count']
+    columns = {}
+    for description in encoded['columns']:
+        kind = description['type']
+        if kind == 'constant':
+            values = [description['value']] * count
+        elif kind in _DERIVATIONS:
+            values = [_DERIVATIONS[kind](v) for v in columns[description['of']]]
+        elif kind == 'string':
+            values = [strings[i] for i in description['values']]
+        elif kind == 'node':
+            values = [nodes[i]['id'] for i in description['values']]
+        elif kind == 'bool':
+            values = [bool(v) for v in description['values']]
+        else:
+            values = description['values']
+        columns[description['name']] = values
+
+    elements = [{} for _ in range(count)]
+    for description in encoded['columns']:
+        name = description['name']
+        for element, value in zip(elements, columns[name]):
+            element[name] = value
+        for i in description.get('missing', ()):
+            del elements[i][name]
+    return elements
+
+
+def decode(encoded):
+    """graph dict of an `encode` output"""
+
+    if encoded.get('format') != 'columnar':
+        raise WireError('not a columnar graph')
+    if encoded['version'] > FORMAT_VERSION:
+        raise WireError('unsupported graph version {}'.format(encoded['version']))
+    strings = encoded['strings']
+    nodes = _decode_elements(encoded['nodes'], strings)
+    graph = dict(encoded['meta'])
+    graph['nodes'] = nodes
+    graph['edges'] = _decode_elements(encoded['edges'], strings, nodes)
+    return graph
+
+
+def _dtype(description):
+    kind, values = description['type'], description['values']
+    if kind == 'float':
+        return '<f8'
+    if kind == 'bool':
+        return '|u1'
+    if kind in ('string', 'node'):
+        return '<u4'
+    # javascript has no 64 bits integer arrays
+    if values and (min(values) < _INT32.min or max(values) > _INT32.max):
+        return '<f8'
+    return '<i4'
+
+
+def dumps(graph):
+    """
+    binary encoding of a graph, see the module documentation
+
+    :return: bytes
+    """
+
+    encoded = encode(graph)
+    chunks, position = [], 0
+    for part in ('nodes', 'edges'):
+        for description in encoded[part]['columns']:
+            if description['type'] not in ('float', 'int', 'bool', 'string', 'node'):
+                continue
+            dtype = _dtype(description)
+            data = np.asarray(description.pop('values'), dtype=dtype).tobytes()
+            description['block'] = [position, encoded[part]['count'], dtype]
+            padding = -len(data) % _ALIGNMENT
+            chunks.append(data + b'\0' * padding)
+            position += len(data) + padding
+
+    encoded['format'] = 'binary'
+    toc = json.dumps(encoded).encode('utf-8')
+    toc += b' ' * (-(_HEADER.size + len(toc)) % _ALIGNMENT)
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(toc)) + toc + b''.join(chunks)
+
+
+def loads(data):
+    """graph dict of a `dumps` output"""
+
+    if len(data) < _HEADER.size:
+        raise WireError('truncated graph')
+    magic, version, flags, toc_length = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise WireError('not a binary graph')
+    if version > FORMAT_VERSION:
+        raise WireError('unsupported graph version {}'.format(version))
+
+    encoded = json.loads(bytes(data[_HEADER.size:_HEADER.size + toc_length]).decode('utf-8'))
+    start = _HEADER.size + toc_length
+    for part in ('nodes', 'edges'):
+        for description in encoded[part]['columns']:
+            if 'block' in description:
+                offset, count, dtype = description.pop('block')
+                values = np.frombuffer(data, dtype=dtype, count=count, offset=start + offset)
+                if description['type'] == 'int':
+                    values = values.astype(np.int64)
+                description['values'] = values.tolist()
+    encoded['format'] = 'columnar'
+    return decode(encoded)
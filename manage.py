@@ -1,8 +1,13 @@
-from kepavi.biomodels import BiomodelMongo
+from kepavi.biomodels import BiomodelMongo, reaction_summary, kegg_index
+from kepavi import currency, layout, snapshot
+from kepavi.cobra_utils import genome_scale_layout
+from kepavi.files import save_array
+from kepavi.stoichiometry import ModelArrays, arrays_path
 from kepavi.user.models import User, Biomodel, KeggReaction
 import os
 import csv
 import logging
+import time
 
 from flask import current_app
 
@@ -105,11 +110,30 @@ def insert_model(xml_model):
     if kegg_org_id is None or model_name is None:
         return False
 
-    biomodel = BiomodelMongo(name=model_name, organism=kegg_org_id, cobra_model=d)
+    data = snapshot.dumps(d)
+    biomodel = BiomodelMongo(name=model_name, organism=kegg_org_id, cobra_model=d,
+                             snapshot=data, n_reactions=len(d['reactions']),
+                             reaction_summary=reaction_summary(sbml_model),
+                             kegg_index=kegg_index(sbml_model))
     biomodel.save()
+
+    write_model_arrays(biomodel, snapshot.read_tables(data))
     return True
 
 
+def write_model_arrays(biomodel, tables):
+    path = arrays_path(current_app.config['MODEL_ARRAYS_DIR'], biomodel.id, biomodel.version or 1)
+    arrays = ModelArrays.from_tables(tables)
+    arrays.save(path)
+    mask = currency.currency_mask(arrays, **currency.config_params(current_app.config))
+    save_array(currency.currency_path(path), mask)
+    # laid out once, graphs of the whole model reuse it
+    save_array(layout.layout_path(path), genome_scale_layout(arrays,
+                                                             current_app.config['LAYOUT_ITERATIONS'],
+                                                             current_app.config['LAYOUT_SEED'],
+                                                             mask))
+
+
 def retrieve_kegg_org_id(xml_model):
     from lxml import etree
     tree = etree.parse(xml_model)
@@ -164,6 +188,208 @@ def insert_models():
             logging.warn('Enable to remove file {}'.format(m))
 
 
+@manager.command
+def build_snapshots():
+    """Writes the binary snapshot of models inserted without one"""
+    ids = [b.id for b in BiomodelMongo.objects(snapshot=None).only('id')]
+    logging.info('{} snapshots to build'.format(len(ids)))
+    for i, doc_id in enumerate(ids):
+        b = BiomodelMongo.objects(id=doc_id).only('cobra_model').first()
+        try:
+            data = snapshot.dumps(b.cobra_model)
+        except snapshot.SnapshotError as e:
+            logging.error('{}: {}'.format(doc_id, e))
+            continue
+        BiomodelMongo.objects(id=doc_id).update_one(set__snapshot=data,
+                                                    set__n_reactions=len(b.cobra_model['reactions']))
+        logging.info('complete: {}%'.format(round(((i + 1.0) / len(ids)) * 100)))
+
+
+@manager.command
+def build_kegg_indexes():
+    """Stores the KEGG ids index of models inserted without one"""
+    ids = [b.id for b in BiomodelMongo.objects(snapshot__ne=None).only('id', 'kegg_index') if not b.kegg_index]
+    logging.info('{} indexes to build'.format(len(ids)))
+    for i, doc_id in enumerate(ids):
+        b = BiomodelMongo.objects(id=doc_id).only('snapshot').first()
+        BiomodelMongo.objects(id=doc_id).update_one(set__kegg_index=kegg_index(snapshot.loads(b.snapshot)))
+        logging.info('complete: {}%'.format(round(((i + 1.0) / len(ids)) * 100)))
+
+
+@manager.command
+def match_pathways():
+    """Matches the KEGG pathways of every model organism against the model"""
+    biomodels = Biomodel.query.filter(Biomodel.kegg_org != None).all()  # noqa
+    for i, biomodel in enumerate(biomodels):
+        if biomodel.get_pathway_coverage() is None and biomodel.match_pathways() is None:
+            logging.warn('{}: pathways not matched'.format(biomodel.name))
+        logging.info('complete: {}%'.format(round(((i + 1.0) / len(biomodels)) * 100)))
+
+
+@manager.command
+def build_model_arrays():
+    """Writes the stoichiometric arrays of every model having a snapshot"""
+    ids = [b.id for b in BiomodelMongo.objects(snapshot__ne=None).only('id')]
+    for i, doc_id in enumerate(ids):
+        b = BiomodelMongo.objects(id=doc_id).only('snapshot', 'version').first()
+        write_model_arrays(b, snapshot.read_tables(b.snapshot))
+        logging.info('complete: {}%'.format(round(((i + 1.0) / len(ids)) * 100)))
+
+
+def _best_of(f, repeat):
+    """shortest of `repeat` timings of f"""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def _largest_models(count, *fields):
+    """mongo documents of the `count` snapshotted models with the most reactions"""
+
+    return BiomodelMongo.objects(snapshot__ne=None).order_by('-n_reactions').only(*fields)[:count]
+
+
+def _largest_biomodels(count):
+    """(mongo document, `Biomodel`) of the `_largest_models` having a Biomodel row"""
+
+    for doc in _largest_models(count, 'name', 'organism', 'n_reactions'):
+        biomodel = Biomodel.query.filter(db.or_(Biomodel.kegg_org == doc.organism,
+                                                Biomodel.name == doc.name)).first()
+        if biomodel is not None:
+            yield doc, biomodel
+
+
+@manager.option('-n', '--count', dest='count', default=5, type=int)
+@manager.option('-r', '--repeat', dest='repeat', default=3, type=int)
+def benchmark_snapshots(count, repeat):
+    """Compares loading the largest models from the dict and from the snapshot"""
+    import cobra.io
+    from bson import BSON
+
+    print "{:<40} {:>6} {:>12} {:>12} {:>9} {:>9} {:>7}".format(
+        'model', 'reacs', 'dict bytes', 'snap bytes', 'dict (s)', 'snap (s)', 'speedup')
+    for doc in _largest_models(count, 'id', 'name', 'n_reactions'):
+        def from_dict():
+            b = BiomodelMongo.objects(id=doc.id).only('cobra_model').first()
+            return cobra.io._from_dict(b.cobra_model)
+
+        def from_snapshot():
+            b = BiomodelMongo.objects(id=doc.id).only('snapshot').first()
+            return snapshot.loads(b.snapshot)
+
+        raw = BiomodelMongo.objects(id=doc.id).only('cobra_model', 'snapshot').first()
+        dict_bytes = len(BSON.encode({'cobra_model': raw.cobra_model}))
+        snap_bytes = len(raw.snapshot)
+
+        dict_time, snap_time = _best_of(from_dict, repeat), _best_of(from_snapshot, repeat)
+        print "{:<40} {:>6} {:>12} {:>12} {:>9.3f} {:>9.3f} {:>6.1f}x".format(
+            doc.name[:40], doc.n_reactions, dict_bytes, snap_bytes, dict_time, snap_time, dict_time / snap_time)
+
+
+@manager.option('-n', '--count', dest='count', default=5, type=int)
+@manager.option('-r', '--repeat', dest='repeat', default=3, type=int)
+def benchmark_solvers(count, repeat):
+    """Compares FBA solve time and memory of the solver backends on the largest models"""
+    from kepavi.solvers import SOLVERS, get_solver
+
+    def peak_rss(f):
+        # run in a child: its peak resident size (KB) only covers this call
+        # plus what is inherited, measured by a child doing nothing
+        pid = os.fork()
+        if pid == 0:
+            f()
+            os._exit(0)
+        return os.wait4(pid, 0)[2].ru_maxrss
+
+    backends = []
+    for name in sorted(SOLVERS):
+        try:
+            backends.append(get_solver(name))
+        except ValueError as e:
+            print "skipping {}: {}".format(name, e)
+    print "{:<40} {:>6} {:<8} {:>12} {:>9} {:>10}".format('model', 'reacs', 'solver', 'objective', 'time (s)', 'rss (KB)')
+    for doc, biomodel in _largest_biomodels(count):
+        # loading is not measured
+        biomodel.get_cobra_model()
+        biomodel.get_model_arrays()
+        baseline = peak_rss(lambda: None)
+        for backend in backends:
+
+            def solve():
+                return backend.solve(biomodel, [], [])
+
+            solution = solve()
+            if solution is None:
+                continue
+            print "{:<40} {:>6} {:<8} {:>12} {:>9.3f} {:>10}".format(
+                doc.name[:40], doc.n_reactions, backend.name, '{:.6g}'.format(solution.f) if solution.f is not None else solution.status,
+                _best_of(solve, repeat), peak_rss(solve) - baseline)
+
+
+@manager.option('-n', '--count', dest='count', default=5, type=int)
+@manager.option('-r', '--repeat', dest='repeat', default=3, type=int)
+def benchmark_networks(count, repeat):
+    """
+    Compares building the genome scale graph from the cobra model and from the model arrays,
+    and its edges once the detected currency metabolites are left out
+    """
+    import numpy as np
+    from kepavi.cobra_utils import _build_genome_scale_network, build_genome_scale_network, genome_scale_topology
+
+    print "{:<40} {:>6} {:>7} {:>9} {:>10} {:>10} {:>7} {:>9} {:>9}".format(
+        'model', 'reacs', 'nodes', 'edges', 'loop (s)', 'arrays (s)', 'speedup', 'currency', 'edges')
+    for doc, biomodel in _largest_biomodels(count):
+        model, arrays = biomodel.get_cobra_model(), biomodel.get_model_arrays()
+        if model is None or arrays is None:
+            continue
+        # fluxes of both signs and zeros, the same for every run
+        fluxes = np.random.RandomState(0).randint(-2, 3, arrays.n_reactions) * 10.
+        results = {'x_dict': dict(zip(arrays.reaction_ids, fluxes.tolist()))}
+
+        graph = build_genome_scale_network(arrays, results)
+        loop_time = _best_of(lambda: _build_genome_scale_network(model, results), repeat)
+        arrays_time = _best_of(lambda: build_genome_scale_network(arrays, results), repeat)
+        mask = biomodel.get_currency_mask()
+        masked = genome_scale_topology(arrays, currency=mask)
+        print "{:<40} {:>6} {:>7} {:>9} {:>10.3f} {:>10.3f} {:>6.1f}x {:>9} {:>9}".format(
+            doc.name[:40], doc.n_reactions, len(graph['nodes']), len(graph['edges']),
+            loop_time, arrays_time, loop_time / arrays_time, int(np.count_nonzero(mask)), len(masked.edges))
+
+
+@manager.option('-n', '--count', dest='count', default=5, type=int)
+@manager.option('-r', '--repeat', dest='repeat', default=3, type=int)
+def benchmark_wire_formats(count, repeat):
+    """Compares the size and encoding time of the whole model graphs in each wire format"""
+    import json
+    import zlib
+    import numpy as np
+    from kepavi import wire
+    from kepavi.cobra_utils import genome_scale_topology
+
+    encoders = [('json', json.dumps),
+                ('columnar', lambda graph: json.dumps(wire.encode(graph))),
+                ('binary', wire.dumps)]
+
+    print "{:<40} {:>8} {:>9} {:>12} {:>12} {:>9}".format(
+        'model', 'format', 'edges', 'bytes', 'gzip bytes', 'dumps (s)')
+    for doc, biomodel in _largest_biomodels(count):
+        arrays = biomodel.get_model_arrays()
+        if arrays is None:
+            continue
+        topology = genome_scale_topology(arrays, biomodel.get_layout(), biomodel.get_currency_mask())
+        # fluxes of both signs and zeros, the same for every run
+        graph = topology.render(np.random.RandomState(0).randint(-2, 3, arrays.n_reactions) * 10.)
+        for name, dumps in encoders:
+            data = dumps(graph)
+            print "{:<40} {:>8} {:>9} {:>12} {:>12} {:>9.3f}".format(
+                doc.name[:40], name, len(graph['edges']), len(data), len(zlib.compress(data, 6)),
+                _best_of(lambda: dumps(graph), repeat))
+
+
 @manager.command
 def populate_kegg_reactions_table():
     """
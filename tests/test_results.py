@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from kepavi import results as kepavi_results
+
+REACTION_IDS = ['HEX1', 'PGI', 'PFK', 'EX_glc__D_e', 'BIOMASS']
+METABOLITE_IDS = ['glc__D_c', 'g6p_c', 'f6p_c']
+
+
+def _fba():
+    return {'status': 'optimal',
+            'objective_value': 0.87,
+            'x_dict': {'HEX1': 10., 'PGI': 0., 'PFK': 0., 'EX_glc__D_e': 0., 'BIOMASS': 0.87},
+            'y_dict': {'glc__D_c': -0.5, 'g6p_c': 0.25, 'f6p_c': None},
+            'reaction_ids': REACTION_IDS}
+
+
+def _fva():
+    return {'minimum': dict((r, float(-i)) for i, r in enumerate(REACTION_IDS)),
+            'maximum': dict((r, float(i) if i else None) for i, r in enumerate(REACTION_IDS)),
+            'single': [1., 0.5, None, 1., 0.],
+            'reaction_ids': REACTION_IDS}
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('sparse', [True, False])
+@pytest.mark.parametrize('make', [_fba, _fva])
+def test_round_trip(make, sparse, compress):
+    results = make()
+    data = kepavi_results.dumps(results, REACTION_IDS, METABOLITE_IDS, compress=compress, sparse=sparse)
+    assert kepavi_results.is_results(data)
+    loaded = kepavi_results.loads(data)
+    assert isinstance(loaded, kepavi_results.Results)
+    assert loaded.to_dict() == results
+    assert loaded.reaction_ids == REACTION_IDS
+    assert loaded.metabolite_ids == METABOLITE_IDS
+
+
+def test_sparse_arrays():
+    loaded = kepavi_results.loads(kepavi_results.dumps(_fba(), REACTION_IDS, METABOLITE_IDS))
+    # two fluxes out of five are not zero
+    assert loaded.arrays['x_dict']['sparse']
+    assert [loaded.value('x_dict', i) for i in range(len(REACTION_IDS))] == [10., 0., 0., 0., 0.87]
+    assert loaded['x_dict']['BIOMASS'] == 0.87
+
+
+def test_none_values():
+    loaded = kepavi_results.loads(kepavi_results.dumps(_fba(), REACTION_IDS, METABOLITE_IDS))
+    assert loaded['y_dict']['f6p_c'] is None
+    assert loaded.value('y_dict', 2) is None
+    assert loaded['objective_value'] == 0.87
+
+
+def test_reaction_ids():
+    results = _fba()
+    loaded = kepavi_results.loads(kepavi_results.dumps(results, REACTION_IDS))
+    # stored once, as the reactions axis
+    assert loaded.id_lists == ['reaction_ids']
+    assert loaded['reaction_ids'] == REACTION_IDS
+
+    # not the model order: kept as a plain value
+    results['reaction_ids'] = REACTION_IDS[::-1]
+    loaded = kepavi_results.loads(kepavi_results.dumps(results, REACTION_IDS))
+    assert loaded.id_lists == []
+    assert loaded.to_dict() == results
+
+
+def test_ids_missing_from_the_model():
+    results = _fba()
+    results['x_dict']['EX_pyr_e'] = 1.
+    loaded = kepavi_results.loads(kepavi_results.dumps(results, REACTION_IDS[:-1]))
+    assert loaded.reaction_ids == REACTION_IDS[:-1] + ['BIOMASS', 'EX_pyr_e']
+    assert dict(loaded['x_dict']) == results['x_dict']
+
+
+def test_non_ascii_ids():
+    ids = [u'α_glc', u'caf\xe9', 'PGI']
+    results = {'x_dict': {u'α_glc': 1., u'caf\xe9': -2., 'PGI': 0.}, 'name': u'β-oxidation'}
+    loaded = kepavi_results.loads(kepavi_results.dumps(results, ids, compress=True))
+    assert loaded.reaction_ids == ids
+    assert loaded.to_dict() == results
+
+
+def test_empty_results():
+    results = {'status': 'infeasible', 'objective_value': None, 'x_dict': None, 'y_dict': None,
+               'reaction_ids': []}
+    loaded = kepavi_results.loads(kepavi_results.dumps(results))
+    assert loaded.reaction_ids == loaded.metabolite_ids == []
+    assert loaded.to_dict() == results
+    assert loaded.get('single') is None
+
+
+def test_single_list_length():
+    results = _fva()
+    results['single'].append(1.)
+    with pytest.raises(kepavi_results.ResultsError):
+        kepavi_results.dumps(results, REACTION_IDS)
+
+
+def test_legacy_json():
+    results = _fba()
+    assert kepavi_results.loads(json.dumps(results)) == results
+    assert kepavi_results.loads(json.dumps(results).encode('utf-8')) == results
+
+
+def test_memory_mapped(tmpdir):
+    results = _fva()
+    path = tmpdir.join('results.kpvr')
+    path.write(kepavi_results.dumps(results, REACTION_IDS), 'wb')
+    loaded = kepavi_results.open_results(str(path))
+    assert loaded.to_dict() == results
+
+
+def test_errors():
+    data = kepavi_results.dumps(_fba(), REACTION_IDS)
+    with pytest.raises(kepavi_results.ResultsError):
+        kepavi_results.Results(data[:4])
+    with pytest.raises(kepavi_results.ResultsError):
+        kepavi_results.Results(b'XXXX' + data[4:])
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from kepavi import snapshot
+
+
+def _model_dict():
+    return {'id': 'toy',
+            'description': u'toy model',
+            'compartments': {'c': 'cytosol'},
+            'metabolites': [{'id': 'glc__D_c', 'name': u'α-D-glucose', 'formula': 'C6H12O6',
+                             'compartment': 'c', 'charge': 0},
+                            {'id': 'g6p_c', 'name': u'D-glucose 6-phosphate', 'formula': 'C6H11O9P',
+                             'compartment': 'c', 'notes': {'kegg': ['C00092']}},
+                            {'id': 'atp_c', 'name': u'ATP', 'formula': None, 'compartment': 'c'}],
+            'reactions': [{'id': 'HEX1', 'name': u'hexokinase', 'gene_reaction_rule': 'b2388',
+                           'subsystem': u'Glycolysis', 'lower_bound': 0., 'upper_bound': 1000.,
+                           'objective_coefficient': 0.,
+                           'metabolites': {'glc__D_c': -1., 'atp_c': -1., 'g6p_c': 1.},
+                           'notes': {}},
+                          {'id': 'EX_glc__D_e', 'name': u'glucose exchange', 'gene_reaction_rule': '',
+                           'subsystem': None, 'lower_bound': -10., 'upper_bound': 1000.,
+                           'objective_coefficient': 1., 'metabolites': {'glc__D_c': -1.}}],
+            'genes': [{'id': 'b2388', 'name': u'glk'}]}
+
+
+def _check_tables(tables, model_dict):
+    metabolites = model_dict['metabolites']
+    reactions = model_dict['reactions']
+    assert tables['metabolites'] == [tuple(m.get(f) for f in snapshot.METABOLITE_FIELDS)
+                                     for m in metabolites]
+    assert tables['reactions'] == [tuple(r.get(f) for f in snapshot.REACTION_FIELDS)
+                                   for r in reactions]
+    assert tables['bounds'] == [tuple(float(r.get(f) or 0.) for f in snapshot.BOUND_FIELDS)
+                                for r in reactions]
+    assert tables['genes'] == [tuple(g.get(f) for f in snapshot.GENE_FIELDS)
+                               for g in model_dict['genes']]
+
+    met_ids = [m['id'] for m in metabolites]
+    indptr, indices, values = tables['indptr'], tables['indices'], tables['values']
+    assert len(indptr) == len(reactions) + 1
+    for i, r in enumerate(reactions):
+        stoichiometry = dict((met_ids[indices[j]], values[j]) for j in range(indptr[i], indptr[i + 1]))
+        assert stoichiometry == r['metabolites']
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_round_trip(compress):
+    model_dict = _model_dict()
+    data = snapshot.dumps(model_dict, compress=compress)
+    assert data[:4] == snapshot.MAGIC
+    tables = snapshot.read_tables(data)
+    _check_tables(tables, model_dict)
+
+    extras = tables['extras']
+    assert extras['model'] == {'id': 'toy', 'description': u'toy model', 'compartments': {'c': 'cytosol'}}
+    assert extras['metabolites'] == {0: {'charge': 0}, 1: {'notes': {'kegg': ['C00092']}}}
+    assert extras['reactions'] == {0: {'notes': {}}}
+    assert extras['genes'] == {}
+
+
+def test_empty_model():
+    tables = snapshot.read_tables(snapshot.dumps({'id': 'empty'}))
+    assert tables['metabolites'] == tables['reactions'] == tables['genes'] == []
+    assert list(tables['indptr']) == [0]
+    assert list(tables['indices']) == list(tables['values']) == []
+    assert tables['extras']['model'] == {'id': 'empty'}
+
+
+def test_non_ascii_strings():
+    tables = snapshot.read_tables(snapshot.dumps(_model_dict()))
+    assert tables['metabolites'][0][1] == u'α-D-glucose'
+    # strings are stored once
+    assert len(tables['strings']) == len(set(tables['strings']))
+
+
+def test_unknown_metabolite():
+    model_dict = _model_dict()
+    model_dict['reactions'][0]['metabolites']['pyr_c'] = 1.
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.dumps(model_dict)
+
+
+def test_errors():
+    data = snapshot.dumps(_model_dict())
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.read_tables(data[:4])
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.read_tables(b'XXXX' + data[4:])
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.read_tables(snapshot.dumps(_model_dict(), compress=False)[:-1])
+
+
+def test_loads_matches_cobra():
+    cobra = pytest.importorskip('cobra')
+    model_dict = _model_dict()
+    expected = cobra.io._from_dict(model_dict)
+    model = snapshot.loads(snapshot.dumps(model_dict))
+
+    assert [(m.id, m.name, m.formula, m.compartment) for m in model.metabolites] == \
+        [(m.id, m.name, m.formula, m.compartment) for m in expected.metabolites]
+    assert [(r.id, r.name, r.subsystem, r.lower_bound, r.upper_bound, r.objective_coefficient,
+             r.gene_reaction_rule) for r in model.reactions] == \
+        [(r.id, r.name, r.subsystem, r.lower_bound, r.upper_bound, r.objective_coefficient,
+          r.gene_reaction_rule) for r in expected.reactions]
+    for r, e in zip(model.reactions, expected.reactions):
+        assert dict((m.id, c) for m, c in r.metabolites.items()) == \
+            dict((m.id, c) for m, c in e.metabolites.items())
+    assert sorted(g.id for g in model.genes) == sorted(g.id for g in expected.genes)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+pytest.importorskip('cobra')
+
+from kepavi import cobra_utils  # noqa
+from kepavi import results as kepavi_results  # noqa
+from kepavi.stoichiometry import ModelArrays  # noqa
+
+
+class _Metabolite(object):
+    """
+    hashed by its index: `_build_genome_scale_network` iterates sets of
+    metabolites, with less than 8 metabolites they come in index order
+    as the columns of the stoichiometric matrix do
+    """
+
+    def __init__(self, index, name):
+        self.index = index
+        self.id = 'm{}'.format(index)
+        self.name = name
+
+    def __hash__(self):
+        return self.index
+
+
+class _Reaction(object):
+
+    def __init__(self, reaction_id, metabolites, lower_bound, upper_bound):
+        self.id = self.name = reaction_id
+        self._metabolites = metabolites
+        self.lower_bound = lower_bound
+        self.upper_bound = upper_bound
+        self.objective_coefficient = 0.
+        self.reversibility = lower_bound < 0 < upper_bound
+        self.reactants = [m for m in sorted(metabolites, key=lambda m: m.index) if metabolites[m] < 0]
+        self.products = [m for m in sorted(metabolites, key=lambda m: m.index) if metabolites[m] > 0]
+
+
+class _Model(object):
+
+    def __init__(self, metabolites, reactions):
+        self.metabolites = metabolites
+        self.reactions = reactions
+
+
+def _model():
+    names = [u'α-D-glucose', u'D-glucose 6-phosphate', 'ATP', 'ADP', 'H+', 'NADX', 'pyruvate', 'NAD(+)']
+    m = [_Metabolite(i, name) for i, name in enumerate(names)]
+    reactions = [_Reaction('HEX1', {m[0]: -1, m[2]: -1, m[1]: 1, m[3]: 1, m[4]: 1}, 0., 1000.),
+                 _Reaction('PGI', {m[1]: -1, m[6]: 2}, -1000., 1000.),
+                 # NAD named reactants are hidden, not the products
+                 _Reaction('NADR', {m[5]: -1, m[7]: -1, m[6]: -1, m[0]: 1, m[3]: 2}, -10., 10.),
+                 _Reaction('ATPM', {m[2]: -1, m[3]: 1}, 0., 1000.),
+                 _Reaction('EX_glc', {m[0]: -1}, -10., 1000.),
+                 _Reaction('NADX_prod', {m[7]: -1, m[5]: 1}, 0., 1000.)]
+    return _Model(m, reactions)
+
+
+@pytest.mark.parametrize('fluxes', [[10.5, -2.25, 3.75, 0., -10.5, 1.],
+                                    [0., 0., 0., 0., 0., 0.],
+                                    [1., 2., -3., 4., 5., -6.]])
+def test_render_matches_loop_network(fluxes):
+    model = _model()
+    arrays = ModelArrays.from_cobra_model(model)
+    x_dict = dict((r.id, f) for r, f in zip(model.reactions, fluxes))
+
+    random.seed(0)
+    expected = cobra_utils._build_genome_scale_network(model, {'x_dict': x_dict})
+    assert expected['edges']
+
+    stored = kepavi_results.loads(kepavi_results.dumps({'x_dict': x_dict}, arrays.reaction_ids))
+    for results in ({'x_dict': x_dict}, stored):
+        # same random positions, drawn in the same node order
+        random.seed(0)
+        assert cobra_utils.build_genome_scale_network(arrays, results) == expected
+
+
+def test_render_positions():
+    model = _model()
+    arrays = ModelArrays.from_cobra_model(model)
+    positions = [[float(i), -float(i)] for i in range(arrays.n_metabolites)]
+    topology = cobra_utils.genome_scale_topology(arrays, positions)
+    graph = topology.render([1.] * arrays.n_reactions)
+    assert [(n['x'], n['y']) for n in graph['nodes']] == \
+        [(float(n['id'][1:]), -float(n['id'][1:])) for n in graph['nodes']]
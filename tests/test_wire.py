@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from kepavi import wire
+from kepavi._compat import text_type
+
+
+def _node(node_id, name, flux, x=0.5, y=0.25):
+    return {'id': node_id,
+            'label': name[:10] + '...',
+            'full_name': name,
+            'size': 5,
+            'x': x,
+            'y': y,
+            'flux': flux,
+            'cumflux': int(abs(flux))}
+
+
+def _edge(source, target, flux, reversible=False):
+    return {'id': '-'.join([source, target, '0', '0']),
+            'label': '',
+            'source': source,
+            'target': target,
+            'size': 1,
+            'flux': flux,
+            'absflux': abs(flux),
+            'reversible': reversible,
+            'sign': 'neg' if flux < 0 else 'pos' if flux > 0 else 'zero'}
+
+
+def _graph():
+    return {'nodes': [_node('glc__D_c', u'α-D-glucose', 2.5, 0.1, 0.2),
+                      _node('g6p_c', u'D-glucose 6-phosphate', -1., 0.3, 0.4),
+                      _node('f6p_c', u'fructose', 0., 0.5, 0.6)],
+            'edges': [_edge('glc__D_c', 'g6p_c', 2.5),
+                      _edge('g6p_c', 'f6p_c', -1., reversible=True),
+                      _edge('f6p_c', 'glc__D_c', 0.)],
+            'pathway': u'Glycolysis / Gluconeogenesis'}
+
+
+def _columns(encoded, part):
+    return dict((c['name'], c) for c in encoded[part]['columns'])
+
+
+def test_columnar_round_trip():
+    graph = _graph()
+    assert wire.decode(wire.encode(graph)) == graph
+    # as sent to the browser
+    assert wire.decode(json.loads(json.dumps(wire.encode(graph)))) == graph
+
+
+def test_binary_round_trip():
+    graph = _graph()
+    data = wire.dumps(graph)
+    assert data[:4] == wire.MAGIC
+    assert wire.loads(data) == graph
+    assert wire.loads(bytearray(data)) == graph
+
+
+def test_derived_and_constant_columns():
+    encoded = wire.encode(_graph())
+    nodes, edges = _columns(encoded, 'nodes'), _columns(encoded, 'edges')
+    assert nodes['label']['type'] == 'abbreviation'
+    assert 'values' not in nodes['label']
+    assert nodes['size'] == {'type': 'constant', 'value': 5, 'name': 'size'}
+    assert edges['absflux']['type'] == 'abs'
+    assert edges['sign']['type'] == 'sign'
+    assert edges['source']['type'] == 'node'
+    assert edges['reversible']['type'] == 'bool'
+
+
+def test_empty_graph():
+    graph = {'nodes': [], 'edges': []}
+    assert wire.decode(wire.encode(graph)) == graph
+    assert wire.loads(wire.dumps(graph)) == graph
+
+
+def test_single_node():
+    graph = {'nodes': [_node('h2o_c', u'H2O', 1.5)], 'edges': []}
+    encoded = wire.encode(graph)
+    # every column holds a single value
+    assert all(c['type'] in ('constant', 'abbreviation') for c in encoded['nodes']['columns'])
+    assert wire.decode(encoded) == graph
+    assert wire.loads(wire.dumps(graph)) == graph
+
+
+def test_missing_keys():
+    nodes = [_node('a', u'a', 1.), _node('b', u'b', 2.)]
+    del nodes[1]['x']
+    nodes[0]['compound_img'] = u'C00031'
+    graph = {'nodes': nodes, 'edges': [_edge('a', 'b', 1.)]}
+    assert wire.decode(wire.encode(graph)) == graph
+    assert wire.loads(wire.dumps(graph)) == graph
+
+
+def test_non_ascii_labels():
+    names = [u'α-D-glucose 6-phosphate', u'β-D-fructose', u'caf\xe9ine']
+    graph = {'nodes': [_node(u'm{}'.format(i), name, float(i)) for i, name in enumerate(names)],
+             'edges': []}
+    for decoded in (wire.decode(json.loads(json.dumps(wire.encode(graph)))),
+                    wire.loads(wire.dumps(graph))):
+        assert decoded == graph
+        assert all(isinstance(n['full_name'], text_type) for n in decoded['nodes'])
+        assert all(isinstance(n['label'], text_type) for n in decoded['nodes'])
+
+
+def test_large_integers():
+    graph = {'nodes': [_node('a', u'a', 1.), _node('b', u'b', 2.)], 'edges': []}
+    graph['nodes'][0]['cumflux'], graph['nodes'][1]['cumflux'] = 2 ** 40, -3
+    assert wire.loads(wire.dumps(graph)) == graph
+
+
+def test_errors():
+    with pytest.raises(wire.WireError):
+        wire.loads(b'KPV')
+    with pytest.raises(wire.WireError):
+        wire.loads(b'XXXX' + wire.dumps(_graph())[4:])
+    with pytest.raises(wire.WireError):
+        wire.decode({'format': 'json'})